@@ -26,28 +26,65 @@
 
 import os
 from re import match
+from collections import deque
 from multiprocessing.pool import ThreadPool
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from urllib3.exceptions import HTTPError
 import numpy as np
 from qgis.PyQt import QtGui, uic
+from qgis.PyQt.QtCore import QCoreApplication
 from qgis.PyQt.QtWidgets import QMessageBox, QDialog
 from qgis.gui import QgsMapToolEmitPoint  # pylint: disable = no-name-in-module
 from qgis.core import (  # pylint: disable = no-name-in-module
     QgsMapLayerProxyModel, QgsFeature, QgsProject, QgsPointXY,
     QgsGeometry, QgsSymbol, QgsGraduatedSymbolRenderer,
     QgsVectorLayer, QgsRendererRange, QgsFillSymbol,
-    QgsSingleSymbolRenderer
+    QgsSingleSymbolRenderer, QgsRasterLayer, QgsVectorFileWriter,
+    QgsCoordinateReferenceSystem, QgsCoordinateTransformContext,
+    QgsMessageLog, Qgis, QgsCategorizedSymbolRenderer, QgsRendererCategory,
+    QgsLimitedRandomColorRamp
 )
 from .osrm_utils import (
     get_isochrones_colors, prep_access_parsed, get_coords_ids,
-    interpolate_from_times, qgsgeom_from_mpl_contour
+    qgsgeom_from_rings, ISOCHRONE_CACHE, save_dialog_raster,
+    merge_time_grids, write_time_raster, save_dialog_gpkg, search_frames,
+    make_regular_points, nearest_facility, qgsgeom_from_label_rings
+)
+from .osrm_utils_isochrone import (
+    submit_isochrone, isochrone_result, interpolate_grid, nearest_label_grid,
+    label_rings, interpolation_grid_shape
 )
 from .osrm_polyfill import Qgis_GeometryType_Point
+from .osrm_polyfill import Qgis_WkbType_MultiPolygon
+from .osrm_polyfill import QgsVectorFileWriter_WriterError_NoError
+from .osrm_polyfill import (
+    QgsVectorFileWriter_ActionOnExistingFile_CreateOrOverwriteFile
+)
 from .template_osrm import TemplateOsrm
 
 
 FORM_CLASS_ACCESS_DIALOG_BASE, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'ui/osrm_access_dialog_base.ui'))
 
+# Below this number of centers, starting worker processes costs more than
+# interpolating and contouring in the QGIS process
+PROCESS_POOL_MIN_CENTERS = 4
+
+# Maximum number of centers fetched or contoured at the same time when
+# streaming one isochrone set per feature to a GeoPackage
+STREAM_MAX_IN_FLIGHT = 16
+
+# Errors of the requests or the contouring of one center (which do not stop
+# the streaming of the others)
+STREAM_CENTER_ERRORS = (ValueError, HTTPError, KeyError, AssertionError)
+
+# Number of points of the regional grid sampled for the service areas:
+# at least SERVICE_AREA_MIN_POINTS, the facilities x grid matrix having at
+# most SERVICE_AREA_MAX_CELLS cells
+SERVICE_AREA_MIN_POINTS = 2500
+SERVICE_AREA_MAX_CELLS = 1000000
+
 
 class OSRMAccessDialog(QDialog, FORM_CLASS_ACCESS_DIALOG_BASE, TemplateOsrm):
     """Dialog for calculating access isochrones"""
@@ -67,6 +104,14 @@ class OSRMAccessDialog(QDialog, FORM_CLASS_ACCESS_DIALOG_BASE, TemplateOsrm):
         self.pushButtonClear.clicked.connect(self.clear_all_isochrone)
         self.close_button_box.clicked.connect(self.close_button_clicked)
         self.lineEdit_xyO.textChanged.connect(self.change_nb_center)
+        self.checkBox_raster.toggled.connect(self.enable_raster_output)
+        self.pushButton_raster_browse.clicked.connect(
+            self.output_dialog_raster
+        )
+        self.checkBox_per_feature.toggled.connect(self.enable_gpkg_output)
+        self.pushButton_gpkg_browse.clicked.connect(self.output_dialog_gpkg)
+        self.pushButton_cancel.clicked.connect(self.cancel_isochrones)
+        self.cancelled = False
         self.intermediate = []
         self.nb_isocr = 0
         self.progress = None
@@ -97,19 +142,86 @@ class OSRMAccessDialog(QDialog, FORM_CLASS_ACCESS_DIALOG_BASE, TemplateOsrm):
             self.comboBox_pointlayer.setEnabled,
             self.label_3.setEnabled,
             self.checkBox_selectedFt.setEnabled,
-            self.pushButton_fetch.setEnabled
+            self.pushButton_fetch.setEnabled,
+            self.checkBox_per_feature.setEnabled
         )
         text = self.comboBox_method.currentText()
         if 'clicking' in text:
-            values = (True, True, False, False, False, True)
+            values = (True, True, False, False, False, True, False)
         elif 'selecting' in text:
-            values = (False, False, True, True, True, True)
+            values = (False, False, True, True, True, True, True)
+        elif 'facility' in text:
+            values = (False, False, True, True, True, True, False)
         elif 'method' in text:
-            values = (False, False, False, False, False, False)
+            values = (False, False, False, False, False, False, False)
         else:
             return
         for func, bool_value in zip(functions, values):
             func(bool_value)
+        self.enable_gpkg_output(
+            self.checkBox_per_feature.isEnabled()
+            and self.checkBox_per_feature.isChecked()
+        )
+
+    def enable_gpkg_output(self, checked):
+        """
+        Enable or disable the per feature GeoPackage output widgets (the
+        streamed isochrones having no travel-time raster output)
+        """
+        self.lineEdit_gpkg.setEnabled(checked)
+        self.pushButton_gpkg_browse.setEnabled(checked)
+        self.checkBox_raster.setEnabled(not checked)
+        self.enable_raster_output(
+            not checked and self.checkBox_raster.isChecked())
+
+    def output_dialog_gpkg(self):
+        """Manages dialog for setting the per feature GeoPackage filename"""
+        self.lineEdit_gpkg.clear()
+        filename, _ = save_dialog_gpkg()
+        if filename is None:
+            return
+        self.lineEdit_gpkg.setText(filename)
+
+    def cancel_isochrones(self):
+        """Handle cancel button action while streaming isochrones"""
+        self.cancelled = True
+
+    def enable_raster_output(self, checked):
+        """Enable or disable the travel-time raster output widgets"""
+        self.label_raster_res.setEnabled(checked)
+        self.spinBox_raster_res.setEnabled(checked)
+        self.lineEdit_raster.setEnabled(checked)
+        self.pushButton_raster_browse.setEnabled(checked)
+
+    def output_dialog_raster(self):
+        """Manages dialog for setting the travel-time raster filename"""
+        self.lineEdit_raster.clear()
+        filename, _ = save_dialog_raster()
+        if filename is None:
+            return
+        self.lineEdit_raster.setText(filename)
+
+    def save_time_raster(self, grids):
+        """
+        Merge the interpolated time grids of every center in a GeoTIFF
+        travel-time raster and add it to the canvas
+        """
+        filename = self.lineEdit_raster.text()
+        try:
+            merged, geotransform = merge_time_grids(
+                grids, self.spinBox_raster_res.value())
+            write_time_raster(filename, merged, geotransform)
+        except (ValueError, RuntimeError) as err:
+            self.display_error(err, 1)
+            return -1
+
+        raster_layer = QgsRasterLayer(
+            filename, f"isochrone_osrm_raster_{self.nb_isocr}")
+        if not raster_layer.isValid():
+            self.display_error(f"Invalid raster file {filename}", 1)
+            return -1
+        QgsProject.instance().addMapLayer(raster_layer)
+        return 0
 
     def clear_all_isochrone(self):
         """
@@ -182,22 +294,48 @@ class OSRMAccessDialog(QDialog, FORM_CLASS_ACCESS_DIALOG_BASE, TemplateOsrm):
         - make an interpolation grid to extract polygons corresponding to the
             desired time intervals (using scipy library),
         - render the polygon.
+        Times and interpolation grids are kept in a per-session cache, so
+        a later run with other levels (or a smaller max time) on the same
+        centers only extracts the new polygons.
         """
+        per_feature = False
+        service_areas = 'facility' in self.comboBox_method.currentText()
         if 'clicking' in self.comboBox_method.currentText():
             pts = self.intermediate
-        elif 'selecting' in self.comboBox_method.currentText():
+        elif 'selecting' in self.comboBox_method.currentText() \
+                or service_areas:
             layer = self.comboBox_pointlayer.currentLayer()
-            pts, _ = get_coords_ids(
+            pts, ids = get_coords_ids(
                 layer,
                 '',
                 on_selected=self.checkBox_selectedFt.isChecked()
             )
             pts = tuple(pts)
+            per_feature = self.checkBox_per_feature.isChecked() \
+                and not service_areas
 
         if not pts:
             self.print_no_features()
             return
 
+        if per_feature and '.gpkg' not in self.lineEdit_gpkg.text().lower():
+            QMessageBox.information(
+                self,
+                'Error',
+                "Choose a .gpkg file for the per feature isochrones output"
+            )
+            return
+
+        raster_name = self.lineEdit_raster.text().lower()
+        if self.checkBox_raster.isChecked() and not per_feature \
+                and '.tif' not in raster_name:
+            QMessageBox.information(
+                self,
+                'Error',
+                "Choose a .tif file for the travel-time raster output"
+            )
+            return
+
         max_time = self.spinBox_max.value()
         interval_time = self.spinBox_intervall.value()
         nb_inter = int(round(max_time / interval_time)) + 1
@@ -210,40 +348,93 @@ class OSRMAccessDialog(QDialog, FORM_CLASS_ACCESS_DIALOG_BASE, TemplateOsrm):
         self.make_prog_bar()
         self.max_points = 500
         self.polygons = []
+        url = self.prepare_request_url(self.base_url, 'table')
+        grid_key = (
+            self.spinBox_grid_res.value() or None,
+            self.checkBox_metric.isChecked()
+        )
+        calibrate = self.checkBox_calibrate.isChecked()
+
+        if service_areas:
+            self.get_service_areas(pts, ids, max_time, url, grid_key)
+            return
+
+        if per_feature:
+            self.stream_isochrones(
+                pts, ids, max_time, levels, interval_time, url, grid_key,
+                calibrate)
+            return
 
+        # The search frames of all the centers are computed in one go :
+        frames = self.center_frames(pts, max_time, calibrate)
         pts = [
             {
                 "point": pt,
                 "max": max_time,
                 "levels": levels,
-                "url": self.prepare_request_url(self.base_url, 'table'),
+                "url": url,
                 "max_points": self.max_points,
-                "api_key": self.api_key
+                "api_key": self.api_key,
+                "calibrate": calibrate,
+                "bounds": frames[i]
             }
-            for pt in pts
+            for i, pt in enumerate(pts)
         ]
 
-        pool = ThreadPool(processes=4 if len(pts) >= 4 else len(pts))
+        # Reuse the times and grids of previous runs, only the centers
+        # never computed with a max time at least as large are requested :
+        entries = [
+            ISOCHRONE_CACHE.get(
+                url, pt["point"], max_time, self.max_points, calibrate)
+            for pt in pts
+        ]
+        missing = [(i, pt) for i, pt in enumerate(pts) if entries[i] is None]
+        use_processes = len(pts) >= PROCESS_POOL_MIN_CENTERS
         self.progress.setValue(5)
-        self.polygons = []
 
+        # Interpolation and contouring run in worker processes, each center
+        # being submitted as soon as its times are known, so that they
+        # overlap with the requests still running in the threads :
+        tasks = {}
+        pool = None
         try:
-            responses = list(pool.map(prep_access_parsed, pts))
-            pool.close()
-
-            for response in responses:
-                times, snapped_dest_coords, levels = response
-                # Fetch MatPlotLib polygons from a griddata interpolation
-                contour_set = interpolate_from_times(
-                    times, np.array(snapped_dest_coords), levels)
+            for i, entry in enumerate(entries):
+                if entry is not None:
+                    task = self.isochrone_task(entry, levels, grid_key)
+                    tasks[submit_isochrone(task, use_processes)] = (i, task)
 
-                # Convert MatPlotLib polygons to QgsGeometry polygons :
-                self.polygons.append(qgsgeom_from_mpl_contour(contour_set))
+            if missing:
+                pool = ThreadPool(
+                    processes=4 if len(missing) >= 4 else len(missing))
+                fetched = pool.imap_unordered(self.fetch_center, missing)
+                for i, (times, snapped_dest_coords, _) in fetched:
+                    entries[i] = ISOCHRONE_CACHE.put(
+                        url, pts[i]["point"], max_time, self.max_points,
+                        times, snapped_dest_coords, None,
+                        calibrate=calibrate
+                    )
+                    task = self.isochrone_task(entries[i], levels, grid_key)
+                    tasks[submit_isochrone(task, use_processes)] = (i, task)
+                pool.close()
+            self.progress.setValue(45)
 
-        except ValueError as err:
+            rings = [None] * len(pts)
+            for future in as_completed(tasks):
+                i, task = tasks[future]
+                entries[i]["grid"], rings[i] = isochrone_result(future, task)
+                entries[i]["grid_key"] = grid_key
+        except STREAM_CENTER_ERRORS as err:
             self.display_error(err, 1)
-            pool.close()
             return
+        finally:
+            # Nothing is left running when a center fails :
+            if pool is not None:
+                pool.terminate()
+            for future in tasks:
+                future.cancel()
+
+        # Convert the contour rings to QgsGeometry polygons :
+        self.polygons = [qgsgeom_from_rings(ring) for ring in rings]
 
         if len(self.polygons) == 1:
             self.polygons = self.polygons[0]
@@ -272,6 +463,9 @@ class OSRMAccessDialog(QDialog, FORM_CLASS_ACCESS_DIALOG_BASE, TemplateOsrm):
                 [i, levels[i] - interval_time, levels[i]])
             features.append(ft)
         data_provider.addFeatures(features[::-1])
+        self.progress.setValue(90)
+        if self.checkBox_raster.isChecked():
+            self.save_time_raster([entry["grid"] for entry in entries])
         self.nb_isocr += 1
         self.progress.setValue(95)
 
@@ -286,6 +480,276 @@ class OSRMAccessDialog(QDialog, FORM_CLASS_ACCESS_DIALOG_BASE, TemplateOsrm):
         self.add_final_pts(pts)
         self.iface.setActiveLayer(isochrone_layer)
 
+    def service_area_points(self, bounds, nb_facilities, resolution):
+        """
+        Number of points of the regional grid of the service areas: one
+        point per cell of the interpolation resolution over the bounds, or
+        the point budget of an isochrone center for each facility without
+        resolution, capped so that the facilities x grid matrix stays
+        within SERVICE_AREA_MAX_CELLS
+        """
+        max_points = max(SERVICE_AREA_MAX_CELLS // nb_facilities, 4)
+        if resolution:
+            nb_x, nb_y = interpolation_grid_shape(
+                bounds, resolution, max_points)
+            nb_pts = nb_x * nb_y
+        else:
+            nb_pts = self.max_points * nb_facilities
+        return min(max(nb_pts, SERVICE_AREA_MIN_POINTS), max_points)
+
+    def get_service_areas(self, pts, ids, max_time, url, grid_key):
+        """
+        Assign every location of the region to its closest facility by
+        travel time, in one matrix pass instead of one isochrone per
+        facility: a single regional grid is sampled around the facilities,
+        the facilities x grid matrix is fetched in blocks keeping the
+        minimum time and its facility for each grid point, then the
+        facility labels are contoured as one catchment polygon per facility
+        (limited to the max time).
+        """
+        frames = search_frames([(pt[0], pt[1]) for pt in pts], max_time)
+        bounds = (
+            frames[:, 0].min(), frames[:, 1].min(),
+            frames[:, 2].max(), frames[:, 3].max()
+        )
+        coords_grid = make_regular_points(
+            bounds, self.service_area_points(bounds, len(pts), grid_key[0]))
+        self.progress.setValue(5)
+        try:
+            times, labels, snapped = nearest_facility(
+                url, self.api_key, list(pts), coords_grid)
+        except ValueError as err:
+            self.display_error(err, 1)
+            return
+        self.progress.setValue(60)
+
+        xi, yi, zi = interpolate_grid(
+            times, snapped, resolution=grid_key[0], metric=grid_key[1])
+        label_grid = nearest_label_grid(xi, yi, snapped, labels)
+        with np.errstate(invalid='ignore'):
+            label_grid[np.isnan(zi) | (zi > max_time)] = -1
+        rings = label_rings(xi, yi, label_grid, len(pts))
+        self.progress.setValue(80)
+
+        service_layer = QgsVectorLayer(
+            "MultiPolygon?crs=epsg:4326&field=id:integer"
+            "&field=facility:string(254)&field=max:integer(10)",
+            f"isochrone_osrm_service_{self.nb_isocr}", "memory")
+        features = []
+        categories = []
+        colors = QgsLimitedRandomColorRamp.randomColors(max(len(pts), 1))
+        for i, facility_rings in enumerate(rings):
+            if not facility_rings:
+                continue
+            ft = QgsFeature()
+            ft.setGeometry(qgsgeom_from_label_rings(facility_rings))
+            ft.setAttributes([i, str(ids[i]), max_time])
+            features.append(ft)
+            symbol = QgsFillSymbol()
+            symbol.setColor(colors[i])
+            categories.append(
+                QgsRendererCategory(str(ids[i]), symbol, str(ids[i])))
+        service_layer.dataProvider().addFeatures(features)
+        self.progress.setValue(90)
+        if self.checkBox_raster.isChecked():
+            self.save_time_raster([(xi, yi, zi)])
+        self.nb_isocr += 1
+
+        service_layer.setRenderer(
+            QgsCategorizedSymbolRenderer('facility', categories))
+        service_layer.setOpacity(0.5)
+        self.iface.messageBar().clearWidgets()
+        QgsProject.instance().addMapLayer(service_layer)
+        self.iface.setActiveLayer(service_layer)
+
+    def stream_isochrones(self, pts, ids, max_time, levels, interval_time,
+                          url, grid_key, calibrate):
+        """
+        Compute one isochrone set per center in a bounded pipeline (at most
+        STREAM_MAX_IN_FLIGHT centers being fetched or contoured at once)
+        and write the bands of each center, with its feature id, to the
+        GeoPackage as soon as they are ready, so that memory use does not
+        depend on the number of centers. The computation can be stopped
+        with the cancel button.
+        """
+        filename = self.lineEdit_gpkg.text()
+        template_layer = QgsVectorLayer(
+            "MultiPolygon?crs=epsg:4326&field=center_id:long"
+            "&field=id:integer&field=min:integer(10)&field=max:integer(10)",
+            "isochrone_osrm_template", "memory")
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = "GPKG"
+        options.layerName = "isochrones_osrm"
+        options.actionOnExistingFile = \
+            QgsVectorFileWriter_ActionOnExistingFile_CreateOrOverwriteFile()
+        writer = QgsVectorFileWriter.create(
+            filename,
+            template_layer.fields(),
+            Qgis_WkbType_MultiPolygon(),
+            QgsCoordinateReferenceSystem.fromEpsgId(4326),
+            QgsCoordinateTransformContext(),
+            options
+        )
+        if writer.hasError() != QgsVectorFileWriter_WriterError_NoError():
+            self.display_error(writer.errorMessage(), 1)
+            return
+
+        nb_centers = len(pts)
+        use_processes = nb_centers >= PROCESS_POOL_MIN_CENTERS
+        requests = deque()
+        tasks = deque()
+        next_center, nb_done, nb_errors = 0, 0, 0
+        self.cancelled = False
+        self.pushButton_cancel.setEnabled(True)
+        pool = ThreadPool(processes=4 if nb_centers >= 4 else nb_centers)
+        executor = ThreadPoolExecutor(max_workers=2)
+
+        try:
+            frames = self.center_frames(pts, max_time, calibrate)
+            while (next_center < nb_centers or requests or tasks) \
+                    and not self.cancelled:
+                while next_center < nb_centers and \
+                        len(requests) + len(tasks) < STREAM_MAX_IN_FLIGHT:
+                    time_param = {
+                        "point": pts[next_center],
+                        "max": max_time,
+                        "levels": levels,
+                        "url": url,
+                        "max_points": self.max_points,
+                        "api_key": self.api_key,
+                        "calibrate": calibrate,
+                        "bounds": frames[next_center]
+                    }
+                    requests.append((
+                        next_center,
+                        pool.apply_async(prep_access_parsed, (time_param,))
+                    ))
+                    next_center += 1
+
+                # Only finished requests and contours are collected, so
+                # that the loop never blocks the event loop (and the cancel
+                # button) for a whole request or contour
+                progressed = False
+                if requests and requests[0][1].ready():
+                    index, request = requests.popleft()
+                    progressed = True
+                    try:
+                        times, snapped_dest_coords, _ = request.get()
+                        task = {
+                            "times": times,
+                            "coords": snapped_dest_coords,
+                            "levels": levels,
+                            "resolution": grid_key[0],
+                            "metric": grid_key[1]
+                        }
+                        tasks.append((index, task, submit_isochrone(
+                            task, use_processes, executor)))
+                    except STREAM_CENTER_ERRORS as err:
+                        nb_errors += 1
+                        QgsMessageLog.logMessage(
+                            f"OSRM-plugin error report :\n {err}",
+                            level=Qgis.Warning
+                        )
+
+                if tasks and tasks[0][2].done():
+                    index, task, future = tasks.popleft()
+                    progressed = True
+                    try:
+                        _, rings = isochrone_result(future, task)
+                    except STREAM_CENTER_ERRORS as err:
+                        nb_errors += 1
+                        QgsMessageLog.logMessage(
+                            f"OSRM-plugin error report :\n {err}",
+                            level=Qgis.Warning
+                        )
+                    else:
+                        self.write_center_bands(
+                            writer, template_layer.fields(), ids[index],
+                            rings, levels, interval_time)
+                        nb_done += 1
+
+                self.progress.setValue(
+                    5 + int(90 * (nb_done + nb_errors) / nb_centers))
+
+                if not progressed:
+                    if requests:
+                        requests[0][1].wait(0.05)
+                    elif tasks:
+                        wait_futures([tasks[0][2]], timeout=0.05)
+                QCoreApplication.processEvents()
+        finally:
+            pool.terminate()
+            for _, _, future in tasks:
+                future.cancel()
+            executor.shutdown(wait=False, cancel_futures=True)
+            del writer  # Closing the writer flushes the GeoPackage
+            self.pushButton_cancel.setEnabled(False)
+            self.iface.messageBar().clearWidgets()
+
+        isochrone_layer = QgsVectorLayer(
+            f"{filename}|layername=isochrones_osrm",
+            f"isochrone_osrm_{self.nb_isocr}", "ogr")
+        isochrone_layer.setRenderer(self.prepare_renderer(
+            levels[1:], interval_time, len(levels) - 1))
+        isochrone_layer.setOpacity(0.25)
+        QgsProject.instance().addMapLayer(isochrone_layer)
+        self.nb_isocr += 1
+
+        if self.cancelled or nb_errors:
+            self.iface.messageBar().pushMessage(
+                "Info",
+                f"{nb_done} of {nb_centers} isochrone sets "
+                f"saved in {filename}"
+                + (" (cancelled)" if self.cancelled else "")
+                + (f", {nb_errors} errors (see QGis log)"
+                   if nb_errors else ""),
+                duration=10
+            )
+
+    @staticmethod
+    def write_center_bands(writer, fields, center_id, rings, levels,
+                           interval_time):
+        """Write the isochrone bands of one center with the writer"""
+        for i, poly in enumerate(qgsgeom_from_rings(rings)):
+            if poly.isEmpty():
+                continue
+            poly.convertToMultiType()
+            ft = QgsFeature(fields)
+            ft.setGeometry(poly)
+            ft.setAttributes([
+                center_id, i, levels[i + 1] - interval_time, levels[i + 1]
+            ])
+            writer.addFeature(ft)
+
+    @staticmethod
+    def fetch_center(item):
+        """Fetch the times of one isochrone center, keeping its index"""
+        index, time_param = item
+        return index, prep_access_parsed(time_param)
+
+    @staticmethod
+    def center_frames(pts, max_time, calibrate):
+        """
+        Search frames of every center from one vectorized computation
+        (None when calibrating, the frames then come from probe requests)
+        """
+        if calibrate:
+            return [None] * len(pts)
+        frames = search_frames([(pt[0], pt[1]) for pt in pts], max_time)
+        return [tuple(frame) for frame in frames.tolist()]
+
+    @staticmethod
+    def isochrone_task(entry, levels, grid_key):
+        """Prepare the interpolation and contouring task of a cache entry"""
+        return {
+            "times": entry["times"],
+            "coords": entry["coords"],
+            "levels": levels,
+            "resolution": grid_key[0],
+            "metric": grid_key[1],
+            "grid": entry["grid"] if entry["grid_key"] == grid_key else None
+        }
+
     @staticmethod
     def prepare_renderer(levels, inter_time, lenpoly):
         """Build renderer for isochrones"""
@@ -28,15 +28,22 @@ from re import match
 import os
 from multiprocessing.pool import ThreadPool
 from urllib3.exceptions import HTTPError
+import numpy as np
 from qgis.PyQt import uic
 from qgis.PyQt.QtWidgets import QMessageBox, QDialog
 from qgis.core import (  # pylint: disable = no-name-in-module
     QgsMapLayerProxyModel, QgsMessageLog,
-    QgsCoordinateTransform, QgsFeature, QgsCoordinateReferenceSystem,
-    QgsProject, QgsVectorLayer, QgsVectorFileWriter,
-    QgsCoordinateTransformContext, Qgis
+    QgsFeature, QgsProject, QgsVectorLayer, QgsVectorFileWriter,
+    QgsCoordinateTransformContext, Qgis, QgsGeometry, QgsPointXY
+)
+from .osrm_utils import (
+    decode_geom, save_dialog_geo, open_dialog, read_csv, fetch_sparse_pairs,
+    get_coords_ids, add_hints, store_hints, profile_query, profile_precision,
+    prep_segments_layer, REQUEST_PROFILES, ROUTE_ANNOTATIONS
+)
+from .osrm_polyfill import (
+    QgsVectorFileWriter_ActionOnExistingFile_CreateOrOverwriteFile
 )
-from .osrm_utils import decode_geom, save_dialog_geo, open_dialog, read_csv
 from .template_osrm import TemplateOsrm
 
 
@@ -46,6 +53,9 @@ FORM_CLASS_BATCH_ROUTE, _ = uic.loadUiType(os.path.join(
 FORM_CLASS_DIALOG_TSP, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'ui/osrm_dialog_tsp.ui'))
 
+# Request profiles (see REQUEST_PROFILES) of the items of comboBox_profile
+BATCH_ROUTE_PROFILES = ('analysis', 'display', 'attributes')
+
 
 class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
     """Batch route calculation dialog"""
@@ -66,12 +76,19 @@ class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
         self.pushButtonRun.clicked.connect(self.get_batch_route)
         self.pushButtonClear.clicked.connect(self.clear_all_routes)
         self.comboBox_method.activated.connect(self.enable_functionnality)
+        self.checkBox_table_only.toggled.connect(
+            self.comboBox_profile.setDisabled)
+        self.checkBox_table_only.toggled.connect(
+            self.checkBox_annotations.setDisabled)
         self.nb_route = 0
         self.nb_done = 0
         self.errors = 0
         self.filename = None
         self.encoding = None
         self.csv_data = None
+        self.profile = BATCH_ROUTE_PROFILES[0]
+        self.annotations = False
+        self.annotated_routes = []
         self.load_providers()
 
     def clear_all_routes(self):
@@ -166,43 +183,18 @@ class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
         if self.ComboBoxOrigin.isEnabled():
             origin_layer = self.ComboBoxOrigin.currentLayer()
             destination_layer = self.ComboBoxDestination.currentLayer()
-            if '4326' not in origin_layer.crs().authid():
-                xform = QgsCoordinateTransform(
-                    origin_layer.crs(),
-                    QgsCoordinateReferenceSystem.fromEpsgId(4326),
-                    QgsCoordinateTransformContext()
-                )
-                origin_ids_coords = \
-                    [(ft.id(), xform.transform(ft.geometry().asPoint()))
-                     for ft in origin_layer.getFeatures()]
-            else:
-                origin_ids_coords = \
-                    [(ft.id(), ft.geometry().asPoint())
-                     for ft in origin_layer.getFeatures()]
-
-            if '4326' not in destination_layer.crs().authid():
-                xform = QgsCoordinateTransform(
-                    origin_layer.crs(),
-                    QgsCoordinateReferenceSystem.fromEpsgId(4326),
-                    QgsCoordinateTransformContext()
-                )
-                destination_ids_coords = \
-                    [(ft.id(), xform.transform(ft.geometry().asPoint()))
-                     for ft in destination_layer.getFeatures()]
-            else:
-                destination_ids_coords = \
-                    [(ft.id(), ft.geometry().asPoint())
-                     for ft in destination_layer.getFeatures()]
+            origin_coords, _ = get_coords_ids(origin_layer, '')
+            destination_coords, _ = get_coords_ids(destination_layer, '')
 
-            if len(origin_ids_coords) * len(destination_ids_coords) > 100000:
+            if len(origin_coords) * len(destination_coords) > 100000:
                 QMessageBox.information(
                     self, 'Info',
                     "Too many route to calculate, try with less than 100000")
                 return -1
 
-            return [(origin[1][1], origin[1][0], dest[1][1], dest[1][0])
-                    for origin in origin_ids_coords
-                    for dest in destination_ids_coords]
+            return [(origin[1], origin[0], dest[1], dest[0])
+                    for origin in origin_coords
+                    for dest in destination_coords]
 
         if self.FieldOriginX.isEnabled():
             fox = self.FieldOriginX.currentText()
@@ -299,17 +291,36 @@ class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
                 "Please, don't make heavy requests on the public API")
             return -1
 
+        self.profile = BATCH_ROUTE_PROFILES[
+            self.comboBox_profile.currentIndex()]
+        self.annotations = self.checkBox_annotations.isChecked() and \
+            not self.checkBox_table_only.isChecked()
+        if self.annotations and \
+                REQUEST_PROFILES[self.profile].get('overview') != 'full':
+            QMessageBox.information(
+                self, 'Info',
+                "Segment annotations need the full route geometry")
+            return -1
+        self.annotated_routes = []
         self.make_prog_bar()
         self.progress.setValue(5)
-        pool = ThreadPool(processes=4 if len(queries) >= 4 else len(queries))
 
-        try:
-            features = list(pool.map(self.prep_routes, queries))
-            pool.close()
-        except ValueError as err:
-            self.display_error(err, 1)
-            pool.close()
-            return -1
+        if self.checkBox_table_only.isChecked():
+            try:
+                features = self.prep_table_routes(queries)
+            except ValueError as err:
+                self.display_error(err, 1)
+                return -1
+        else:
+            pool = ThreadPool(
+                processes=4 if len(queries) >= 4 else len(queries))
+            try:
+                features = list(pool.map(self.prep_routes, queries))
+                pool.close()
+            except ValueError as err:
+                self.display_error(err, 1)
+                pool.close()
+                return -1
 
         self.progress.setValue(85)
 
@@ -327,6 +338,8 @@ class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
             return -1
 
         self.return_batch_route(features)
+        if self.annotated_routes:
+            self.return_segments()
         self.progress.setValue(95)
         return 0
 
@@ -334,23 +347,38 @@ class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
         """Fetch and parse route objects from query points"""
         yo, xo, yd, xd = query
         try:
+            service_url = self.prepare_request_url(self.base_url, 'route')
             url = ''.join(
                 [
-                    self.prepare_request_url(self.base_url, 'route'),
-                    f"{xo},{yo};{xd},{yd}?overview=full&steps=false&"
-                    f"alternatives=false"
+                    service_url,
+                    f"{xo},{yo};{xd},{yd}?",
+                    profile_query(self.profile),
+                    "&steps=false&alternatives=false",
+                    f"&annotations={ROUTE_ANNOTATIONS}"
+                    if self.annotations else ""
                 ]
             )
+            url = add_hints(url, service_url, [(xo, yo), (xd, yd)],
+                            skip_waypoints=True)
             if self.api_key:
                 url = ''.join([url, '&api_key=', self.api_key])
             parsed = self.query_url(url)
+            store_hints(service_url, [(xo, yo), (xd, yd)], parsed)
         except (HTTPError) as err:
             self.display_error(err, 1)
             self.errors += 1
 
             return -1
         try:
-            line_geom = decode_geom(parsed['routes'][0]["geometry"])
+            route = parsed['routes'][0]
+            if self.profile == 'attributes':
+                line_geom = QgsGeometry.fromPolylineXY([
+                    QgsPointXY(float(xo), float(yo)),
+                    QgsPointXY(float(xd), float(yd))
+                ])
+            else:
+                line_geom = decode_geom(route["geometry"],
+                                        profile_precision(self.profile))
 
         except KeyError:
             self.iface.messageBar().pushMessage(
@@ -365,13 +393,64 @@ class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
         fet.setGeometry(line_geom)
         fet.setAttributes([
             self.nb_route,
-            parsed['routes'][0]['duration'] / 60,
-            parsed['routes'][0]['distance']
+            route['duration'] / 60,
+            route['distance']
         ])
+        if self.annotations:
+            self.annotated_routes.append((self.nb_route, route))
         self.nb_route += 1
 
         return fet
 
+    def prep_table_routes(self, queries):
+        """
+        Fetch the time and distance of every origin-destination pair with a
+        few table requests covering the sparse set of pairs (instead of one
+        route request per pair) and make straight lines for them
+        """
+        queries = np.array(queries, dtype=float)
+        coords_src, src_index = np.unique(
+            queries[:, [1, 0]], axis=0, return_inverse=True)
+        coords_dest, dest_index = np.unique(
+            queries[:, [3, 2]], axis=0, return_inverse=True)
+        pairs = np.column_stack((src_index.ravel(), dest_index.ravel()))
+        coords_src, coords_dest = coords_src.tolist(), coords_dest.tolist()
+
+        url = self.prepare_request_url(self.base_url, 'table')
+        durations, distances = fetch_sparse_pairs(
+            url, self.api_key, coords_src, coords_dest, pairs,
+            ['Durations', 'Distances'])
+
+        features = []
+        for i, (yo, xo, yd, xd) in enumerate(queries):
+            if np.isnan(durations[i]):
+                self.errors += 1
+                continue
+            fet = QgsFeature()
+            fet.setGeometry(QgsGeometry.fromPolylineXY(
+                [QgsPointXY(xo, yo), QgsPointXY(xd, yd)]))
+            fet.setAttributes([
+                self.nb_route,
+                durations[i] / 60,
+                distances[i]
+            ])
+            self.nb_route += 1
+            features.append(fet)
+        return features
+
+    def return_segments(self):
+        """Display the segments (see prep_segments_layer) of the routes"""
+        try:
+            segments_layer = prep_segments_layer(
+                f"routes_osrm{self.nb_done}_segments",
+                sorted(self.annotated_routes, key=lambda item: item[0]),
+                profile_precision(self.profile))
+        except (KeyError, ValueError) as err:
+            self.display_error(err, 1)
+            return -1
+        QgsProject.instance().addMapLayer(segments_layer)
+        return 0
+
     def return_batch_route(self, features):
         """Save and/or display the routes retrieved"""
         osrm_batch_route_layer = QgsVectorLayer(
@@ -386,7 +465,7 @@ class OSRMBatchRouteDialog(QDialog, FORM_CLASS_BATCH_ROUTE, TemplateOsrm):
 
         opt = QgsVectorFileWriter.SaveVectorOptions()
         opt.actionOnExistingFile = \
-            QgsVectorFileWriter.ActionOnExistingFile.CreateOrOverwriteFile
+            QgsVectorFileWriter_ActionOnExistingFile_CreateOrOverwriteFile()
         opt.driverName = "ESRI Shapefile"
         opt.fileEncoding = self.encoding
 
@@ -34,8 +34,11 @@ from qgis.core import (  # pylint: disable = no-name-in-module
     QgsGeometry, QgsRuleBasedRenderer, QgsSymbol, QgsSingleSymbolRenderer
 )
 from .osrm_utils import (
-    decode_geom, prepare_route_symbol, put_on_top, encode_to_polyline
+    decode_geom, prepare_route_symbol, put_on_top, encode_to_polyline,
+    fetch_long_route, ROUTE_MAX_COORDS, add_hints, store_hints, profile_query,
+    prep_instruction_layer, prep_segments_layer, ROUTE_ANNOTATIONS
 )
+from .osrm_live_route import OSRMLiveRouteTool
 from .template_osrm import TemplateOsrm
 
 
@@ -60,19 +63,21 @@ class OSRMDialog(QDialog, FORM_CLASS_DIALOG_BASE, TemplateOsrm):
         self.nb_route = 0
         self.intermediate = []
         self.pushButtonTryIt.clicked.connect(self.get_route)
+        self.pushButtonLive.clicked.connect(self.start_live_route)
         self.pushButtonReverse.clicked.connect(self.reverse_origin_destination)
         self.pushButtonClear.clicked.connect(self.clear_all_single)
         self.close_button_box.clicked.connect(self.close_button_clicked)
+        self.checkBox_instructions.toggled.connect(
+            self.checkBox_step_lines.setEnabled)
         self.parsed = None
         self.destination = None
         self.nb_alternative = None
+        self.live_tool = None
         self.load_providers()
 
     def closeEvent(self, event):  # pylint: disable=invalid-name
         """Handle window close event"""
-        self.canvas.unsetMapTool(self.origin_emit)
-        self.canvas.unsetMapTool(self.intermediate_emit)
-        self.canvas.unsetMapTool(self.destination_emit)
+        self.close_button_clicked()
         super().closeEvent(event)
 
     def close_button_clicked(self):
@@ -80,6 +85,8 @@ class OSRMDialog(QDialog, FORM_CLASS_DIALOG_BASE, TemplateOsrm):
         self.canvas.unsetMapTool(self.origin_emit)
         self.canvas.unsetMapTool(self.intermediate_emit)
         self.canvas.unsetMapTool(self.destination_emit)
+        if self.live_tool is not None:
+            self.canvas.unsetMapTool(self.live_tool)
 
     def store_intermediate(self, point):
         """Store intermediate points for route"""
@@ -140,73 +147,6 @@ class OSRMDialog(QDialog, FORM_CLASS_DIALOG_BASE, TemplateOsrm):
             self.repaint_layers()
         self.nb_route = 0
 
-    def prep_instruction(self, nb_route, routes_json, alt=None):
-        """
-        Prepare the instruction layer, each field corresponding to an OSRM
-        viaroute response field.
-        """
-        osrm_instruction_layer = QgsVectorLayer(
-            "Point?crs=epsg:4326&field=id:integer&field=alt:integer"
-            "&field=maneuver_bearing_before:integer"
-            "&field=bearing_after:integer"
-            "&field=maneuver_type:string(254)"
-            "&field=maneuver_modifier:string(254)"
-            "&field=maneuver_exit:integer(20)"
-            "&field=street_name:string(254)"
-            "&field=length_m:real(20)&field=route_idx:integer(20)"
-            "&field=time_min:real(20)",
-            f"instruction_single_osrm{nb_route}",
-            "memory")
-        provider = osrm_instruction_layer.dataProvider()
-
-        nbi = 0
-        features = []
-        for route_idx, route in enumerate(routes_json):
-            for leg in route["legs"]:
-                for step in leg["steps"]:
-                    if "maneuver" not in step:
-                        continue
-                    if "location" not in step["maneuver"]:
-                        continue
-
-                    maneuver = step["maneuver"]
-                    coords = maneuver["location"]
-                    fet = QgsFeature()
-                    pt = QgsPointXY(coords[0], coords[1])
-                    fet.setGeometry(QgsGeometry.fromPointXY(pt))
-                    fet.setAttributes(
-                        [
-                            nbi,
-                            alt if alt is not None else 0,
-                            maneuver["bearing_before"]
-                            if "bearing_before" in maneuver else None,
-                            maneuver["bearing_after"]
-                            if "bearing_after" in maneuver else None,
-                            step["maneuver"]["type"]
-                            if "type" in maneuver else None,
-                            step["maneuver"]["modifier"]
-                            if "modifier" in maneuver else None,
-                            step["maneuver"]["exit"]
-                            if "exit" in maneuver else None,
-                            step["name"],
-                            step["distance"],
-                            route_idx,
-                            step["duration"] / 60
-                        ]
-                    )
-                    features.append(fet)
-                    nbi += 1
-            if (alt is None) and (route_idx > 0):
-                break
-        provider.addFeatures(features)
-
-        symbol = QgsSymbol.defaultSymbol(osrm_instruction_layer.geometryType())
-        symbol.setSize(2)
-        symbol.setColor(QtGui.QColor("#d9ef8b"))
-        osrm_instruction_layer.setRenderer(QgsSingleSymbolRenderer(symbol))
-
-        return provider, osrm_instruction_layer
-
     @staticmethod
     def make_origin_destination_markers(nb, xo, yo, xd, yd, list_coords=None):
         """
@@ -266,10 +206,10 @@ class OSRMDialog(QDialog, FORM_CLASS_DIALOG_BASE, TemplateOsrm):
         origin_destination_layer.setRenderer(renderer)
         return origin_destination_layer
 
-    def get_route(self):
+    def read_waypoints(self):
         """
-        Main method to prepare the request and display the result on the
-        QGIS canvas.
+        Read the origin, the intermediates and the destination coordinates
+        of the line edits (None if they are invalid).
         """
         origin = self.lineEdit_xyO.text()
         interm = self.lineEdit_xyI.text()
@@ -285,41 +225,97 @@ class OSRMDialog(QDialog, FORM_CLASS_DIALOG_BASE, TemplateOsrm):
         except AssertionError:
             self.iface.messageBar().pushMessage(
                 "Error", "Invalid coordinates !", duration=10)
-            return -1
-
-        alternative = str(self.checkBox_alternative.isChecked()).lower()
-        steps = str(self.checkBox_instructions.isChecked()).lower()
+            return None
 
         if interm:
             try:
-                assert match('^[^a-zA-Z]+$', interm) and 150 > len(interm) > 4
+                assert match('^[^a-zA-Z]+$', interm) and len(interm) > 4
                 interm = self.transform_str_to_coords_list(interm)
-                tmp = ';'.join([f"{xi},{yi}" for xi, yi in interm])
-                url = ''.join([
-                    self.prepare_request_url(self.base_url, 'route'),
-                    f"{xo},{yo};", tmp, f";{xd},{yd}",
-                    f"?overview=full&alternatives={alternative}&steps={steps}"
-                ])
-            except AssertionError:
+            except (AssertionError, ValueError):
                 self.iface.messageBar().pushMessage(
                     "Error",
                     "Invalid intemediates coordinates",
                     duration=10
                 )
-                return -1
-        else:
-            url = ''.join([
-                self.prepare_request_url(self.base_url, 'route'),
-                "polyline(", encode_to_polyline([(yo, xo), (yd, xd)]), ")",
-                f"?overview=full&alternatives={alternative}&steps={steps}"
-            ])
+                return None
+        return [(xo, yo)] + [tuple(pt) for pt in interm or []] + [(xd, yd)]
 
-        if self.api_key:
-            url = ''.join([url, '&api_key=', self.api_key])
-        print(f"Fetch route query: {url}")
+    def start_live_route(self):
+        """
+        Activate the map tool dragging the origin, intermediate and
+        destination markers, the route being updated in place in a single
+        layer.
+        """
+        waypoints = self.read_waypoints()
+        if waypoints is None:
+            return -1
+        if self.live_tool is not None:
+            self.canvas.unsetMapTool(self.live_tool)
+        self.live_tool = OSRMLiveRouteTool(
+            self.canvas, self.prepare_request_url(self.base_url, 'route'),
+            self.api_key, waypoints)
+        self.live_tool.waypointsChanged.connect(self.store_live_waypoints)
+        self.canvas.setMapTool(self.live_tool)
+        return 0
+
+    def store_live_waypoints(self, waypoints):
+        """Store the waypoints moved with the live route tool"""
+        self.origin = QgsPointXY(*waypoints[0])
+        self.destination = QgsPointXY(*waypoints[-1])
+        self.intermediate = [
+            tuple(round(x, 6) for x in pt) for pt in waypoints[1:-1]]
+        self.lineEdit_xyO.setText(self.transform_point_to_str(self.origin))
+        self.lineEdit_xyD.setText(
+            self.transform_point_to_str(self.destination))
+        self.lineEdit_xyI.setText(
+            str(self.intermediate) if self.intermediate else '')
+
+    def get_route(self):
+        """
+        Main method to prepare the request and display the result on the
+        QGIS canvas.
+        """
+        origin = self.lineEdit_xyO.text()
+        destination = self.lineEdit_xyD.text()
+        waypoints = self.read_waypoints()
+        if waypoints is None:
+            return -1
+        (xo, yo), interm, (xd, yd) = \
+            waypoints[0], waypoints[1:-1], waypoints[-1]
+
+        alternative = str(self.checkBox_alternative.isChecked()).lower()
+        steps = str(self.checkBox_instructions.isChecked()).lower()
+        annotations = self.checkBox_annotations.isChecked()
 
         try:
-            self.parsed = self.query_url(url)
+            if len(waypoints) > ROUTE_MAX_COORDS:
+                self.parsed = {
+                    'code': 'Ok',
+                    'routes': [fetch_long_route(
+                        self.prepare_request_url(self.base_url, 'route'),
+                        self.api_key, waypoints,
+                        self.checkBox_instructions.isChecked(),
+                        annotations=annotations)]
+                }
+            else:
+                service_url = self.prepare_request_url(self.base_url, 'route')
+                url = ''.join([
+                    service_url,
+                    "polyline(",
+                    encode_to_polyline([(y, x) for x, y in waypoints]),
+                    ")",
+                    "?",
+                    profile_query('detail'),
+                    f"&alternatives={alternative}&steps={steps}",
+                    f"&annotations={ROUTE_ANNOTATIONS}" if annotations else ""
+                ])
+                url = add_hints(url, service_url, waypoints,
+                                skip_waypoints=True)
+                if self.api_key:
+                    url = ''.join([url, '&api_key=', self.api_key])
+                print(f"Fetch route query: {url}")
+                self.parsed = self.query_url(url)
+                store_hints(service_url, waypoints, self.parsed)
         except (
             AssertionError,
             Exception
@@ -384,11 +380,26 @@ class OSRMDialog(QDialog, FORM_CLASS_DIALOG_BASE, TemplateOsrm):
         put_on_top(origin_destination_layer.id(), osrm_route_layer.id())
 
         if self.checkBox_instructions.isChecked():
-            _, instruct_layer = self.prep_instruction(
-                self.nb_route,
+            instruct_layer = prep_instruction_layer(
+                f"instruction_single_osrm{self.nb_route}",
                 self.parsed["routes"],
-                self.checkBox_alternative.isChecked())
+                int(self.checkBox_alternative.isChecked()),
+                step_lines=self.checkBox_step_lines.isChecked())
             QgsProject.instance().addMapLayer(instruct_layer)
             self.iface.setActiveLayer(instruct_layer)
             put_on_top(instruct_layer.id(), origin_destination_layer.id())
+
+        if annotations:
+            routes = self.parsed["routes"]
+            if not self.checkBox_alternative.isChecked():
+                routes = routes[:1]
+            try:
+                segments_layer = prep_segments_layer(
+                    f"route_osrm{self.nb_route}_segments",
+                    list(enumerate(routes)))
+            except (KeyError, ValueError) as err:
+                self.display_error(err, 1)
+                return -1
+            QgsProject.instance().addMapLayer(segments_layer)
+            put_on_top(origin_destination_layer.id(), segments_layer.id())
         return 0
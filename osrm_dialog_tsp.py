@@ -25,19 +25,24 @@
 """
 
 import os
+from multiprocessing.pool import ThreadPool
 from urllib3.exceptions import HTTPError
+import numpy as np
 from qgis.PyQt import QtGui, uic
 from qgis.PyQt.QtGui import QFont, QColor
 from qgis.PyQt.QtWidgets import QDialog
 from qgis.core import (  # pylint: disable = no-name-in-module
     QgsMapLayerProxyModel, QgsPointXY, QgsProject, QgsVectorLayer,
     QgsSymbol, QgsFeature, QgsGeometry, QgsPalLayerSettings, Qgis,
-    QgsSingleSymbolRenderer, QgsMessageLog, QgsTextFormat,
+    QgsSingleSymbolRenderer, QgsTextFormat,
     QgsTextBufferSettings, QgsVectorLayerSimpleLabeling
 )
 from .osrm_utils import (
-    decode_geom, get_coords_ids, prepare_route_symbol, put_on_top
+    decode_geom, get_coords_ids, prepare_route_symbol, put_on_top,
+    fetch_table_dense, fetch_tour_routes, join_route_chunks, add_hints,
+    store_hints, prep_instruction_layer
 )
+from .osrm_utils_solver import solve_large_tsp, TRIP_MAX_COORDS
 from .template_osrm import TemplateOsrm
 
 
@@ -56,9 +61,13 @@ class OSRMDialogTSP(QDialog, FORM_CLASS_DIALOG_TSP, TemplateOsrm):
         self.iface = iface
         self.pushButton_display.clicked.connect(self.run_tsp)
         self.pushButton_clear.clicked.connect(self.clear_results)
+        self.checkBox_instructions.toggled.connect(
+            self.checkBox_step_lines.setEnabled)
         self.comboBox_layer.setFilters(QgsMapLayerProxyModel.PointLayer)
+        self.comboBox_group.setAllowEmptyFieldName(True)
+        self.comboBox_group.setLayer(self.comboBox_layer.currentLayer())
+        self.comboBox_layer.layerChanged.connect(self.comboBox_group.setLayer)
         self.nb_route = 0
-        self.parsed = None
         self.tsp_marker_lr = None
         self.load_providers()
 
@@ -81,117 +90,52 @@ class OSRMDialogTSP(QDialog, FORM_CLASS_DIALOG_TSP, TemplateOsrm):
             self.repaint_layers()
         self.nb_route = 0
 
-    def prep_instruction(self, nb_route, routes_json, alt=None):
-        """
-        Prepare the instruction layer, each field corresponding to an OSRM
-        viaroute response field.
-        """
-        osrm_instruction_layer = QgsVectorLayer(
-            "Point?crs=epsg:4326&field=id:integer&field=alt:integer"
-            "&field=maneuver_bearing_before:integer"
-            "&field=bearing_after:integer"
-            "&field=maneuver_type:string(254)"
-            "&field=maneuver_modifier:string(254)"
-            "&field=maneuver_exit:integer(20)"
-            "&field=street_name:string(254)"
-            "&field=length_m:real(20)&field=route_idx:integer(20)"
-            "&field=time_min:real(20)",
-            f"instruction_tsp_osrm{nb_route}",
-            "memory")
-        provider = osrm_instruction_layer.dataProvider()
-
-        nbi = 0
-        features = []
-        for route_idx, route in enumerate(routes_json):
-            for leg in route["legs"]:
-                for step in leg["steps"]:
-                    if "maneuver" not in step:
-                        continue
-                    if "location" not in step["maneuver"]:
-                        continue
-
-                    maneuver = step["maneuver"]
-                    coords = maneuver["location"]
-                    fet = QgsFeature()
-                    pt = QgsPointXY(coords[0], coords[1])
-                    fet.setGeometry(QgsGeometry.fromPointXY(pt))
-                    fet.setAttributes(
-                        [
-                            nbi,
-                            alt if alt is not None else 0,
-                            maneuver["bearing_before"]
-                            if "bearing_before" in maneuver else None,
-                            maneuver["bearing_after"]
-                            if "bearing_after" in maneuver else None,
-                            step["maneuver"]["type"]
-                            if "type" in maneuver else None,
-                            step["maneuver"]["modifier"]
-                            if "modifier" in maneuver else None,
-                            step["maneuver"]["exit"]
-                            if "exit" in maneuver else None,
-                            step["name"],
-                            step["distance"],
-                            route_idx,
-                            step["duration"] / 60
-                        ]
-                    )
-                    features.append(fet)
-                    nbi += 1
-            if (alt is None) and (route_idx > 0):
-                break
-        provider.addFeatures(features)
-
-        symbol = QgsSymbol.defaultSymbol(osrm_instruction_layer.geometryType())
-        symbol.setSize(2)
-        symbol.setColor(QtGui.QColor("#d9ef8b"))
-        osrm_instruction_layer.setRenderer(QgsSingleSymbolRenderer(symbol))
-
-        return provider, osrm_instruction_layer
-
     def run_tsp(self):
         """
         Main method, preparing the query and displaying the result on
-        the canvas.
+        the canvas (one tour per value of the group field, the tours of
+        the groups being requested concurrently).
         """
         layer = self.comboBox_layer.currentLayer()
-        coords, _ = get_coords_ids(
-            layer, '', on_selected=self.checkBox_selec_features.isChecked())
+        group_field = self.comboBox_group.currentField()
+        coords, groups = get_coords_ids(
+            layer, group_field,
+            on_selected=self.checkBox_selec_features.isChecked())
 
         if len(coords) < 2:
             self.print_no_features()
             return -1
 
-        steps = str(self.checkBox_instructions.isChecked()).lower()
+        members = {}
+        for i, group in enumerate(groups):
+            members.setdefault(group if group_field else None, []).append(i)
+        skipped = [self.group_value(group)
+                   for group, indices in members.items() if len(indices) < 2]
+        members = [(group, indices) for group, indices in members.items()
+                   if len(indices) > 1]
+        if not members:
+            self.print_no_features()
+            return -1
 
-        query = ''.join(
-            [
-                self.prepare_request_url(self.base_url, 'trip'),
-                ";".join([f"{c[0]},{c[1]}" for c in coords]),
-                "?",
-                "steps=",
-                steps
-            ]
-        )
-        if self.api_key:
-            query = ''.join([query, '&api_key=', self.api_key])
-        print(f"Fetch traveling salesman query: {query}")
+        steps = self.checkBox_instructions.isChecked()
+        large = self.checkBox_large.isChecked()
 
-        try:
-            self.parsed = self.query_url(query)
-        except (HTTPError) as err:
-            self.iface.messageBar().pushMessage(
-                "Error", "An error occured when trying to contact the OSRM "
-                "instance (see QGis log for error traceback)",
-                duration=10)
-            QgsMessageLog.logMessage(
-                f"OSRM-plugin error report :\n {err}",
-                level=Qgis.Warning)
-            return -1
+        def solve_group(item):
+            group, indices = item
+            group_coords = [coords[i] for i in indices]
+            if large or len(group_coords) > TRIP_MAX_COORDS:
+                parsed, line_geoms = self.solve_large_trip(
+                    group_coords, steps)
+            else:
+                parsed, line_geoms = self.fetch_trip(group_coords, steps)
+            return group, indices, parsed, line_geoms
 
         try:
-            line_geoms = \
-                [decode_geom(self.parsed['trips'][i]['geometry'])
-                 for i in range(len(self.parsed['trips']))]
+            with ThreadPool(processes=min(4, len(members))) as pool:
+                results = pool.map(solve_group, members)
+        except (ValueError, HTTPError, AssertionError) as err:
+            self.display_error(err, 1)
+            return -1
         except KeyError:
             self.iface.messageBar().pushMessage(
                 "Error",
@@ -201,19 +145,25 @@ class OSRMDialogTSP(QDialog, FORM_CLASS_DIALOG_TSP, TemplateOsrm):
 
         tsp_route_layer = QgsVectorLayer(
             "Linestring?crs=epsg:4326&field=id:integer"
-            "&field=total_time_min:integer(20)&field=distance_m:integer(20)",
+            "&field=total_time_min:integer(20)&field=distance_m:integer(20)"
+            "&field=group:string(254)",
             f"tsp_solution_osrm{self.nb_route}", "memory")
         my_symb = prepare_route_symbol(self.nb_route)
         tsp_route_layer.setRenderer(QgsSingleSymbolRenderer(my_symb))
         features = []
-        for trip_idx, feature in enumerate(self.parsed['trips']):
-            ft = QgsFeature()
-            ft.setGeometry(line_geoms[trip_idx])
-            ft.setAttributes([trip_idx,
-                              feature['duration'] / 60,
-                              feature['distance']])
-            features.append(ft)
-            self.prepare_ordered_marker(coords)
+        trips, trip_groups = [], []
+        for group, _, parsed, line_geoms in results:
+            for trip_idx, feature in enumerate(parsed['trips']):
+                ft = QgsFeature()
+                ft.setGeometry(line_geoms[trip_idx])
+                ft.setAttributes([len(features),
+                                  feature['duration'] / 60,
+                                  feature['distance'],
+                                  self.group_value(group)])
+                features.append(ft)
+                trips.append(feature)
+                trip_groups.append(self.group_value(group))
+        self.prepare_ordered_marker(coords, results)
         tsp_route_layer.dataProvider().addFeatures(features)
         tsp_route_layer.updateExtents()
         QgsProject.instance().addMapLayer(tsp_route_layer)
@@ -222,43 +172,122 @@ class OSRMDialogTSP(QDialog, FORM_CLASS_DIALOG_TSP, TemplateOsrm):
         put_on_top(self.tsp_marker_lr.id(), tsp_route_layer.id())
 
         if self.checkBox_instructions.isChecked():
-            _, instruct_layer = self.prep_instruction(
-                self.nb_route,
-                self.parsed["trips"],
-                False)
+            instruct_layer = prep_instruction_layer(
+                f"instruction_tsp_osrm{self.nb_route}",
+                trips,
+                groups=trip_groups,
+                step_lines=self.checkBox_step_lines.isChecked())
             QgsProject.instance().addMapLayer(instruct_layer)
             self.iface.setActiveLayer(instruct_layer)
             put_on_top(instruct_layer.id(), self.tsp_marker_lr.id())
 
+        if skipped:
+            self.iface.messageBar().pushMessage(
+                "Warning",
+                f"{len(skipped)} group(s) with a single point left out: "
+                f"{', '.join(skipped[:10])}"
+                f"{', ...' if len(skipped) > 10 else ''}",
+                level=Qgis.Warning,
+                duration=10)
         self.nb_route += 1
 
         return 0
 
-    def prepare_ordered_marker(self, coords):
+    @staticmethod
+    def group_value(group):
+        """Value of the group attribute of the output layers"""
+        return None if group is None else str(group)
+
+    def solve_large_trip(self, coords, steps):
+        """
+        Solve the tour locally (see solve_large_tsp) from duration matrices
+        fetched in table blocks, then fetch its route in chunks.
+
+        Return
+        ------
+        parsed : trip response like object holding the tour as a single trip
+        line_geoms : list holding the geometry of the trip
+        """
+        table_url = self.prepare_request_url(self.base_url, 'table')
+        tour = solve_large_tsp(
+            coords,
+            lambda stops: fetch_table_dense(
+                table_url, self.api_key,
+                [coords[i] for i in stops], [coords[i] for i in stops],
+                ['Durations'])[0]
+        )
+        routes = fetch_tour_routes(
+            self.prepare_request_url(self.base_url, 'route'),
+            self.api_key, coords, tour, steps)
+
+        ranks = np.empty(len(tour), dtype=int)
+        ranks[tour] = np.arange(len(tour))
+        parsed = {
+            'trips': [{
+                'duration': sum(route['duration'] for route in routes),
+                'distance': sum(route['distance'] for route in routes),
+                'legs': [leg for route in routes for leg in route['legs']]
+            }],
+            'waypoints': [{'waypoint_index': int(rank)} for rank in ranks]
+        }
+        return parsed, [join_route_chunks(routes)]
+
+    def fetch_trip(self, coords, steps):
+        """
+        Fetch the trip through every point in a single request to the OSRM
+        trip service.
+
+        Return
+        ------
+        parsed : trip response
+        line_geoms : list of the geometries of the trips
+        """
+        service_url = self.prepare_request_url(self.base_url, 'trip')
+        query = ''.join(
+            [
+                service_url,
+                ";".join([f"{c[0]},{c[1]}" for c in coords]),
+                "?",
+                "steps=",
+                str(steps).lower()
+            ]
+        )
+        query = add_hints(query, service_url, coords)
+        if self.api_key:
+            query = ''.join([query, '&api_key=', self.api_key])
+        print(f"Fetch traveling salesman query: {query}")
+
+        parsed = self.query_url(query)
+        store_hints(service_url, coords, parsed)
+        return parsed, [decode_geom(trip['geometry'])
+                        for trip in parsed['trips']]
+
+    def prepare_ordered_marker(self, coords, results):
         """
         Try to display nice marker on a point layer, showing the order of
-        the path computed by OSRM.
+        the path computed by OSRM (within the tour of each group), the id of
+        the markers running across the groups.
         """
         self.tsp_marker_lr = QgsVectorLayer(
             "Point?crs=epsg:4326&field=id:integer"
-            "&field=TSP_nb:integer(20)&field=Origin_nb:integer(20)",
+            "&field=TSP_nb:integer(20)&field=Origin_nb:integer(20)"
+            "&field=group:string(254)",
             f"tsp_markers_osrm{self.nb_route}", "memory")
         symbol = QgsSymbol.defaultSymbol(self.tsp_marker_lr.geometryType())
         symbol.setSize(4.5)
         symbol.setColor(QtGui.QColor("yellow"))
 
         features = []
-        waypoint_nb = len(self.parsed['waypoints'])
-
-        for i in range(0, waypoint_nb):
-            waypoint = self.parsed['waypoints'][i]
-            trip_idx = waypoint['waypoint_index']
-            pt = coords[i]
+        for group, indices, parsed, _ in results:
+            for i, waypoint in zip(indices, parsed['waypoints']):
+                trip_idx = waypoint['waypoint_index']
+                pt = coords[i]
 
-            ft = QgsFeature()
-            ft.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(pt)))
-            ft.setAttributes([trip_idx, trip_idx + 1, i])
-            features.append(ft)
+                ft = QgsFeature()
+                ft.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(*pt)))
+                ft.setAttributes([len(features), trip_idx + 1, i,
+                                  self.group_value(group)])
+                features.append(ft)
 
         self.tsp_marker_lr.dataProvider().addFeatures(features)
 
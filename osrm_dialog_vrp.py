@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ OSRMDialogVRP
+                                 A QGIS plugin
+ Capacitated vehicle routing problem
+                             -------------------
+        begin                : 2025-07-15
+        copyright            : (C) 2025 by strues-maps
+        email                : info@strues-maps.lt
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from urllib3.exceptions import HTTPError
+import numpy as np
+from qgis.PyQt import QtGui, uic
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.PyQt.QtWidgets import QDialog
+from qgis.core import (  # pylint: disable = no-name-in-module
+    QgsMapLayerProxyModel, QgsFieldProxyModel, QgsPointXY, QgsProject,
+    QgsVectorLayer, QgsSymbol, QgsFeature, QgsGeometry,
+    QgsSingleSymbolRenderer, QgsCategorizedSymbolRenderer,
+    QgsRendererCategory, QgsLimitedRandomColorRamp
+)
+from .osrm_utils import (
+    get_coords_ids, put_on_top, fetch_table_dense, fetch_tour_routes,
+    join_route_chunks
+)
+from .osrm_utils_solver import solve_vrp
+from .template_osrm import TemplateOsrm
+
+
+FORM_CLASS_DIALOG_VRP, _ = uic.loadUiType(os.path.join(
+    os.path.dirname(__file__), 'ui/osrm_dialog_vrp.ui'))
+
+
+class OSRMDialogVRP(QDialog, FORM_CLASS_DIALOG_VRP, TemplateOsrm):
+    """Dialog for capacitated vehicle routing problem"""
+
+    def __init__(self, iface, parent=None):
+        """ Constructor"""
+        super().__init__(parent)
+        TemplateOsrm.__init__(self)
+        self.setupUi(self)
+        self.iface = iface
+        self.pushButton_display.clicked.connect(self.run_vrp)
+        self.pushButton_clear.clicked.connect(self.clear_results)
+        self.pushButton_cancel.clicked.connect(self.cancel_solver)
+        self.comboBox_layer.setFilters(QgsMapLayerProxyModel.PointLayer)
+        self.comboBox_depot.setFilters(QgsMapLayerProxyModel.PointLayer)
+        self.comboBox_demand.setFilters(QgsFieldProxyModel.Numeric)
+        self.comboBox_demand.setAllowEmptyFieldName(True)
+        self.comboBox_demand.setLayer(self.comboBox_layer.currentLayer())
+        self.comboBox_layer.layerChanged.connect(
+            self.comboBox_demand.setLayer
+        )
+        self.comboBox_capacity.setFilters(QgsFieldProxyModel.Numeric)
+        self.comboBox_capacity.setAllowEmptyFieldName(True)
+        self.comboBox_capacity.setLayer(self.comboBox_depot.currentLayer())
+        self.comboBox_depot.layerChanged.connect(
+            self.comboBox_capacity.setLayer
+        )
+        self.comboBox_capacity.fieldChanged.connect(
+            lambda field: self.spinBox_capacity.setEnabled(not field)
+        )
+        self.nb_route = 0
+        self.stop_solver = threading.Event()
+        self.load_providers()
+
+    def cancel_solver(self):
+        """
+        Handle cancel button action: stop the local search, keeping the
+        routes found so far
+        """
+        self.stop_solver.set()
+
+    def solve_routes(self, matrix, demands, capacity, max_duration):
+        """
+        Run solve_vrp in a worker thread, the progress bar following the
+        time budget and the events being processed meanwhile so that QGIS
+        stays responsive and the search can be cancelled
+        """
+        time_budget = self.spinBox_time_budget.value()
+        self.stop_solver.clear()
+        self.pushButton_display.setEnabled(False)
+        self.pushButton_cancel.setEnabled(True)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(
+                solve_vrp, matrix, demands, capacity, max_duration,
+                time_budget, self.stop_solver)
+            try:
+                while not future.done():
+                    elapsed = min((time.monotonic() - start) / time_budget, 1)
+                    self.progress.setValue(40 + int(30 * elapsed))
+                    QCoreApplication.processEvents()
+                    wait_futures([future], timeout=0.05)
+            finally:
+                self.stop_solver.set()
+                self.pushButton_cancel.setEnabled(False)
+                self.pushButton_display.setEnabled(True)
+        return future.result()
+
+    def clear_results(self):
+        """
+        Clear previous result and set back counter to 0.
+        """
+        needs_repaint = False
+        for layer in QgsProject.instance().mapLayers():
+            if 'vrp_solution_osrm' in layer or 'vrp_stops_osrm' in layer:
+                QgsProject.instance().removeMapLayer(layer)
+                needs_repaint = True
+        if needs_repaint:
+            self.repaint_layers()
+        self.nb_route = 0
+
+    def run_vrp(self):
+        """
+        Main method: fetch the duration matrix between the depot and the
+        stops, solve the vehicle routes locally and display one route per
+        vehicle on the canvas.
+        """
+        layer = self.comboBox_layer.currentLayer()
+        depot_layer = self.comboBox_depot.currentLayer()
+        demand_field = self.comboBox_demand.currentField()
+        capacity_field = self.comboBox_capacity.currentField()
+        if layer is None or depot_layer is None:
+            self.print_no_features()
+            return -1
+
+        coords, demands, fids = get_coords_ids(
+            layer, demand_field,
+            on_selected=self.checkBox_selec_features.isChecked(),
+            with_fids=True)
+        # The first (selected) feature of the depot layer is the depot,
+        # the capacity of the vehicles may be one of its fields
+        depot_coords, depot_capacities = get_coords_ids(
+            depot_layer, capacity_field,
+            on_selected=depot_layer.selectedFeatureCount() > 0)
+
+        if len(coords) < 1 or len(depot_coords) < 1:
+            self.print_no_features()
+            return -1
+
+        if demand_field:
+            demands = np.array(
+                [float(demand) if demand else 0.0 for demand in demands])
+        else:
+            demands = np.ones(len(coords))
+        capacity = self.spinBox_capacity.value()
+        if capacity_field:
+            try:
+                capacity = float(depot_capacities[0])
+            except (TypeError, ValueError):
+                self.iface.messageBar().pushMessage(
+                    "Error",
+                    f"The depot has no capacity in the field {capacity_field}",
+                    duration=10)
+                return -1
+        if demands.max() > capacity:
+            self.iface.messageBar().pushMessage(
+                "Error",
+                "The demand of some stops exceeds the vehicle capacity",
+                duration=10)
+            return -1
+        max_duration = self.spinBox_max_duration.value() * 60 or None
+
+        self.make_prog_bar()
+        locations = [depot_coords[0]] + list(coords)
+        try:
+            matrix = fetch_table_dense(
+                self.prepare_request_url(self.base_url, 'table'),
+                self.api_key, locations, locations, ['Durations'])[0]
+            self.progress.setValue(40)
+            routes = self.solve_routes(
+                matrix, demands, capacity, max_duration)
+            self.progress.setValue(70)
+            route_url = self.prepare_request_url(self.base_url, 'route')
+            chunks = [
+                fetch_tour_routes(route_url, self.api_key, locations,
+                                  np.concatenate(([0], route + 1)))
+                for route in routes
+            ]
+        except (ValueError, HTTPError, AssertionError) as err:
+            self.iface.messageBar().clearWidgets()
+            self.display_error(err, 1)
+            return -1
+        except KeyError:
+            self.iface.messageBar().clearWidgets()
+            self.iface.messageBar().pushMessage(
+                "Error",
+                "?...",
+                duration=5)
+            return -1
+
+        routes_layer = self.prep_routes_layer(routes, chunks, demands)
+        stops_layer = self.prep_stops_layer(routes, coords, fids, demands)
+        self.iface.messageBar().clearWidgets()
+        QgsProject.instance().addMapLayer(routes_layer)
+        QgsProject.instance().addMapLayer(stops_layer)
+        self.iface.setActiveLayer(routes_layer)
+        self.iface.zoomToActiveLayer()
+        put_on_top(stops_layer.id(), routes_layer.id())
+        self.iface.messageBar().pushMessage(
+            "Info", f"{len(routes)} vehicle routes for {len(coords)} stops",
+            duration=10)
+
+        self.nb_route += 1
+        return 0
+
+    def prep_routes_layer(self, routes, chunks, demands):
+        """
+        Prepare the layer of the vehicle routes, the route of each vehicle
+        being merged from its chunks.
+        """
+        routes_layer = QgsVectorLayer(
+            "Linestring?crs=epsg:4326&field=vehicle:integer"
+            "&field=nb_stops:integer(20)&field=load:double"
+            "&field=total_time_min:double&field=distance_m:double",
+            f"vrp_solution_osrm{self.nb_route}", "memory")
+
+        features = []
+        categories = []
+        colors = QgsLimitedRandomColorRamp.randomColors(max(len(routes), 1))
+        for vehicle, (route, route_chunks) in enumerate(zip(routes, chunks)):
+            ft = QgsFeature()
+            ft.setGeometry(join_route_chunks(route_chunks))
+            ft.setAttributes([
+                vehicle,
+                len(route),
+                float(demands[route].sum()),
+                sum(chunk['duration'] for chunk in route_chunks) / 60,
+                sum(chunk['distance'] for chunk in route_chunks)
+            ])
+            features.append(ft)
+
+            symbol = QgsSymbol.defaultSymbol(routes_layer.geometryType())
+            symbol.setWidth(0.8)
+            symbol.setColor(colors[vehicle])
+            categories.append(
+                QgsRendererCategory(vehicle, symbol, str(vehicle)))
+        routes_layer.dataProvider().addFeatures(features)
+        routes_layer.setRenderer(
+            QgsCategorizedSymbolRenderer('vehicle', categories))
+        routes_layer.updateExtents()
+        return routes_layer
+
+    def prep_stops_layer(self, routes, coords, fids, demands):
+        """
+        Prepare the layer of the stops (with the feature id of the stop
+        layer), their vehicle and their rank in the route of the vehicle.
+        """
+        stops_layer = QgsVectorLayer(
+            "Point?crs=epsg:4326&field=id:integer"
+            "&field=vehicle:integer(20)&field=rank:integer(20)"
+            "&field=demand:double",
+            f"vrp_stops_osrm{self.nb_route}", "memory")
+
+        features = []
+        for vehicle, route in enumerate(routes):
+            for rank, stop in enumerate(route):
+                ft = QgsFeature()
+                ft.setGeometry(QgsGeometry.fromPointXY(
+                    QgsPointXY(*coords[stop])))
+                ft.setAttributes(
+                    [fids[stop], vehicle, rank + 1, float(demands[stop])])
+                features.append(ft)
+        stops_layer.dataProvider().addFeatures(features)
+
+        symbol = QgsSymbol.defaultSymbol(stops_layer.geometryType())
+        symbol.setSize(2.5)
+        symbol.setColor(QtGui.QColor("yellow"))
+        stops_layer.setRenderer(QgsSingleSymbolRenderer(symbol))
+        return stops_layer
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ OSRMLiveRouteTool
+                                 A QGIS plugin
+ Map tool dragging the markers of a route, the route being updated live
+                             -------------------
+        begin                : 2025-07-15
+        copyright            : (C) 2025 by strues-maps
+        email                : info@strues-maps.lt
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+import json
+from qgis.PyQt.QtCore import QTimer, QUrl, pyqtSignal
+from qgis.PyQt.QtGui import QColor
+from qgis.PyQt.QtNetwork import QNetworkRequest
+from qgis.gui import (  # pylint: disable = no-name-in-module
+    QgsMapTool, QgsVertexMarker
+)
+from qgis.core import (  # pylint: disable = no-name-in-module
+    QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsProject,
+    QgsVectorLayer, QgsFeature, QgsPointXY, QgsSingleSymbolRenderer,
+    QgsNetworkAccessManager, QgsMessageLog, Qgis
+)
+from .osrm_polyfill import Qt_MouseButton_LeftButton
+from .osrm_polyfill import QNetworkReply_NetworkError_NoError
+from .osrm_polyfill import QNetworkReply_NetworkError_OperationCanceledError
+from .osrm_polyfill import QgsVertexMarker_IconType_Circle
+from .osrm_utils import (
+    encode_to_polyline, decode_geom, prepare_route_symbol, add_hints,
+    store_hints, profile_query
+)
+
+# Delay (in milliseconds) without marker move before a route is requested
+LIVE_ROUTE_DEBOUNCE_MS = 40
+
+# Distance (in pixels) under which a press on the map grabs a marker
+LIVE_ROUTE_GRAB_PIXELS = 12
+
+# Largest map scale denominator at which the full geometry is requested
+# (the simplified geometry is precise enough when zoomed out further)
+LIVE_ROUTE_FULL_OVERVIEW_SCALE = 100000
+
+# Name of the layer holding the live route
+LIVE_ROUTE_LAYER = 'route_osrm_live'
+
+
+class OSRMLiveRouteTool(QgsMapTool):
+    """
+    Map tool dragging the origin, via and destination markers of a route:
+    the route is requested again once the markers stop moving for a few
+    milliseconds, the requests made stale by further moves are aborted,
+    and the route of a single layer is updated in place.
+    """
+    # Emitted with the lon/lat waypoints when a marker is dropped
+    waypointsChanged = pyqtSignal(list)  # pylint: disable=invalid-name
+
+    def __init__(self, canvas, url, api_key, waypoints):
+        """
+        Params:
+
+        url: str
+            The start of the url of the route service
+        waypoints: list
+            lon/lat coordinates of the origin, the via points and the
+            destination
+        """
+        super().__init__(canvas)
+        self.canvas = canvas
+        self.url = url
+        self.api_key = api_key
+        self.waypoints = [tuple(pt) for pt in waypoints]
+        self.markers = []
+        self.dragged = None
+        self.reply = None
+        self.layer_id = None
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(LIVE_ROUTE_DEBOUNCE_MS)
+        self.timer.timeout.connect(self.request_route)
+
+    def to_map(self, reverse=False):
+        """Transform from EPSG:4326 to the CRS of the canvas (or back)"""
+        crs = [QgsCoordinateReferenceSystem.fromEpsgId(4326),
+               self.canvas.mapSettings().destinationCrs()]
+        if reverse:
+            crs.reverse()
+        return QgsCoordinateTransform(crs[0], crs[1], QgsProject.instance())
+
+    def activate(self):
+        """Show the markers and request the route"""
+        super().activate()
+        xform = self.to_map()
+        last = len(self.waypoints) - 1
+        for i, waypoint in enumerate(self.waypoints):
+            marker = QgsVertexMarker(self.canvas)
+            marker.setIconType(QgsVertexMarker_IconType_Circle())
+            marker.setIconSize(12)
+            marker.setPenWidth(3)
+            marker.setColor(QColor(
+                '#50b56d' if i == 0 else '#d31115' if i == last else 'grey'))
+            marker.setCenter(xform.transform(QgsPointXY(*waypoint)))
+            self.markers.append(marker)
+        self.request_route()
+
+    def deactivate(self):
+        """Remove the markers and abort the pending request"""
+        self.timer.stop()
+        self.abort_request()
+        for marker in self.markers:
+            self.canvas.scene().removeItem(marker)
+        self.markers = []
+        self.dragged = None
+        super().deactivate()
+
+    def canvasPressEvent(self, event):  # pylint: disable=invalid-name
+        """Grab the marker closest to the press, if close enough"""
+        if event.button() != Qt_MouseButton_LeftButton():
+            return
+        best = LIVE_ROUTE_GRAB_PIXELS
+        for i, marker in enumerate(self.markers):
+            pos = self.toCanvasCoordinates(marker.center())
+            dist = (pos - event.pos()).manhattanLength()
+            if dist <= best:
+                best, self.dragged = dist, i
+
+    def canvasMoveEvent(self, event):  # pylint: disable=invalid-name
+        """Move the grabbed marker, the route being requested once idle"""
+        if self.dragged is None:
+            return
+        point = event.mapPoint()
+        self.markers[self.dragged].setCenter(point)
+        point = self.to_map(reverse=True).transform(point)
+        self.waypoints[self.dragged] = (point.x(), point.y())
+        self.timer.start()
+
+    def canvasReleaseEvent(self, event):  # pylint: disable=invalid-name
+        """Drop the grabbed marker and request the route at once"""
+        if self.dragged is None:
+            return
+        self.canvasMoveEvent(event)
+        self.dragged = None
+        self.timer.stop()
+        self.request_route()
+        self.waypointsChanged.emit(list(self.waypoints))
+
+    def profile(self):
+        """Request profile of the geometry fitting the scale of the canvas"""
+        if self.canvas.scale() <= LIVE_ROUTE_FULL_OVERVIEW_SCALE:
+            return 'detail'
+        return 'display'
+
+    def abort_request(self):
+        """Abort the pending request, if any"""
+        reply, self.reply = self.reply, None
+        if reply is not None:
+            reply.abort()
+
+    def request_route(self):
+        """
+        Request the route through the waypoints, aborting the previous
+        request if it is still pending
+        """
+        self.abort_request()
+        url = ''.join([
+            self.url,
+            "polyline(",
+            encode_to_polyline([(y, x) for x, y in self.waypoints]),
+            ")",
+            "?",
+            profile_query(self.profile()),
+            "&steps=false&alternatives=false"
+        ])
+        url = add_hints(url, self.url, self.waypoints, skip_waypoints=True)
+        if self.api_key:
+            url = ''.join([url, '&api_key=', self.api_key])
+
+        waypoints = list(self.waypoints)
+        reply = QgsNetworkAccessManager.instance().get(
+            QNetworkRequest(QUrl(url)))
+        reply.finished.connect(
+            lambda: self.route_received(reply, waypoints))
+        self.reply = reply
+
+    def route_received(self, reply, waypoints):
+        """
+        Display the route of the latest request and store the hints of its
+        waypoints
+        """
+        reply.deleteLater()
+        if reply is not self.reply:
+            return
+        self.reply = None
+        if reply.error() != QNetworkReply_NetworkError_NoError():
+            if reply.error() != \
+                    QNetworkReply_NetworkError_OperationCanceledError():
+                QgsMessageLog.logMessage(
+                    f"OSRM-plugin error report :\n {reply.errorString()}",
+                    level=Qgis.Warning)
+            return
+        try:
+            parsed = json.loads(bytes(reply.readAll()), strict=False)
+            route = parsed['routes'][0]
+        except (ValueError, KeyError, IndexError) as err:
+            QgsMessageLog.logMessage(
+                f"OSRM-plugin error report :\n {err}",
+                level=Qgis.Warning)
+            return
+        store_hints(self.url, waypoints, parsed)
+        self.update_layer(route)
+
+    def update_layer(self, route):
+        """
+        Update the single feature of the live route layer in place (the
+        layer, found by its name when the tool was activated again, or its
+        feature being created if they do not exist anymore)
+        """
+        geom = decode_geom(route['geometry'])
+        attributes = [0, route['duration'] / 60, route['distance']]
+        layer = None
+        if self.layer_id is not None:
+            layer = QgsProject.instance().mapLayer(self.layer_id)
+        if layer is None:
+            layer = next(
+                iter(QgsProject.instance().mapLayersByName(LIVE_ROUTE_LAYER)),
+                None)
+
+        if layer is None:
+            layer = QgsVectorLayer(
+                "Linestring?crs=epsg:4326&field=id:integer"
+                "&field=total_time_min:integer(20)"
+                "&field=distance_m:integer(20)",
+                LIVE_ROUTE_LAYER, "memory")
+            layer.setRenderer(
+                QgsSingleSymbolRenderer(prepare_route_symbol(0)))
+            QgsProject.instance().addMapLayer(layer)
+        self.layer_id = layer.id()
+
+        provider = layer.dataProvider()
+        feature = next(layer.getFeatures(), None)
+        if feature is None:
+            fet = QgsFeature()
+            fet.setGeometry(geom)
+            fet.setAttributes(attributes)
+            provider.addFeatures([fet])
+        else:
+            fid = feature.id()
+            provider.changeGeometryValues({fid: geom})
+            provider.changeAttributeValues(
+                {fid: dict(enumerate(attributes))})
+        layer.updateExtents()
+        layer.triggerRepaint()
@@ -29,12 +29,18 @@ from qgis.utils import iface
 from qgis.PyQt.QtCore import QTranslator, QCoreApplication, QSettings
 from qgis.PyQt.QtWidgets import QAction
 from qgis.PyQt.QtGui import QIcon
+from qgis.core import (  # pylint: disable = no-name-in-module
+    QgsMessageLog, Qgis
+)
 from .osrm_dialog import OSRMDialog
 from .osrm_table_dialog import OSRMTableDialog
 from .osrm_access_dialog import OSRMAccessDialog
 from .osrm_dialog_tsp import OSRMDialogTSP
+from .osrm_dialog_vrp import OSRMDialogVRP
 from .osrm_batch_route_dialog import OSRMBatchRouteDialog
 from .osrm_provider_dialog import OSRMProviderDialog
+from .osrm_utils_isochrone import shutdown_process_pool
+from .osrm_utils_matrix import remove_leftover_stores
 
 
 class OsrmPlugin:
@@ -173,6 +179,14 @@ class OsrmPlugin:
             add_to_toolbar=False,
         )
 
+        self.add_action(
+            None,
+            text=self.tr('Solve a vehicle routing problem with OSRM'),
+            callback=self.run_vrp,
+            parent=self.qgis_iface.mainWindow(),
+            add_to_toolbar=False,
+        )
+
         self.add_action(
             None,
             text=self.tr('Export many routes from OSRM'),
@@ -190,6 +204,13 @@ class OsrmPlugin:
             self.qgis_iface.removeToolBarIcon(action)
         # remove the toolbar
         del self.toolbar
+        # stop the isochrone worker processes
+        shutdown_process_pool()
+        # remove the matrix files which were still mapped when closed
+        for path in remove_leftover_stores():
+            QgsMessageLog.logMessage(
+                f"OSRM-plugin: temporary matrix file not removed: {path}",
+                level=Qgis.Warning)
 
     def run_route(self):
         """Run the window to compute a single viaroute"""
@@ -231,6 +252,12 @@ class OsrmPlugin:
         self.dlg.pushButton_about.clicked.connect(self.dlg.print_about)
         self.dlg.show()
 
+    def run_vrp(self):
+        """Run the window for solving a vehicle routing problem"""
+        self.dlg = OSRMDialogVRP(iface)
+        self.dlg.pushButton_about.clicked.connect(self.dlg.print_about)
+        self.dlg.show()
+
     def run_accessibility(self):
         """Run the window for making accessibility isochrones"""
         self.dlg = OSRMAccessDialog(iface)
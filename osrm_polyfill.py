@@ -80,6 +80,16 @@ def Qgis_GeometryType_Point():  # pylint: disable=invalid-name
     return Qgis.GeometryType.Point
 
 
+def Qgis_WkbType_MultiPolygon():  # pylint: disable=invalid-name
+    """Polyfill for Qgis.WkbType.MultiPolygon"""
+    if qgis_version_less_than('3.30'):
+        from qgis.core import QgsWkbTypes  # pylint: disable=no-name-in-module
+        return QgsWkbTypes.MultiPolygon
+
+    from qgis.core import Qgis  # pylint: disable=no-name-in-module
+    return Qgis.WkbType.MultiPolygon
+
+
 def Qgis_QMessageBox_Icon_Information():  # pylint: disable=invalid-name
     """Polyfill for QMessageBox.Icon.Information"""
     # pylint: disable=line-too-long
@@ -161,6 +171,72 @@ def Qt_AlignmentFlag_AlignVCenter():  # pylint: disable=invalid-name
     return Qt.AlignmentFlag.AlignVCenter
 
 
+def Qt_MouseButton_LeftButton():  # pylint: disable=invalid-name
+    """Polyfill for Qt.MouseButton.LeftButton"""
+    from qgis.PyQt.QtCore import Qt  # pylint: disable=no-name-in-module
+
+    if pyqt_version_less_than('6.0'):
+        return Qt.LeftButton
+
+    return Qt.MouseButton.LeftButton
+
+
+def QNetworkReply_NetworkError_NoError():  # pylint: disable=invalid-name
+    """Polyfill for QNetworkReply.NetworkError.NoError"""
+    from qgis.PyQt.QtNetwork import QNetworkReply
+
+    if pyqt_version_less_than('6.0'):
+        return QNetworkReply.NoError
+
+    return QNetworkReply.NetworkError.NoError
+
+
+def QNetworkReply_NetworkError_OperationCanceledError():  # pylint: disable=invalid-name,line-too-long # noqa
+    """Polyfill for QNetworkReply.NetworkError.OperationCanceledError"""
+    from qgis.PyQt.QtNetwork import QNetworkReply
+
+    if pyqt_version_less_than('6.0'):
+        return QNetworkReply.OperationCanceledError
+
+    return QNetworkReply.NetworkError.OperationCanceledError
+
+
+def QgsVertexMarker_IconType_Circle():  # pylint: disable=invalid-name
+    """Polyfill for QgsVertexMarker.IconType.ICON_CIRCLE"""
+    from qgis.gui import QgsVertexMarker  # pylint: disable=no-name-in-module
+
+    if pyqt_version_less_than('6.0'):
+        return QgsVertexMarker.ICON_CIRCLE
+
+    return QgsVertexMarker.IconType.ICON_CIRCLE
+
+
+def QgsVectorFileWriter_WriterError_NoError():  # pylint: disable=invalid-name
+    """Polyfill for QgsVectorFileWriter.WriterError.NoError"""
+    from qgis.core import (  # pylint: disable=no-name-in-module
+        QgsVectorFileWriter
+    )
+
+    if pyqt_version_less_than('6.0'):
+        return QgsVectorFileWriter.NoError
+
+    return QgsVectorFileWriter.WriterError.NoError
+
+
+def QgsVectorFileWriter_ActionOnExistingFile_CreateOrOverwriteFile():  # pylint: disable=invalid-name,line-too-long # noqa
+    """
+    Polyfill for QgsVectorFileWriter.ActionOnExistingFile.CreateOrOverwriteFile
+    """
+    from qgis.core import (  # pylint: disable=no-name-in-module
+        QgsVectorFileWriter
+    )
+
+    if pyqt_version_less_than('6.0'):
+        return QgsVectorFileWriter.CreateOrOverwriteFile
+
+    return QgsVectorFileWriter.ActionOnExistingFile.CreateOrOverwriteFile
+
+
 def qgsgeom_from_mpl_contour(contour_set):
     """Convert MatPlotLib polygons to QgsGeometry polygons"""
     if matplotlib_version_less_than('3.9'):
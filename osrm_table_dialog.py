@@ -34,7 +34,13 @@ from qgis.PyQt.QtWidgets import QMessageBox, QDialog
 from qgis.core import (  # pylint: disable = no-name-in-module
     QgsMapLayerProxyModel, QgsFieldProxyModel, QgsMessageLog, Qgis
 )
-from .osrm_utils import get_coords_ids, save_dialog, fetch_table
+from .osrm_utils import (
+    get_coords_ids, save_dialog, closest_destinations,
+    k_nearest_destinations, iter_table_blocks, fetch_table_dense
+)
+from .osrm_utils_matrix import (
+    MatrixStore, MatrixSession, write_matrix_csv, save_matrices_npz
+)
 from .template_osrm import TemplateOsrm
 
 
@@ -43,6 +49,7 @@ FORM_CLASS_TABLE_DIALOG_BASE, _ = uic.loadUiType(os.path.join(
 
 METRICS_DURATION = 'Durations'
 METRICS_DISTANCE = 'Distances'
+METRICS_BOTH = 'Durations and distances'
 
 
 class OSRMTableDialog(QDialog, FORM_CLASS_TABLE_DIALOG_BASE, TemplateOsrm):
@@ -72,7 +79,8 @@ class OSRMTableDialog(QDialog, FORM_CLASS_TABLE_DIALOG_BASE, TemplateOsrm):
         )
         self.lineEdit_output.textChanged.connect(
             lambda x: self.pushButton_fetch.setEnabled(True)
-            if '.csv' in x else self.pushButton_fetch.setDisabled(True)
+            if any(ext in x for ext in ('.csv', '.npy', '.npz'))
+            else self.pushButton_fetch.setDisabled(True)
         )
         self.comboBox_layer_2.setFilters(
             QgsMapLayerProxyModel.PointLayer
@@ -85,26 +93,45 @@ class OSRMTableDialog(QDialog, FORM_CLASS_TABLE_DIALOG_BASE, TemplateOsrm):
         self.combo_box_metrics.currentTextChanged.connect(
             self.metrics_changed
         )
+        self.checkBox_closest.toggled.connect(self.enable_closest)
+        self.checkBox_knearest.toggled.connect(self.enable_knearest)
+        self.checkBox_max_value.toggled.connect(
+            self.spinBox_max_value.setEnabled)
         self.pushButton_browse.clicked.connect(self.output_dialog)
         self.pushButton_fetch.clicked.connect(self.get_table)
         self.filename = None
         self.encoding = None
+        self.session = None
         self.load_providers()
 
     def metrics_changed(self):
         """Handle distance / duration selection action"""
         self.metrics = self.combo_box_metrics.currentText()
-        if self.metrics == METRICS_DURATION:
+        if self.metrics in (METRICS_DURATION, METRICS_BOTH):
             self.checkBox_minutes.setEnabled(True)
         else:
             self.checkBox_minutes.setEnabled(False)
 
+    def enable_closest(self, checked):
+        """Enable or disable the closest destination widgets"""
+        self.spinBox_candidates.setEnabled(checked)
+        self.label_candidates.setEnabled(checked)
+        if checked:
+            self.checkBox_knearest.setChecked(False)
+
+    def enable_knearest(self, checked):
+        """Enable or disable the k nearest destinations widgets"""
+        self.spinBox_knearest.setEnabled(checked)
+        if checked:
+            self.checkBox_closest.setChecked(False)
+
     def output_dialog(self):
         """
         Dialog for setting filename and encoding for route distance/time table
         """
         self.lineEdit_output.clear()
-        self.filename, self.encoding = save_dialog()
+        self.filename, self.encoding = save_dialog(
+            "CSV (*.csv *.CSV);;NumPy (*.npy *.npz)")
         if self.filename is None:
             return
         self.lineEdit_output.setText(self.filename)
@@ -119,88 +146,292 @@ class OSRMTableDialog(QDialog, FORM_CLASS_TABLE_DIALOG_BASE, TemplateOsrm):
 
         if self.comboBox_layer_2.currentLayer() != s_layer:
             d_layer = self.comboBox_layer_2.currentLayer()
-            coords_dest, ids_dest = get_coords_ids(
+            coords_dest, ids_dest, fids_dest = get_coords_ids(
                 d_layer,
-                self.comboBox_idfield_2.currentField()
+                self.comboBox_idfield_2.currentField(),
+                with_fids=True
             )
         else:
             d_layer = None
             coords_dest = None
             ids_dest = None
 
-        coords_src, ids_src = get_coords_ids(
+        coords_src, ids_src, fids_src = get_coords_ids(
             s_layer,
-            self.comboBox_idfield.currentField()
+            self.comboBox_idfield.currentField(),
+            with_fids=True
         )
 
         url = self.prepare_request_url(self.base_url, 'table')
 
+        if self.checkBox_closest.isChecked():
+            if d_layer is None:
+                QMessageBox.information(
+                    self, 'Error',
+                    "Choose a destination layer different from the source "
+                    "layer to find the closest destinations")
+                return -1
+            return self.get_closest_table(
+                url, coords_src, ids_src, coords_dest, ids_dest)
+
+        if self.checkBox_knearest.isChecked():
+            if d_layer is None:
+                return self.get_knearest_table(
+                    url, coords_src, ids_src, coords_src, ids_src, True)
+            return self.get_knearest_table(
+                url, coords_src, ids_src, coords_dest, ids_dest, False)
+
+        if coords_dest is None:
+            coords_dest, ids_dest, fids_dest = coords_src, ids_src, fids_src
+        if self.metrics == METRICS_BOTH:
+            metrics = [METRICS_DURATION, METRICS_DISTANCE]
+        else:
+            metrics = [self.metrics]
+        minutes = self.checkBox_minutes.isChecked() \
+            and METRICS_DURATION in metrics
+
+        # Assemble the matrices in memory-mapped stores, block by block,
+        # all the metrics being requested together :
+        stores = [
+            MatrixStore(
+                (len(coords_src), len(coords_dest)),
+                'uint32' if self.checkBox_uint32.isChecked() else 'float32'
+            )
+            for _ in metrics
+        ]
+        if self.checkBox_incremental.isChecked():
+            # Only the rows and columns of the features added or moved
+            # since the previous run are requested :
+            key = (url, tuple(metrics), s_layer.id(),
+                   d_layer.id() if d_layer else None)
+            if self.session is None or self.session.key != key:
+                if self.session is not None:
+                    self.session.close()
+                self.session = MatrixSession(key, len(metrics))
+            blocks = self.session_blocks(
+                url, metrics, coords_src, fids_src, coords_dest, fids_dest)
+        else:
+            blocks = (
+                (src_start, dest_start, values)
+                for src_start, dest_start, values, _, _ in iter_table_blocks(
+                    url, self.api_key, coords_src, coords_dest,
+                    metrics=metrics)
+            )
+        try:
+            for src_start, dest_start, values in blocks:
+                for metric, store, metric_values in zip(
+                        metrics, stores, values):
+                    # Replace the value corresponding to a not-found
+                    # connection :
+                    if self.checkBox_empty_val.isChecked():
+                        metric_values[metric_values == 2147483647] = np.nan
+                    # Convert the matrix in minutes if needed :
+                    if minutes and metric == METRICS_DURATION:
+                        metric_values = (metric_values / 60.0).round(2)
+                    store.write_block(src_start, dest_start, metric_values)
+        except ValueError as err:
+            for store in stores:
+                store.close()
+            if self.session is not None:
+                self.session.close()
+            self.session = None
+            self.display_error(err, 1)
+            return -1
+
+        # Fetch the default encoding if selected :
+        if self.encoding == "System":
+            self.encoding = sys.getdefaultencoding()
+
+        # Write the result in binary or csv files :
+        try:
+            self.write_table(stores, metrics, minutes, ids_src, ids_dest)
+            QMessageBox.information(
+                self, 'Done',
+                f"OSRM table saved in {self.filename}")
+        except Exception as err:
+            QMessageBox.information(
+                self, 'Error',
+                "Something went wrong...(See Qgis log for traceback)")
+            QgsMessageLog.logMessage(
+                f"OSRM-plugin error report :\n {str(err)}",
+                level=Qgis.Warning)
+            return -1
+        finally:
+            for store in stores:
+                store.close()
+
+        return 0
+
+    def session_blocks(self, url, metrics, coords_src, fids_src, coords_dest,
+                       fids_dest):
+        """
+        Update the matrix session with the current features and yield its
+        values by bands of rows
+        """
+        nb_cells = self.session.update(
+            fids_src, coords_src, fids_dest, coords_dest,
+            lambda rows, cols: fetch_table_dense(
+                url, self.api_key,
+                [coords_src[i] for i in rows],
+                [coords_dest[j] for j in cols],
+                metrics
+            )
+        )
+        self.iface.messageBar().pushMessage(
+            "Info",
+            f"{nb_cells} of {len(coords_src) * len(coords_dest)} cells "
+            "requested",
+            duration=5
+        )
+        yield from self.session.iter_blocks()
+
+    def write_table(self, stores, metrics, minutes, ids_src, ids_dest):
+        """
+        Write the stored matrices according to the output file extension:
+        the matrices of a .npz archive are named after their metric, the
+        other outputs get the first matrix in the chosen file and the
+        second one (distances) in a "_distances" file next to it, except
+        flattened .csv files where both come side by side with the speed
+        """
+        base, extension = os.path.splitext(self.filename)
+        extension = extension.lower()
+        filenames = [self.filename] + [
+            f"{base}_{metric.lower()}{extension}" for metric in metrics[1:]
+        ]
+        if extension == '.npz':
+            if len(stores) == 1:
+                names = ["matrix"]
+            else:
+                names = [metric.lower() for metric in metrics]
+            save_matrices_npz(
+                self.filename, dict(zip(names, stores)), ids_src, ids_dest)
+            MatrixStore.save_ids(
+                self.filename, ids_src, ids_dest, self.encoding)
+        elif extension == '.npy':
+            for store, filename in zip(stores, filenames):
+                store.save_npy(filename)
+            MatrixStore.save_ids(
+                self.filename, ids_src, ids_dest, self.encoding)
+        elif self.checkBox_flatten.isChecked() and len(stores) > 1:
+            self.write_csv_table(
+                self.filename, stores, metrics, ids_src, ids_dest,
+                speed_factor=0.06 if minutes else 3.6)
+        else:
+            for store, metric, filename in zip(stores, metrics, filenames):
+                self.write_csv_table(
+                    filename, [store], [metric], ids_src, ids_dest)
+
+    def write_csv_table(self, filename, stores, metrics, ids_src, ids_dest,
+                        speed_factor=None):
+        """
+        Stream the matrices of the stores to a .csv file, as a table or
+        flattened, leaving out the cells over the cutoff or unreachable
+        """
+        write_matrix_csv(
+            filename,
+            stores[0],
+            ids_src,
+            ids_dest,
+            flatten=self.checkBox_flatten.isChecked(),
+            header=[
+                'Distance' if metric == METRICS_DISTANCE else 'Time'
+                for metric in metrics
+            ],
+            encoding=self.encoding,
+            max_value=self.spinBox_max_value.value()
+            if self.checkBox_max_value.isChecked() else None,
+            drop_unreachable=self.checkBox_drop_unreachable.isChecked(),
+            others=stores[1:],
+            speed_factor=speed_factor
+        )
+
+    def get_closest_table(self, url, coords_src, ids_src, coords_dest,
+                          ids_dest):
+        """
+        Write the closest destination of each origin, with its time and
+        distance, to the .csv file: only the k nearest destinations (by
+        straight-line distance) of each origin are requested
+        """
         try:
-            table = fetch_table(
+            best, times, distances = closest_destinations(
                 url,
                 self.api_key,
                 coords_src,
                 coords_dest,
-                metrics=self.metrics
+                k=self.spinBox_candidates.value()
             )
         except ValueError as err:
             self.display_error(err, 1)
             return -1
 
-        table_durations = table[0]
+        if self.checkBox_minutes.isChecked():
+            times = (times / 60.0).round(2)
 
-        # Convert the matrix in minutes if needed :
-        if (self.checkBox_minutes.isChecked() and self.metrics == METRICS_DURATION):  # pylint: disable=line-too-long
-            table_durations = (table_durations / 60.0).round(2)
+        if self.encoding == "System":
+            self.encoding = sys.getdefaultencoding()
 
-        # Replace the value corresponding to a not-found connection :
-        if self.checkBox_empty_val.isChecked():
-            if self.checkBox_minutes.isChecked():
-                table_durations[table_durations == 3579139.4] = np.NaN
-            else:
-                table_durations[table_durations == 2147483647] = np.NaN
+        try:
+            with codecs_open(self.filename, 'w', self.encoding) as out_file:
+                writer = csv.writer(out_file, lineterminator='\n')
+                writer.writerow(['Origin', 'Destination', 'Time', 'Distance'])
+                writer.writerows([
+                    [
+                        ids_src[i],
+                        ids_dest[best[i]] if best[i] >= 0 else '',
+                        times[i],
+                        distances[i]
+                    ]
+                    for i in range(len(ids_src))
+                ])
+            QMessageBox.information(
+                self, 'Done',
+                f"OSRM closest destinations saved in {self.filename}")
+        except Exception as err:
+            QMessageBox.information(
+                self, 'Error',
+                "Something went wrong...(See Qgis log for traceback)")
+            QgsMessageLog.logMessage(
+                f"OSRM-plugin error report :\n {str(err)}",
+                level=Qgis.Warning)
+            return -1
 
-        # Fetch the default encoding if selected :
+        return 0
+
+    def get_knearest_table(self, url, coords_src, ids_src, coords_dest,
+                           ids_dest, square):
+        """
+        Write the k nearest destinations (by time) of each origin to the
+        .csv file, one row per (origin, destination, rank), as the bands of
+        the matrix are fetched: the full matrix is never held in memory
+        """
         if self.encoding == "System":
             self.encoding = sys.getdefaultencoding()
+        minutes = self.checkBox_minutes.isChecked()
 
-        # Write the result in csv :
         try:
             with codecs_open(self.filename, 'w', self.encoding) as out_file:
                 writer = csv.writer(out_file, lineterminator='\n')
-                if self.checkBox_flatten.isChecked():
-                    table_durations = table_durations.ravel()
-                    if d_layer:
-                        idsx = [(i, j) for i in ids_src for j in ids_dest]
-                    else:
-                        idsx = [(i, j) for i in ids_src for j in ids_src]
-                    writer.writerow(['Origin', 'Destination', 'Time'])
+                writer.writerow(
+                    ['Origin', 'Destination', 'Rank', 'Time', 'Distance'])
+                for rows, indices, durations, distances in \
+                        k_nearest_destinations(
+                            url, self.api_key, coords_src, coords_dest,
+                            self.spinBox_knearest.value(), square):
+                    if minutes:
+                        durations = (durations / 60.0).round(2)
                     writer.writerows([
-                        [idsx[i][0], idsx[i][1], table_durations[i]]
-                        for i in range(len(idsx))
+                        [ids_src[row], ids_dest[dest], rank + 1,
+                         durations[i, rank], distances[i, rank]]
+                        for i, row in enumerate(rows)
+                        for rank, dest in enumerate(indices[i])
+                        if dest >= 0
                     ])
-                else:
-                    table_list = table_durations.tolist()
-                    if d_layer:
-                        writer.writerow([''] + ids_dest)
-                        writer.writerows(
-                            [
-                                [ids_src[_id]] + line
-                                for _id, line in enumerate(table_list)
-                            ]
-                        )
-                    else:
-                        writer.writerow([''] + ids_src)
-                        writer.writerows(
-                            [
-                                [ids_src[_id]] + line
-                                for _id, line in enumerate(table_list)
-                            ]
-                        )
-                out_file.close()
-                QMessageBox.information(
-                    self, 'Done',
-                    f"OSRM table saved in {self.filename}")
+            QMessageBox.information(
+                self, 'Done',
+                f"OSRM nearest destinations saved in {self.filename}")
+        except ValueError as err:
+            self.display_error(err, 1)
+            return -1
         except Exception as err:
             QMessageBox.information(
                 self, 'Error',
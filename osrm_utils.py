@@ -25,6 +25,10 @@
 """
 import csv
 import os
+import re
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from configparser import ConfigParser
 from functools import lru_cache
 import json
@@ -36,26 +40,55 @@ import numpy as np
 from qgis.PyQt.QtGui import QColor
 from qgis.PyQt.QtCore import QSettings, QFileInfo
 from qgis.core import (  # pylint: disable = no-name-in-module
-    QgsGeometry, QgsPointXY, QgsCoordinateReferenceSystem,
+    QgsGeometry, QgsCoordinateReferenceSystem,
     QgsProject, QgsCoordinateTransform, QgsSymbol,
-    QgsCoordinateTransformContext, QgsPoint
+    QgsCoordinateTransformContext, QgsPoint, QgsLineString, QgsPolygon,
+    QgsFeatureRequest, QgsVectorLayer, QgsFeature, QgsPointXY,
+    QgsSingleSymbolRenderer, QgsGraduatedSymbolRenderer, QgsRendererRange
 )
 from qgis.gui import (  # pylint: disable = no-name-in-module
     QgsEncodingFileDialog
 )
 from matplotlib import use as matplotlib_use
 from matplotlib.pyplot import contourf
-from scipy.interpolate import griddata
+from scipy.interpolate import RegularGridInterpolator
+from osgeo import gdal, osr
 from .osrm_polyfill import QFileDialog_AcceptMode_AcceptOpen
 from .osrm_polyfill import QFileDialog_AcceptMode_AcceptSave
 from .osrm_polyfill import QFileDialog_FileMode_AnyFile
 from .osrm_polyfill import Qgis_GeometryType_Line
 from .osrm_polyfill import qgsgeom_from_mpl_contour
 from .osrm_utils_polylline_codec import PolylineCodec
+from .osrm_utils_isochrone import (
+    interpolate_grid, interpolation_grid_shape, METERS_PER_DEGREE,
+    probe_points, ground_distances, frame_from_probe, expand_search_frame,
+    mercator_to_lonlat, search_frames, regular_grids
+)
+from .osrm_utils_matrix import (
+    TABLE_MAX_COORDS, candidate_destinations, candidate_pairs,
+    plan_table_blocks, k_smallest
+)
+from .osrm_utils_solver import TRIP_MAX_COORDS, tour_chunks
 
 __all__ = ['save_dialog', 'save_dialog_geo', 'prep_access',
            'prepare_route_symbol', 'prep_access_parsed',
            'encode_to_polyline', 'interpolate_from_times', 'get_coords_ids',
+           'interpolate_grid', 'contour_from_grid', 'IsochroneCache',
+           'ISOCHRONE_CACHE', 'save_dialog_raster', 'merge_time_grids',
+           'write_time_raster', 'interpolation_grid_shape',
+           'qgsgeom_from_rings', 'save_dialog_gpkg', 'probe_search_frame',
+           'search_frames', 'transform_to_wgs84', 'iter_table_blocks',
+           'nearest_facility', 'qgsgeom_from_label_rings',
+           'closest_destinations', 'fetch_sparse_pairs', 'iter_table_rows',
+           'k_nearest_destinations', 'fetch_table_annotations',
+           'fetch_table_dense', 'extract_points', 'LayerPointsCache',
+           'LAYER_POINTS_CACHE', 'fetch_tour_routes', 'join_route_chunks',
+           'fetch_route_chunks', 'fetch_long_route', 'stitch_routes',
+           'ROUTE_MAX_COORDS', 'HintCache', 'HINT_CACHE', 'add_hints',
+           'store_hints', 'REQUEST_PROFILES', 'profile_query',
+           'profile_precision', 'instruction_columns',
+           'prep_instruction_layer', 'ROUTE_ANNOTATIONS', 'route_annotations',
+           'segment_runs', 'route_segments', 'prep_segments_layer',
            'pts_ref', "put_on_top", 'decode_geom', 'fetch_table',
            'decode_geom_to_pts', 'fetch_nearest',
            'make_regular_points', 'get_search_frame', 'get_isochrones_colors',
@@ -64,6 +97,36 @@ __all__ = ['save_dialog', 'save_dialog_geo', 'prep_access',
 
 matplotlib_use('agg')
 
+RASTER_NODATA = -9999.0
+# Maximum number of waypoints of a route request sent by fetch_long_route
+# (osrm-routed --max-viaroute-size is 500 by default)
+ROUTE_MAX_COORDS = 100
+FRAME_MAX_EXPANSIONS = 2
+# Maximum number of waypoint hints kept per provider
+HINT_CACHE_SIZE = 100000
+# Hints are only sent while the request url stays under this length
+HINTS_MAX_URL_LENGTH = 8000
+# Upper estimates of the url length taken by each location of a table
+# request besides its hint (polyline, source or destination index and
+# separators) and by the rest of the query (options, api key)
+TABLE_COORD_URL_LENGTH = 20
+TABLE_QUERY_URL_LENGTH = 300
+# Route geometry requested per use case, from the lightest response to the
+# most precise one: durations and distances only, geometry simplified to
+# the zoom level fitting the route, full geometry, and full geometry with
+# 6 decimals (polyline6)
+REQUEST_PROFILES = OrderedDict([
+    ('attributes', {'overview': 'false'}),
+    ('display', {'overview': 'simplified'}),
+    ('detail', {'overview': 'full'}),
+    ('analysis', {'overview': 'full', 'geometries': 'polyline6'}),
+])
+# Per-segment annotations requested for the segment layers
+ROUTE_ANNOTATIONS = 'duration,distance,speed,nodes'
+# Upper bound (in km/h) and color of the speed classes of the segment layers
+SEGMENT_SPEED_CLASSES = ((10, '#d7191c'), (30, '#fdae61'), (50, '#ffffbf'),
+                         (80, '#a6d96a'), (1000, '#1a9641'))
+
 
 def _chain(*lists):
     """Flatten array"""
@@ -71,12 +134,28 @@ def _chain(*lists):
         yield from li
 
 
-def encode_to_polyline(pts):
-    """Convert point array to encoded polyline"""
+def profile_query(profile):
+    """Query parameters of a request profile (see REQUEST_PROFILES)"""
+    return '&'.join(
+        [f"{key}={value}" for key, value in REQUEST_PROFILES[profile].items()])
+
+
+def profile_precision(profile):
+    """Number of decimals of the geometries requested by a profile"""
+    if REQUEST_PROFILES[profile].get('geometries') == 'polyline6':
+        return 6
+    return 5
+
+
+def encode_to_polyline(pts, precision=5):
+    """
+    Convert point array to encoded polyline (with the given number of
+    decimals, 6 for polyline6)
+    """
     output = []
+    factor = 10 ** precision
 
     def write_enc(coord):
-        coord = int(round(coord * 1e5))
         coord <<= 1
         coord = coord if coord >= 0 else ~coord
         while coord >= 0x20:
@@ -85,6 +164,10 @@ def encode_to_polyline(pts):
         output.append(coord + 63)
 
     if len(pts) > 0 and len(pts[0]) > 1:
+        # Round the coordinates (not their differences) so that rounding
+        # errors do not add up along the line
+        pts = [(int(round(pt[0] * factor)), int(round(pt[1] * factor)))
+               for pt in pts]
         write_enc(pts[0][0])
         write_enc(pts[0][1])
         for i, pt in enumerate(pts[1:]):
@@ -123,25 +206,66 @@ def prep_access(time_param):
 
 
 def prep_access_parsed(time_param):
-    """Make the regular grid of points, snap them and compute tables"""
+    """
+    Make the regular grid of points, snap them and compute tables.
+    With the "calibrate" parameter, the search frame is sized from a probe
+    request and enlarged while its border is reached within max time.
+    """
     point = time_param['point']
     max_time = time_param['max']
     levels = time_param["levels"]
     url = time_param["url"]
     api_key = time_param["api_key"]
+    calibrate = time_param.get("calibrate", False)
 
-    bounds = get_search_frame(point, max_time)
-    coords_grid = make_regular_points(bounds, time_param["max_points"])
+    if calibrate:
+        bounds = probe_search_frame(url, api_key, point, max_time)
+    elif time_param.get("bounds") is not None:
+        bounds = time_param["bounds"]
+    else:
+        bounds = get_search_frame(point, max_time)
 
-    table_data = fetch_table(url, api_key, [point], coords_grid)
-    times = table_data[0]
-    snapped_dest_coords = table_data[2]
+    for _ in range(FRAME_MAX_EXPANSIONS + 1):
+        coords_grid = make_regular_points(bounds, time_param["max_points"])
 
-    times = (times[0] / 60.0).round(2)  # Round values in minutes
+        table_data = fetch_table(url, api_key, [point], coords_grid)
+        times = table_data[0]
+        snapped_dest_coords = table_data[2]
+
+        times = (times[0] / 60.0).round(2)  # Round values in minutes
+
+        if not calibrate:
+            break
+        bounds = expand_search_frame(
+            point, bounds, coords_grid, times, max_time)
+        if bounds is None:
+            break
 
     return [times, np.array(snapped_dest_coords), levels]
 
 
+def probe_search_frame(url, api_key, point, max_time):
+    """
+    Define the search frame from the effective speeds measured by a sparse
+    radial probe (one table request), rather than from a fixed speed, so
+    that the grid points are spent where the reachable area actually is.
+    Falls back to get_search_frame when no probe point can be routed.
+
+    Return
+    ------
+    xmin, ymin, xmax, ymax : float
+    """
+    radius = (max_time * 4) * 1000
+    bearings, coords = probe_points(point, radius)
+    table_data = fetch_table(url, api_key, [point], coords.tolist())
+    times = table_data[0][0] / 60.0
+    distances = ground_distances(point, table_data[2])
+    bounds = frame_from_probe(point, bearings, distances, times, max_time)
+    if bounds is None:
+        return get_search_frame(point, max_time)
+    return tuple(float(bound) for bound in bounds)
+
+
 def save_dialog(filtering="CSV (*.csv *.CSV)"):
     """Dialog for selecting csv file location"""
     settings = QSettings()
@@ -222,6 +346,56 @@ def save_dialog_geo(filtering="ESRI Shapefile (*.shp *.SHP)"):
     return None, None
 
 
+def save_dialog_raster(filtering="GeoTIFF (*.tif *.TIF)"):
+    """Dialog for selecting GeoTIFF file location"""
+    settings = QSettings()
+    dir_name = settings.value("/UI/lastShapefileDir")
+    encode = settings.value("/UI/encoding")
+    file_dialog = QgsEncodingFileDialog(
+        None,
+        "Save output GeoTIFF",
+        dir_name,
+        filtering,
+        encode
+    )
+    file_dialog.setDefaultSuffix('tif')
+    file_dialog.setFileMode(QFileDialog_FileMode_AnyFile())
+    file_dialog.setAcceptMode(QFileDialog_AcceptMode_AcceptSave())
+    if file_dialog.exec():
+        files = file_dialog.selectedFiles()
+        settings.setValue(
+            "/UI/lastShapefileDir",
+            QFileInfo(files[0]).absolutePath()
+        )
+        return (files[0], file_dialog.encoding())
+    return None, None
+
+
+def save_dialog_gpkg(filtering="GeoPackage (*.gpkg *.GPKG)"):
+    """Dialog for selecting GeoPackage file location"""
+    settings = QSettings()
+    dir_name = settings.value("/UI/lastShapefileDir")
+    encode = settings.value("/UI/encoding")
+    file_dialog = QgsEncodingFileDialog(
+        None,
+        "Save output GeoPackage",
+        dir_name,
+        filtering,
+        encode
+    )
+    file_dialog.setDefaultSuffix('gpkg')
+    file_dialog.setFileMode(QFileDialog_FileMode_AnyFile())
+    file_dialog.setAcceptMode(QFileDialog_AcceptMode_AcceptSave())
+    if file_dialog.exec():
+        files = file_dialog.selectedFiles()
+        settings.setValue(
+            "/UI/lastShapefileDir",
+            QFileInfo(files[0]).absolutePath()
+        )
+        return (files[0], file_dialog.encoding())
+    return None, None
+
+
 def prepare_route_symbol(nb_route):
     """Build route symbols for rendering routes"""
     colors = ['#1f78b4', '#ffff01', '#ff7f00',
@@ -233,53 +407,640 @@ def prepare_route_symbol(nb_route):
     return my_symb
 
 
-def interpolate_from_times(times, coords, levels, rev_coords=False):
-    """Interpolate polygons from route times and coordinates"""
-    if not rev_coords:
-        x = coords[..., 0]
-        y = coords[..., 1]
+def instruction_columns(routes_json, alt=0, groups=None):
+    """
+    Extract the fields of the instruction layer from the steps of the
+    routes (the steps without maneuver location being left out) in a
+    single loop over the steps, one list per field (see
+    prep_instruction_layer), along with the steps themselves
+    """
+    steps, group_column = [], []
+    columns = [[] for _ in range(9)]
+    (bearings_before, bearings_after, types, modifiers, exits, names,
+     distances, route_indices, durations) = columns
+    for route_idx, route in enumerate(routes_json):
+        group = groups[route_idx] if groups is not None else None
+        for leg in route['legs']:
+            for step in leg['steps']:
+                maneuver = step.get('maneuver', {})
+                if 'location' not in maneuver:
+                    continue
+                steps.append(step)
+                bearings_before.append(maneuver.get('bearing_before'))
+                bearings_after.append(maneuver.get('bearing_after'))
+                types.append(maneuver.get('type'))
+                modifiers.append(maneuver.get('modifier'))
+                exits.append(maneuver.get('exit'))
+                names.append(step['name'])
+                distances.append(step['distance'])
+                route_indices.append(route_idx)
+                durations.append(step['duration'] / 60)
+                group_column.append(group)
+
+    columns = [range(len(steps)), [alt] * len(steps)] + columns
+    if groups is not None:
+        columns.append(group_column)
+    return steps, columns
+
+
+def prep_instruction_layer(name, routes_json, alt=0, groups=None,
+                           step_lines=False, precision=5):
+    """
+    Prepare the instruction layer of the routes, each field corresponding
+    to an OSRM route step field (and the group of each route if groups is
+    given), the features being built in bulk from the field columns.
+
+    Params:
+
+    alt: int
+        Value of the alt field
+    groups: list or None
+        Group of each route
+    step_lines: bool
+        Use the line of each step (its 'geometry', with the given number of
+        decimals) instead of its maneuver point
+    """
+    steps, columns = instruction_columns(routes_json, alt, groups)
+    layer = QgsVectorLayer(
+        ''.join([
+            "Linestring" if step_lines else "Point",
+            "?crs=epsg:4326&field=id:integer&field=alt:integer"
+            "&field=maneuver_bearing_before:integer"
+            "&field=bearing_after:integer"
+            "&field=maneuver_type:string(254)"
+            "&field=maneuver_modifier:string(254)"
+            "&field=maneuver_exit:integer(20)"
+            "&field=street_name:string(254)"
+            "&field=length_m:real(20)&field=route_idx:integer(20)"
+            "&field=time_min:real(20)",
+            "&field=group:string(254)" if groups is not None else ""
+        ]),
+        name, "memory")
+
+    if step_lines:
+        geoms = [decode_geom(step['geometry'], precision) for step in steps]
     else:
-        x = coords[..., 1]
-        y = coords[..., 0]
-    xi = np.linspace(np.nanmin(x), np.nanmax(x), 200)
-    yi = np.linspace(np.nanmin(y), np.nanmax(y), 200)
-    x_grid, y_grid = np.meshgrid(xi, yi)
+        geoms = [
+            QgsGeometry.fromPointXY(QgsPointXY(*step['maneuver']['location']))
+            for step in steps
+        ]
 
-    zi = griddata(coords, times, (x_grid, y_grid), method='linear')
-    v_bnd = np.nanmax(abs(zi))
-    contour_set = contourf(xi, yi, zi, levels, vmax=v_bnd, vmin=-v_bnd)
+    fields = layer.fields()
+    features = []
+    for geom, attributes in zip(geoms, zip(*columns)):
+        fet = QgsFeature(fields)
+        fet.setGeometry(geom)
+        fet.setAttributes(list(attributes))
+        features.append(fet)
+    layer.dataProvider().addFeatures(features)
+
+    symbol = QgsSymbol.defaultSymbol(layer.geometryType())
+    if step_lines:
+        symbol.setWidth(0.6)
+    else:
+        symbol.setSize(2)
+    symbol.setColor(QColor("#d9ef8b"))
+    layer.setRenderer(QgsSingleSymbolRenderer(symbol))
+    layer.updateExtents()
+    return layer
 
-    return contour_set
 
+def route_annotations(route):
+    """
+    Concatenate the per-segment annotations of the legs of a route (see
+    ROUTE_ANNOTATIONS) into arrays, the OSM nodes being given as the start
+    and end node of each segment
+    """
+    legs = [leg['annotation'] for leg in route['legs']]
+    annotations = {
+        key: np.concatenate(
+            [np.asarray(leg[key], dtype=float) for leg in legs])
+        for key in ('duration', 'distance', 'speed')
+    }
+    node_from, node_to = [], []
+    for leg in legs:
+        nodes = np.asarray(leg['nodes'], dtype=np.int64)
+        nb_segments = len(leg['distance'])
+        if len(nodes) < nb_segments + 1:
+            raise ValueError("Missing node annotations")
+        node_from.append(nodes[:nb_segments])
+        node_to.append(nodes[1:nb_segments + 1])
+    annotations['node_from'] = np.concatenate(node_from)
+    annotations['node_to'] = np.concatenate(node_to)
+    return annotations
+
+
+def segment_runs(speed):
+    """Index of the first segment of each run of segments of equal speed"""
+    return np.flatnonzero(np.diff(speed, prepend=np.nan) != 0)
+
+
+def route_segments(route, precision=5, speed_runs=True):
+    """
+    Split the full geometry of an annotated route into one line per
+    segment, or per run of segments of equal speed, the annotations being
+    summed over each run with array operations (see prep_segments_layer)
 
-def get_coords_ids(layer, field, on_selected=False):
-    """Return list of feature geometry and feature id field from layer"""
-    if on_selected:
-        get_features_method = layer.selectedFeatures
-    else:
-        get_features_method = layer.getFeatures
+    Return
+    ------
+    list of the geometries, and list of the values of each field
+    """
+    annotations = route_annotations(route)
+    coords = np.array(decode_geom_to_pts(route['geometry'], precision))
+    nb_segments = len(annotations['distance'])
+    if len(coords) != nb_segments + 1:
+        raise ValueError(
+            "The route geometry does not match its annotations "
+            "(the full overview is required)")
 
-    if '4326' not in layer.crs().authid():
-        xform = QgsCoordinateTransform(
-            layer.crs(),
-            QgsCoordinateReferenceSystem.fromEpsgId(4326),
-            QgsCoordinateTransformContext()
-        )
-        coords = [
-            xform.transform(ft.geometry().asPoint())
-            for ft in get_features_method()
-        ]
+    if speed_runs:
+        starts = segment_runs(annotations['speed'])
     else:
-        coords = [ft.geometry().asPoint() for ft in get_features_method()]
+        starts = np.arange(nb_segments)
+    ends = np.append(starts[1:], nb_segments)
+    duration = np.add.reduceat(annotations['duration'], starts)
+    distance = np.add.reduceat(annotations['distance'], starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = distance / duration * 3.6
+
+    xs, ys = coords[:, 0].tolist(), coords[:, 1].tolist()
+    geoms = [
+        QgsGeometry(QgsLineString(xs[start:end + 1], ys[start:end + 1]))
+        for start, end in zip(starts.tolist(), ends.tolist())
+    ]
+    columns = [
+        starts.tolist(),
+        (ends - starts).tolist(),
+        duration.tolist(),
+        distance.tolist(),
+        np.where(np.isfinite(speed), speed, None).tolist(),
+        annotations['node_from'][starts].tolist(),
+        annotations['node_to'][ends - 1].tolist()
+    ]
+    return geoms, columns
+
+
+def prep_segments_renderer():
+    """Renderer of the segment layers, by speed class"""
+    ranges = []
+    lower = 0
+    for upper, color in SEGMENT_SPEED_CLASSES:
+        symbol = QgsSymbol.defaultSymbol(Qgis_GeometryType_Line())
+        symbol.setColor(QColor(color))
+        symbol.setWidth(1.2)
+        label = f"{lower} - {upper} km/h" \
+            if upper != SEGMENT_SPEED_CLASSES[-1][0] else f"> {lower} km/h"
+        ranges.append(QgsRendererRange(lower, upper, symbol, label))
+        lower = upper
+    return QgsGraduatedSymbolRenderer('speed_kmh', ranges)
+
+
+def prep_segments_layer(name, routes, precision=5, speed_runs=True):
+    """
+    Prepare the layer of the segments (see route_segments) of annotated
+    routes, rendered by speed class
+
+    Params:
+
+    routes: list
+        (id, route object) of each route, the id being the value of the
+        route_id field
+    """
+    layer = QgsVectorLayer(
+        "Linestring?crs=epsg:4326&field=route_id:integer"
+        "&field=first_segment:integer&field=nb_segments:integer"
+        "&field=duration_s:real(20)&field=distance_m:real(20)"
+        "&field=speed_kmh:real(20)"
+        "&field=node_from:long&field=node_to:long",
+        name, "memory")
+    fields = layer.fields()
+    features = []
+    for route_id, route in routes:
+        geoms, columns = route_segments(route, precision, speed_runs)
+        for geom, attributes in zip(geoms, zip(*columns)):
+            fet = QgsFeature(fields)
+            fet.setGeometry(geom)
+            fet.setAttributes([route_id, *attributes])
+            features.append(fet)
+    layer.dataProvider().addFeatures(features)
+    layer.setRenderer(prep_segments_renderer())
+    layer.updateExtents()
+    return layer
+
+
+def contour_from_grid(xi, yi, zi, levels):
+    """Extract MatPlotLib polygons of the desired levels from a time grid"""
+    v_bnd = np.nanmax(abs(zi))
+    return contourf(xi, yi, zi, levels, vmax=v_bnd, vmin=-v_bnd)
+
+
+def qgsgeom_from_rings(rings):
+    """
+    Convert the rings computed by contour_rings (one coordinate array or
+    None per level) to QgsGeometry polygons
+    """
+    polygons = []
+    for ring in rings:
+        if ring is None:
+            polygons.append(QgsGeometry.fromPolygonXY([]))
+            continue
+        exterior = QgsLineString(ring[:, 0].tolist(), ring[:, 1].tolist())
+        polygons.append(QgsGeometry(QgsPolygon(exterior)))
+    return polygons
+
+
+def qgsgeom_from_label_rings(rings):
+    """
+    Convert the rings of one label computed by label_rings to a single
+    QgsGeometry, the holes being removed by the even-odd rule
+    """
+    geom = QgsGeometry()
+    for ring in rings:
+        exterior = QgsLineString(ring[:, 0].tolist(), ring[:, 1].tolist())
+        part = QgsGeometry(QgsPolygon(exterior))
+        geom = part if geom.isNull() else geom.symDifference(part)
+    return geom
+
+
+def interpolate_from_times(times, coords, levels, rev_coords=False):
+    """Interpolate polygons from route times and coordinates"""
+    xi, yi, zi = interpolate_grid(times, coords, rev_coords)
+    return contour_from_grid(xi, yi, zi, levels)
+
+
+def merge_time_grids(grids, resolution):
+    """
+    Resample interpolated time grids (in EPSG:4326) on a common north-up
+    grid whose cells are about `resolution` meters wide, keeping the
+    smallest time of all the grids in each cell.
+
+    Return
+    ------
+    merged : 2D array of times (NaN where no grid reaches the cell)
+    geotransform : (xmin, cell width, 0, ymax, 0, -cell height)
+    """
+    xmin = min(np.nanmin(grid[0]) for grid in grids)
+    xmax = max(np.nanmax(grid[0]) for grid in grids)
+    ymin = min(np.nanmin(grid[1]) for grid in grids)
+    ymax = max(np.nanmax(grid[1]) for grid in grids)
+
+    cell_h = resolution / METERS_PER_DEGREE
+    cell_w = cell_h / max(np.cos(np.radians((ymin + ymax) / 2.0)), 1e-6)
+    nb_x = max(int(np.ceil((xmax - xmin) / cell_w)), 1)
+    nb_y = max(int(np.ceil((ymax - ymin) / cell_h)), 1)
+    x_centers = xmin + (np.arange(nb_x) + 0.5) * cell_w
+    y_centers = ymax - (np.arange(nb_y) + 0.5) * cell_h
+
+    merged = np.full((nb_y, nb_x), np.nan)
+    for xi, yi, zi in grids:
+        # Only resample the window of the common grid covered by this one
+        cols = np.nonzero((x_centers >= xi[0]) & (x_centers <= xi[-1]))[0]
+        rows = np.nonzero((y_centers >= yi[0]) & (y_centers <= yi[-1]))[0]
+        if len(cols) == 0 or len(rows) == 0:
+            continue
+        interpolator = RegularGridInterpolator(
+            (yi, xi), zi, bounds_error=False, fill_value=np.nan)
+        y_grid, x_grid = np.meshgrid(
+            y_centers[rows], x_centers[cols], indexing='ij')
+        values = interpolator((y_grid, x_grid))
+        window = np.ix_(rows, cols)
+        merged[window] = np.fmin(merged[window], values)
+
+    return merged, (float(xmin), cell_w, 0.0, float(ymax), 0.0, -cell_h)
+
+
+def write_time_raster(filename, grid, geotransform, nodata=RASTER_NODATA):
+    """
+    Write a time grid (as returned by merge_time_grids) in a single band
+    GeoTIFF file, cells without value being written as `nodata`
+    """
+    nb_y, nb_x = grid.shape
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        filename, nb_x, nb_y, 1, gdal.GDT_Float32, ['COMPRESS=DEFLATE'])
+    if dataset is None:
+        raise ValueError(f"Unable to create raster file {filename}")
+    dataset.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    dataset.SetProjection(srs.ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(np.where(np.isnan(grid), nodata, grid).astype(np.float32))
+    band.FlushCache()
+    dataset = None  # Closing the dataset writes it to disk
+
+
+class IsochroneCache:
+    """
+    Bounded per-session store of the expensive isochrone artefacts
+    (travel times, snapped grid coordinates and interpolated time grid),
+    so that changing only the levels of a previous run re-contours the
+    stored grid instead of querying the OSRM instance again.
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _point_key(point):
+        """Normalize a center point to a hashable key"""
+        return (round(float(point[0]), 6), round(float(point[1]), 6))
+
+    def get(self, url, point, max_time, max_points, calibrate=False):
+        """
+        Return the entry computed for this provider, center, number of
+        points and frame calibration, with a maximum time greater or equal
+        to the requested one (the smallest suitable one), or None
+        """
+        point = self._point_key(point)
+        best_key = None
+        for key in self._entries:
+            if key[0] != url or key[1] != point or key[3] != max_points:
+                continue
+            if key[4] != calibrate:
+                continue
+            if key[2] < max_time:
+                continue
+            if best_key is None or key[2] < best_key[2]:
+                best_key = key
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key]
+
+    def put(self, url, point, max_time, max_points, times, coords, grid,
+            grid_key=None, calibrate=False):
+        """
+        Store the results computed for one isochrone center, `grid_key`
+        identifying the interpolation settings used to compute `grid`
+        """
+        key = (url, self._point_key(point), max_time, max_points, calibrate)
+        self._entries[key] = {
+            "times": times,
+            "coords": coords,
+            "grid": grid,
+            "grid_key": grid_key
+        }
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return self._entries[key]
+
+    def clear(self):
+        """Drop every stored entry"""
+        self._entries.clear()
+
+
+ISOCHRONE_CACHE = IsochroneCache()
+
+
+class HintCache:
+    """
+    Bounded per-provider store of the hints returned by OSRM for snapped
+    coordinates: sending them back (hints=) lets the server skip the
+    nearest edge search of these coordinates. The hints of a provider are
+    dropped when the data_version of its responses changes.
+    """
+
+    def __init__(self, maxsize=HINT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _provider_key(url):
+        """Provider of a service url, whatever the service"""
+        return re.sub(
+            r'/(route|table|trip|nearest|match)/', '/{action}/', url, count=1)
+
+    @staticmethod
+    def _point_key(point):
+        """Normalize a coordinate to the precision of encoded polylines"""
+        return (round(float(point[0]), 5), round(float(point[1]), 5))
+
+    def get(self, url, coords):
+        """
+        Return the hint of each coordinate ('' if unknown), or None if
+        no hint is known
+        """
+        with self._lock:
+            entries = self._entries.get(self._provider_key(url))
+            if not entries:
+                return None
+            hints = [entries.get(self._point_key(point), '')
+                     for point in coords]
+        return hints if any(hints) else None
+
+    def update(self, url, coords, waypoints, data_version=None):
+        """
+        Store the hints of the waypoints snapped from coords (in the same
+        order)
+        """
+        provider = self._provider_key(url)
+        with self._lock:
+            if self._versions.get(provider) != data_version:
+                self._entries.pop(provider, None)
+                self._versions[provider] = data_version
+            entries = self._entries.setdefault(provider, OrderedDict())
+            for point, waypoint in zip(coords, waypoints):
+                if waypoint and waypoint.get('hint'):
+                    key = self._point_key(point)
+                    entries[key] = waypoint['hint']
+                    entries.move_to_end(key)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every stored hint"""
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+HINT_CACHE = HintCache()
+
+
+def add_hints(query, url, coords, skip_waypoints=False):
+    """
+    Append the known hints of coords (in request order) to a query, unless
+    the query would become too long. If skip_waypoints is set (the response
+    waypoints not being used otherwise), the waypoints are left out of the
+    response once the hints of every coordinate are known (and sent: a
+    query left without hints keeps its waypoints so that they get stored).
+    """
+    hints = HINT_CACHE.get(url, coords)
+    if hints is None:
+        return query
+    hinted = ''.join([
+        query,
+        '&skip_waypoints=true' if skip_waypoints and all(hints) else '',
+        '&hints=',
+        ';'.join(hints)
+    ])
+    return hinted if len(hinted) <= HINTS_MAX_URL_LENGTH else query
+
+
+def hinted_max_coords(url, coords, max_coords):
+    """
+    Number of locations of the table blocks over coords: max_coords, or
+    fewer when hints of coords are known, so that the hinted query of a
+    block stays under HINTS_MAX_URL_LENGTH instead of falling back to an
+    unhinted one (at least 2 locations)
+    """
+    hints = HINT_CACHE.get(url, coords)
+    if hints is None:
+        return max_coords
+    coord_length = max(len(hint) for hint in hints) + TABLE_COORD_URL_LENGTH
+    fitting = (HINTS_MAX_URL_LENGTH - len(url) - TABLE_QUERY_URL_LENGTH) \
+        // coord_length
+    return max(2, min(max_coords, fitting))
+
+
+def store_hints(url, coords, parsed_json, keys=('waypoints',)):
+    """
+    Store the hints of the waypoints of a response, the waypoints of the
+    given keys being concatenated in the order of coords
+    """
+    waypoints = []
+    for key in keys:
+        waypoints.extend(parsed_json.get(key) or [])
+    HINT_CACHE.update(
+        url, coords, waypoints, parsed_json.get('data_version'))
+
+
+class LayerPointsCache:
+    """
+    Coordinates (in EPSG:4326) and ids of the features of point layers,
+    read in a single pass and kept until the layer changes (data or edit
+    buffer, selection, filter, fields, CRS) or is removed.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._watched = set()
+
+    def _watch(self, layer):
+        """
+        Drop the entries of a layer when its data (saved or in its edit
+        buffer), selection, filter, fields or CRS change, and forget the
+        layer when it is removed
+        """
+        layer_id = layer.id()
+        if layer_id in self._watched:
+            return
+        for signal in (layer.dataChanged, layer.layerModified,
+                       layer.selectionChanged, layer.subsetStringChanged,
+                       layer.updatedFields, layer.crsChanged):
+            signal.connect(lambda *args, lid=layer_id: self.invalidate(lid))
+        layer.willBeDeleted.connect(
+            lambda *args, lid=layer_id: self.forget(lid))
+        self._watched.add(layer_id)
+
+    def invalidate(self, layer_id):
+        """Drop the entries of a layer"""
+        for key in [key for key in self._entries if key[0] == layer_id]:
+            del self._entries[key]
+
+    def forget(self, layer_id):
+        """Drop the entries of a removed layer and stop watching it"""
+        self.invalidate(layer_id)
+        self._watched.discard(layer_id)
+
+    def get(self, layer, field='', on_selected=False):
+        """
+        Feature ids, (n, 2) lon/lat array and id field values of the
+        features (or of the selected features) of a point layer
+        """
+        key = (layer.id(), field, on_selected)
+        if key not in self._entries:
+            self._watch(layer)
+            self._entries[key] = extract_points(layer, field, on_selected)
+        fids, coords, ids = self._entries[key]
+        return fids, coords, list(ids)
+
+    def clear(self):
+        """Drop every stored entry"""
+        self._entries.clear()
+
+
+def extract_points(layer, field='', on_selected=False):
+    """
+    Read the feature ids, the coordinates and the id field of a point layer
+    in a single request fetching only the needed attribute, the coordinates
+    being transformed to EPSG:4326 at once
 
-    if field != '':
-        ids = [ft.attribute(field) for ft in get_features_method()]
+    Return
+    ------
+    fids : array of feature ids
+    coords : (n, 2) array of lon/lat coordinates
+    ids : list of id field values (the feature ids without field)
+    """
+    request = QgsFeatureRequest()
+    if field:
+        request.setSubsetOfAttributes([field], layer.fields())
     else:
-        ids = [ft.id() for ft in get_features_method()]
+        request.setNoAttributes()
+    if on_selected:
+        request.setFilterFids(layer.selectedFeatureIds())
+
+    fids, xs, ys, ids = [], [], [], []
+    for ft in layer.getFeatures(request):
+        point = ft.geometry().asPoint()
+        fids.append(ft.id())
+        xs.append(point.x())
+        ys.append(point.y())
+        ids.append(ft.attribute(field) if field else ft.id())
 
+    lon, lat = transform_to_wgs84(layer.crs(), xs, ys)
+    return np.array(fids, dtype=np.int64), np.column_stack((lon, lat)), ids
+
+
+LAYER_POINTS_CACHE = LayerPointsCache()
+
+
+def get_coords_ids(layer, field, on_selected=False, with_fids=False):
+    """
+    Return list of feature geometry and feature id field from layer
+    (and the feature ids with with_fids)
+    """
+    fids, coords, ids = LAYER_POINTS_CACHE.get(layer, field, on_selected)
+    coords = [tuple(coord) for coord in coords.tolist()]
+    if with_fids:
+        return coords, ids, fids.tolist()
     return coords, ids
 
 
+@lru_cache(maxsize=16)
+def get_transform_to_wgs84(crs_wkt):
+    """Coordinate transform from a CRS (given as WKT) to EPSG:4326"""
+    return QgsCoordinateTransform(
+        QgsCoordinateReferenceSystem.fromWkt(crs_wkt),
+        QgsCoordinateReferenceSystem.fromEpsgId(4326),
+        QgsCoordinateTransformContext()
+    )
+
+
+def transform_to_wgs84(crs, xs, ys):
+    """
+    Transform coordinate arrays from crs to EPSG:4326 at once: no-op for
+    EPSG:4326, closed form for Web Mercator and a cached transform applied
+    to a single line string for the other CRSs.
+
+    Return
+    ------
+    lon, lat : numpy arrays
+    """
+    authid = crs.authid()
+    if authid == 'EPSG:4326' or len(xs) == 0:
+        return np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+    if authid in ('EPSG:3857', 'EPSG:900913'):
+        return mercator_to_lonlat(xs, ys)
+    line = QgsLineString([float(x) for x in xs], [float(y) for y in ys])
+    line.transform(get_transform_to_wgs84(crs.toWkt()))
+    return np.array(line.xVector()), np.array(line.yVector())
+
+
 def pts_ref(features):
     """Retrieve third item from each feature"""
     return [i[3] for i in features]
@@ -302,7 +1063,7 @@ def put_on_top(id_new_layer_top, id_old_layer_top):
     parent.removeChildNode(my_a_layer)
 
 
-def decode_geom(encoded_polyline):
+def decode_geom(encoded_polyline, precision=5):
     """
     Function decoding an encoded polyline (with 'encoded polyline
     algorithme') and returning a QgsGeometry object
@@ -311,43 +1072,19 @@ def decode_geom(encoded_polyline):
 
     encoded_polyline: str
         The encoded string to decode
+    precision: int
+        The number of decimals of the encoded coordinates (6 for polyline6)
     """
     return QgsGeometry.fromPolyline(
         [
             QgsPoint(i[1], i[0])
-            for i in PolylineCodec().decode(encoded_polyline)
+            for i in PolylineCodec().decode(encoded_polyline, precision)
         ]
     )
 
 
-def fetch_table(url, api_key, coords_src, coords_dest, metrics='Durations'):
-    """
-    Function wrapping OSRM 'table' function in order to get a matrix of
-    time distance as a numpy array
-
-    Params :
-        - url, str: the start of the url to use
-            (containing the host and the profile version/name)
-
-        - coords_src, list: a python list of (x, y) coordinates to use
-            (they will be used a "sources" if destinations coordinates are
-             provided, otherwise they will be used as source and destination
-             in order to build a "square"/"symetrical" matrix)
-
-        - coords_dest, list or None: a python list of (x, y) coordinates to use
-            (if set to None, only the sources coordinates will be used in order
-            to build a "square"/"symetrical" matrix)
-
-    Output:
-        - a numpy array containing the time in tenth of seconds
-            (where 2147483647 means not-found route)
-
-        - a list of "snapped" source coordinates
-
-        - a list of "snapped" destination coordinates
-            (or None if no destination coordinates where provided)
-    """
-    metrics = metrics.lower()
+def _table_query(url, api_key, coords_src, coords_dest, annotations):
+    """Build the url of a table request for the given annotations"""
     if not coords_dest:
         query = ''.join(
             [
@@ -356,11 +1093,9 @@ def fetch_table(url, api_key, coords_src, coords_dest, metrics='Durations'):
                 encode_to_polyline([(c[1], c[0]) for c in coords_src]),
                 ")?"
                 'annotations=',
-                metrics[:-1]
+                annotations
             ]
         )
-        if api_key:
-            query = ''.join([query, '&api_key=', api_key])
     else:
         src_end = len(coords_src)
         dest_end = src_end + len(coords_dest)
@@ -379,12 +1114,19 @@ def fetch_table(url, api_key, coords_src, coords_dest, metrics='Durations'):
             '&destinations=',
             ';'.join([str(j) for j in range(src_end, dest_end)]),
             '&annotations=',
-            metrics[:-1]
+            annotations
         ])
-        if api_key:
-            query = ''.join([query, '&api_key=', api_key])
+    # The snapped sources and destinations are part of the table results,
+    # so the waypoints are never skipped here
+    query = add_hints(query, url, _chain(coords_src, coords_dest or []))
+    if api_key:
+        query = ''.join([query, '&api_key=', api_key])
+    return query
 
-    print(f"Fetch table query: {query}")
+
+def _request_service(query, keys, service='table'):
+    """Run a request to an OSRM service and check its response holds keys"""
+    print(f"Fetch {service} query: {query}")
 
     try:
         http = urllib3.PoolManager()
@@ -393,7 +1135,8 @@ def fetch_table(url, api_key, coords_src, coords_dest, metrics='Durations'):
         parsed_json = json.loads(res.data, strict=False)
         assert 'code' in parsed_json
         assert parsed_json["code"] == "Ok"
-        assert metrics in parsed_json
+        for key in keys:
+            assert key in parsed_json
     except AssertionError as er:
         raise ValueError(
             f"Error while contacting OSRM instance: invalid response: {er}"
@@ -407,28 +1150,443 @@ def fetch_table(url, api_key, coords_src, coords_dest, metrics='Durations'):
         raise ValueError(
             f"Error while contacting OSRM instance: invalid response: {err}"
         ) from err
+    return parsed_json
+
+
+def fetch_table(url, api_key, coords_src, coords_dest, metrics='Durations'):
+    """
+    Function wrapping OSRM 'table' function in order to get a matrix of
+    time distance as a numpy array
 
-    durations = np.array(parsed_json[metrics], dtype=float)
-    new_src_coords = [ft["location"] for ft in parsed_json["sources"]]
+    Params :
+        - url, str: the start of the url to use
+            (containing the host and the profile version/name)
+
+        - coords_src, list: a python list of (x, y) coordinates to use
+            (they will be used a "sources" if destinations coordinates are
+             provided, otherwise they will be used as source and destination
+             in order to build a "square"/"symetrical" matrix)
+
+        - coords_dest, list or None: a python list of (x, y) coordinates to use
+            (if set to None, only the sources coordinates will be used in order
+            to build a "square"/"symetrical" matrix)
+
+        - metrics, str or list: 'Durations', 'Distances' or a list of both
+            (requested together with a single annotations=duration,distance
+             request)
+
+    Output:
+        - a numpy array containing the time in tenth of seconds
+            (where 2147483647 means not-found route), or, for a list of
+            metrics, an array of one such matrix per metric
+
+        - a list of "snapped" source coordinates
+
+        - a list of "snapped" destination coordinates
+            (or None if no destination coordinates where provided)
+    """
+    if isinstance(metrics, str):
+        parsed_json = fetch_table_annotations(
+            url, api_key, coords_src, coords_dest, [metrics])
+        values = parsed_json[metrics.lower()]
+    else:
+        parsed_json = fetch_table_annotations(
+            url, api_key, coords_src, coords_dest, metrics)
+        values = np.stack([parsed_json[metric.lower()] for metric in metrics])
+
+    return values, parsed_json["sources"], parsed_json["destinations"]
+
+
+def fetch_table_annotations(url, api_key, coords_src, coords_dest,
+                            metrics=('Durations', 'Distances')):
+    """
+    Fetch several annotations of a table in a single request
+    (annotations=duration,distance)
+
+    Output:
+        dict holding a numpy array for each lower-cased metric
+        ("durations", "distances"), the "sources" snapped coordinates and
+        the "destinations" snapped coordinates (None if no destination
+        coordinates where provided)
+    """
+    metrics = [metric.lower() for metric in metrics]
+    query = _table_query(
+        url, api_key, coords_src, coords_dest,
+        ','.join([metric[:-1] for metric in metrics])
+    )
+    parsed_json = _request_service(query, metrics)
+    if coords_dest:
+        store_hints(url, _chain(coords_src, coords_dest), parsed_json,
+                    ('sources', 'destinations'))
+    else:
+        store_hints(url, coords_src, parsed_json, ('sources',))
 
+    result = {
+        metric: np.array(parsed_json[metric], dtype=float)
+        for metric in metrics
+    }
+    result["sources"] = [ft["location"] for ft in parsed_json["sources"]]
     if coords_dest:
-        new_dest_coords = [
+        result["destinations"] = [
             ft["location"] for ft in parsed_json["destinations"]
         ]
     else:
-        new_dest_coords = None
+        result["destinations"] = None
+    return result
+
+
+def iter_table_blocks(url, api_key, coords_src, coords_dest,
+                      max_coords=TABLE_MAX_COORDS, metrics='Durations'):
+    """
+    Fetch a sources x destinations matrix in blocks small enough for the
+    table size limit of the OSRM instance (at most max_coords locations per
+    request), yielding the blocks as they arrive (requests run in a few
+    threads) so that the whole matrix never needs to be held in memory.
+
+    Yield
+    -----
+    src_start, dest_start, values, snapped_src, snapped_dest
+    """
+    max_coords = hinted_max_coords(
+        url, _chain(coords_src, coords_dest), max_coords)
+    nb_src = max(1, min(len(coords_src), max_coords // 2))
+    nb_dest = max(1, max_coords - nb_src)
+    blocks = [
+        (src_start, dest_start)
+        for dest_start in range(0, len(coords_dest), nb_dest)
+        for src_start in range(0, len(coords_src), nb_src)
+    ]
+
+    def fetch_block(block):
+        src_start, dest_start = block
+        values, snapped_src, snapped_dest = fetch_table(
+            url, api_key,
+            list(coords_src[src_start:src_start + nb_src]),
+            list(coords_dest[dest_start:dest_start + nb_dest]),
+            metrics
+        )
+        return src_start, dest_start, values, snapped_src, snapped_dest
+
+    with ThreadPool(processes=min(4, len(blocks)) or 1) as pool:
+        yield from pool.imap_unordered(fetch_block, blocks)
 
-    return durations, new_src_coords, new_dest_coords
 
+def fetch_table_dense(url, api_key, coords_src, coords_dest, metrics,
+                      max_coords=TABLE_MAX_COORDS):
+    """
+    Fetch a whole sources x destinations matrix for each metric, in blocks
+    fitting the table size limit
+
+    Return
+    ------
+    (metrics, sources, destinations) array
+    """
+    values = np.full((len(metrics), len(coords_src), len(coords_dest)),
+                     np.nan)
+    for src_start, dest_start, block, _, _ in iter_table_blocks(
+            url, api_key, coords_src, coords_dest, max_coords, metrics):
+        values[:, src_start:src_start + block.shape[1],
+               dest_start:dest_start + block.shape[2]] = block
+    return values
+
+
+def iter_table_rows(url, api_key, coords_src, coords_dest,
+                    max_coords=TABLE_MAX_COORDS, metrics='Durations'):
+    """
+    Fetch a sources x destinations matrix by bands of rows, each band being
+    fetched in blocks fitting the table size limit, so that only one band
+    is held in memory at a time.
+
+    Yield
+    -----
+    row_start, band : index of the first row and (rows, destinations) array
+    (one such array per metric if metrics is a list)
+    """
+    nb_src = max(1, min(len(coords_src), max_coords // 2))
+    for row_start in range(0, len(coords_src), nb_src):
+        rows = coords_src[row_start:row_start + nb_src]
+        shape = (len(rows), len(coords_dest))
+        if not isinstance(metrics, str):
+            shape = (len(metrics),) + shape
+        band = np.empty(shape)
+        for _, dest_start, values, _, _ in iter_table_blocks(
+                url, api_key, rows, coords_dest, max_coords, metrics):
+            band[..., dest_start:dest_start + values.shape[-1]] = values
+        yield row_start, band
+
+
+def k_nearest_destinations(url, api_key, coords_src, coords_dest, k,
+                           square=False, max_coords=TABLE_MAX_COORDS):
+    """
+    Find the k nearest destinations (by travel time) of every source, band
+    of rows by band of rows, the durations and distances being requested
+    together: memory use depends on the number of sources times k, not on
+    the size of the matrix.
+
+    Params:
+
+    square: bool
+        The destinations are the sources, each source is left out of its
+        own nearest destinations
+
+    Yield
+    -----
+    rows, indices, durations, distances : the source indices of a band and
+    (rows, k) arrays of destination indices (-1 when there are less than k
+    reachable destinations), durations (s) and distances (m)
+    """
+    for row_start, band in iter_table_rows(
+            url, api_key, coords_src, coords_dest, max_coords,
+            ['Durations', 'Distances']):
+        rows = np.arange(row_start, row_start + band.shape[1])
+        indices, durations = k_smallest(
+            band[0], k, exclude=rows if square else None)
+        distances = np.take_along_axis(
+            band[1], np.maximum(indices, 0), axis=1)
+        distances[indices < 0] = np.nan
+        yield rows, indices, durations, distances
+
+
+def nearest_facility(url, api_key, facilities, coords_grid,
+                     max_coords=TABLE_MAX_COORDS):
+    """
+    Find the closest facility (by travel time) of every grid point from a
+    facilities x grid matrix fetched in blocks, keeping only the running
+    minimum and argmin of each grid point.
+
+    Return
+    ------
+    times : travel times in minutes from the closest facility (NaN if none)
+    labels : index of the closest facility (-1 if none)
+    snapped : (n, 2) array of the snapped grid coordinates
+    """
+    nb_pts = len(coords_grid)
+    best = np.full(nb_pts, np.inf)
+    labels = np.full(nb_pts, -1, dtype=int)
+    snapped = np.array(coords_grid, dtype=float)
+    for src_start, dest_start, values, _, snapped_dest in iter_table_blocks(
+            url, api_key, facilities, coords_grid, max_coords):
+        cols = slice(dest_start, dest_start + values.shape[1])
+        snapped[cols] = snapped_dest
+        values = np.where(np.isnan(values), np.inf, values)
+        block_arg = values.argmin(axis=0)
+        block_min = values[block_arg, np.arange(values.shape[1])]
+        better = block_min < best[cols]
+        best[cols] = np.where(better, block_min, best[cols])
+        labels[cols] = np.where(better, block_arg + src_start, labels[cols])
+    best[np.isinf(best)] = np.nan
+    return best / 60.0, labels, snapped
+
+
+def _fetch_blocks(url, api_key, coords_src, coords_dest, blocks, metrics):
+    """Fetch the table of each planned block in threads"""
+    def fetch_block(block):
+        values, _, _ = fetch_table(
+            url, api_key,
+            [coords_src[i] for i in block[0]],
+            [coords_dest[j] for j in block[1]],
+            metrics
+        )
+        return block, values
+
+    with ThreadPool(processes=min(4, len(blocks)) or 1) as pool:
+        yield from pool.imap_unordered(fetch_block, blocks)
+
+
+def fetch_sparse_pairs(url, api_key, coords_src, coords_dest, pairs,
+                       metrics='Durations', max_coords=TABLE_MAX_COORDS):
+    """
+    Fetch the values of a sparse set of (source index, destination index)
+    pairs: the pairs are covered by a few dense blocks (see
+    plan_table_blocks), each one being a single table request, and the
+    values are scattered back to the requested pairs.
+
+    Return
+    ------
+    values of each pair in the order of pairs (NaN if no route), one row
+    per metric if metrics is a list
+    """
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    shape = (len(pairs),)
+    if not isinstance(metrics, str):
+        shape = (len(metrics),) + shape
+    values = np.full(shape, np.nan)
+    max_coords = hinted_max_coords(
+        url, _chain(coords_src, coords_dest), max_coords)
+    blocks = plan_table_blocks(pairs, coords_src, coords_dest, max_coords)
+    for (rows, cols, members), block_values in _fetch_blocks(
+            url, api_key, coords_src, coords_dest, blocks, metrics):
+        values[..., members] = block_values[
+            ...,
+            np.searchsorted(rows, pairs[members, 0]),
+            np.searchsorted(cols, pairs[members, 1])
+        ]
+    return values
+
+
+def closest_destinations(url, api_key, coords_src, coords_dest, k=5,
+                         max_coords=TABLE_MAX_COORDS):
+    """
+    Find the closest destination (by travel time) of every source among its
+    k nearest destinations by straight-line distance: the candidates come
+    from a KD-tree and only the blocks covering the sources with their
+    candidates are requested, instead of the full sources x destinations
+    matrix. The distances are requested along with the durations, the
+    distance of the chosen destination being read from the same block.
+
+    Return
+    ------
+    best : index of the closest destination of each source (-1 if none)
+    times : travel time in seconds (NaN if none)
+    distances : travel distance in meters (NaN if none)
+    """
+    nb_src = len(coords_src)
+    best = np.full(nb_src, -1, dtype=int)
+    times = np.full(nb_src, np.inf)
+    distances = np.full(nb_src, np.nan)
+
+    pairs = candidate_pairs(
+        candidate_destinations(coords_src, coords_dest, k))
+    max_coords = hinted_max_coords(
+        url, _chain(coords_src, coords_dest), max_coords)
+    blocks = plan_table_blocks(pairs, coords_src, coords_dest, max_coords)
+    for (rows, cols, _), (durations, block_distances) in _fetch_blocks(
+            url, api_key, coords_src, coords_dest, blocks,
+            ['Durations', 'Distances']):
+        # Every cell of a block is paid for, not only the candidate ones :
+        durations = np.where(np.isnan(durations), np.inf, durations)
+        block_arg = durations.argmin(axis=1)
+        block_rows = np.arange(len(rows))
+        block_min = durations[block_rows, block_arg]
+        better = block_min < times[rows]
+        times[rows[better]] = block_min[better]
+        best[rows[better]] = cols[block_arg[better]]
+        distances[rows[better]] = block_distances[
+            block_rows[better], block_arg[better]]
+    times[np.isinf(times)] = np.nan
+
+    return best, times, distances
+
+
+def fetch_route_chunks(url, api_key, coords, chunks, steps=False,
+                       profile='detail', annotations=False):
+    """
+    Fetch the route through the coordinates of each chunk of indices (sent
+    as an encoded polyline), the requests running in a few threads
+
+    Params:
 
-def decode_geom_to_pts(encoded_polyline):
+    url: str
+        The start of the url of the route service
+    chunks: list
+        Arrays of indices of the coordinates, in visiting order
+    profile: str
+        The geometry detail to request (see REQUEST_PROFILES)
+    annotations: bool
+        Request the per-segment annotations (see ROUTE_ANNOTATIONS)
+
+    Return
+    ------
+    list of the route object of each chunk, in chunk order
+    """
+    def fetch_chunk(chunk):
+        query = ''.join([
+            url,
+            "polyline(",
+            encode_to_polyline([(coords[i][1], coords[i][0]) for i in chunk]),
+            ")?",
+            profile_query(profile),
+            "&steps=",
+            str(steps).lower(),
+            f"&annotations={ROUTE_ANNOTATIONS}" if annotations else ""
+        ])
+        chunk_coords = [coords[i] for i in chunk]
+        query = add_hints(query, url, chunk_coords, skip_waypoints=True)
+        if api_key:
+            query = ''.join([query, '&api_key=', api_key])
+        parsed_json = _request_service(query, ['routes'], 'route')
+        store_hints(url, chunk_coords, parsed_json)
+        return parsed_json['routes'][0]
+
+    with ThreadPool(processes=min(4, len(chunks))) as pool:
+        return pool.map(fetch_chunk, chunks)
+
+
+def fetch_tour_routes(url, api_key, coords, tour, steps=False,
+                      max_coords=TRIP_MAX_COORDS, profile='detail'):
+    """
+    Fetch the route of a closed tour (indices of the coordinates in visiting
+    order) in chunks of at most max_coords waypoints (see tour_chunks)
+
+    Return
+    ------
+    list of the route object of each chunk, in tour order
+    """
+    return fetch_route_chunks(
+        url, api_key, coords, tour_chunks(tour, max_coords), steps, profile)
+
+
+def fetch_long_route(url, api_key, coords, steps=False,
+                     max_coords=ROUTE_MAX_COORDS, profile='detail',
+                     annotations=False):
+    """
+    Fetch the route through many ordered waypoints: the waypoints are split
+    in overlapping chunks of at most max_coords waypoints (each chunk
+    starting at the last waypoint of the previous one) requested
+    concurrently, and the routes of the chunks are stitched together
+
+    Return
+    ------
+    route object (see stitch_routes)
+    """
+    chunks = tour_chunks(np.arange(len(coords)), max_coords, closed=False)
+    return stitch_routes(
+        fetch_route_chunks(url, api_key, coords, chunks, steps, profile,
+                           annotations),
+        profile_precision(profile))
+
+
+def stitch_routes(routes, precision=5):
+    """
+    Merge the route objects of consecutive chunks into a single route
+    object: encoded geometry of the joined lines (with the given number of
+    decimals), summed duration, distance and weight, and the legs (with
+    their steps) of every chunk in order
+    """
+    points = []
+    for route in routes:
+        chunk_points = decode_geom_to_pts(route['geometry'], precision)
+        points.extend(chunk_points[1:] if points else chunk_points)
+    return {
+        'geometry': encode_to_polyline(
+            [(y, x) for x, y in points], precision),
+        'duration': sum(route['duration'] for route in routes),
+        'distance': sum(route['distance'] for route in routes),
+        'weight': sum(route.get('weight', 0) for route in routes),
+        'legs': [leg for route in routes for leg in route['legs']]
+    }
+
+
+def join_route_chunks(routes, precision=5):
+    """
+    Join the geometries of consecutive route objects (each one starting at
+    the end of the previous one) into a single QgsGeometry
+    """
+    return decode_geom(
+        stitch_routes(routes, precision)['geometry'], precision)
+
+
+def decode_geom_to_pts(encoded_polyline, precision=5):
     """
     Params:
 
     encoded_polyline: str
         The encoded string to decode
+    precision: int
+        The number of decimals of the encoded coordinates (6 for polyline6)
     """
-    return [(i[1], i[0]) for i in PolylineCodec().decode(encoded_polyline)]
+    return [(i[1], i[0])
+            for i in PolylineCodec().decode(encoded_polyline, precision)]
 
 
 @lru_cache(maxsize=25)
@@ -474,15 +1632,7 @@ def make_regular_points(bounds, nb_pts):
     Return a square grid of regular points (same number in height and width
     even if the bbox is not a square).
     """
-    xmin, ymin, xmax, ymax = bounds
-    nb_h = int(round(np.sqrt(nb_pts)))
-    prog_x = [xmin + i * ((xmax - xmin) / nb_h) for i in range(nb_h + 1)]
-    prog_y = [ymin + i * ((ymax - ymin) / nb_h) for i in range(nb_h + 1)]
-    result = []
-    for x in prog_x:
-        for y in prog_y:
-            result.append((x, y))
-    return result
+    return regular_grids(bounds, nb_pts)[0].tolist()
 
 
 def get_search_frame(point, max_time):
@@ -494,25 +1644,8 @@ def get_search_frame(point, max_time):
     ------
     xmin, ymin, xmax, ymax : float
     """
-    search_len = (max_time * 4) * 1000
-    xform = QgsCoordinateTransform(
-        QgsCoordinateReferenceSystem.fromEpsgId(4326),
-        QgsCoordinateReferenceSystem.fromEpsgId(3857),
-        QgsCoordinateTransformContext()
-    )
-    point = xform.transform(QgsPointXY(*point))
-    xmin = point[0] - search_len
-    ymin = point[1] - search_len
-    xmax = point[0] + search_len
-    ymax = point[1] + search_len
-    xform = QgsCoordinateTransform(
-        QgsCoordinateReferenceSystem.fromEpsgId(3857),
-        QgsCoordinateReferenceSystem.fromEpsgId(4326),
-        QgsCoordinateTransformContext()
-    )
-    xmin, ymin = xform.transform(QgsPointXY(xmin, ymin))
-    xmax, ymax = xform.transform(QgsPointXY(xmax, ymax))
-    return xmin, ymin, xmax, ymax
+    frame = search_frames([(point[0], point[1])], max_time)[0]
+    return tuple(float(bound) for bound in frame)
 
 
 def get_isochrones_colors(nb_features):
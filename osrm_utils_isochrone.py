@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ osrm_utils_isochrone
+                                 A QGIS plugin
+ Numerical isochrone functions, free of any QGIS import so that they can
+ run in worker processes
+                             -------------------
+        begin                : 2025-07-15
+        copyright            : (C) 2025 by strues-maps
+        email                : info@strues-maps.lt
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import os
+import sys
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from matplotlib.figure import Figure
+from scipy.interpolate import griddata
+
+__all__ = ['interpolation_grid_shape', 'interpolate_grid', 'contour_rings',
+           'isochrone_rings', 'get_process_pool', 'shutdown_process_pool',
+           'submit_isochrone', 'isochrone_result', 'probe_points',
+           'ground_distances', 'frame_from_probe', 'expand_search_frame',
+           'lonlat_to_mercator', 'mercator_to_lonlat', 'search_frames',
+           'regular_grids', 'nearest_label_grid', 'label_rings',
+           'INTERPOLATION_SIZE', 'INTERPOLATION_MAX_CELLS',
+           'METERS_PER_DEGREE']
+
+INTERPOLATION_SIZE = 200
+INTERPOLATION_MAX_CELLS = 250000
+METERS_PER_DEGREE = 111320.0
+EARTH_RADIUS = 6378137.0
+MERCATOR_MAX_LAT = 85.0511287798
+
+PROBE_DIRECTIONS = 16
+PROBE_FRACTIONS = (0.25, 0.5, 1.0)
+FRAME_MARGIN = 1.2
+FRAME_MIN_REACH = 500.0
+FRAME_EXPANSION = 1.5
+
+_PROCESS_POOL = None
+
+
+def interpolation_grid_shape(bounds, resolution,
+                             max_cells=INTERPOLATION_MAX_CELLS):
+    """
+    Number of columns and rows of a grid whose cells are about `resolution`
+    meters wide over the (lon/lat) bounds, the total number of cells being
+    limited to `max_cells` (the cells are then enlarged evenly).
+
+    Return
+    ------
+    nb_x, nb_y : int
+    """
+    xmin, ymin, xmax, ymax = bounds
+    cos_lat = max(np.cos(np.radians((ymin + ymax) / 2.0)), 1e-6)
+    width = (xmax - xmin) * METERS_PER_DEGREE * cos_lat
+    height = (ymax - ymin) * METERS_PER_DEGREE
+    nb_x = int(np.ceil(width / resolution)) + 1
+    nb_y = int(np.ceil(height / resolution)) + 1
+    if nb_x * nb_y > max_cells:
+        factor = np.sqrt(max_cells / (nb_x * nb_y))
+        nb_x = int(nb_x * factor)
+        nb_y = int(nb_y * factor)
+    return max(nb_x, 2), max(nb_y, 2)
+
+
+def interpolate_grid(times, coords, rev_coords=False, resolution=None,
+                     max_cells=INTERPOLATION_MAX_CELLS, metric=False):
+    """
+    Interpolate route times on a regular grid covering the coordinates
+
+    Params:
+
+    resolution: float or None
+        Target ground size (in meters) of the grid cells, the default
+        grid having 200 x 200 cells whatever the size of the area
+    max_cells: int
+        Upper bound of the number of cells when sizing from a resolution
+    metric: bool
+        Interpolate on a local equirectangular projection (in meters)
+        rather than on raw lon/lat degrees, avoiding triangles stretched
+        along the longitude axis away from the equator
+
+    Return
+    ------
+    xi, yi, zi : the grid axes (lon/lat) and the interpolated times
+    """
+    if not rev_coords:
+        x = coords[..., 0]
+        y = coords[..., 1]
+    else:
+        x = coords[..., 1]
+        y = coords[..., 0]
+    bounds = (np.nanmin(x), np.nanmin(y), np.nanmax(x), np.nanmax(y))
+    if resolution:
+        nb_x, nb_y = interpolation_grid_shape(bounds, resolution, max_cells)
+    else:
+        nb_x, nb_y = INTERPOLATION_SIZE, INTERPOLATION_SIZE
+    xi = np.linspace(bounds[0], bounds[2], nb_x)
+    yi = np.linspace(bounds[1], bounds[3], nb_y)
+    x_grid, y_grid = np.meshgrid(xi, yi)
+
+    if metric:
+        # The local projection is linear on each axis, so the regular
+        # lon/lat grid stays regular once projected
+        x_scale = METERS_PER_DEGREE * np.cos(
+            np.radians((bounds[1] + bounds[3]) / 2.0))
+        y_scale = METERS_PER_DEGREE
+        points = np.column_stack((x * x_scale, y * y_scale))
+        zi = griddata(points, times, (x_grid * x_scale, y_grid * y_scale),
+                      method='linear')
+    else:
+        zi = griddata(np.column_stack((x, y)), times, (x_grid, y_grid),
+                      method='linear')
+    return xi, yi, zi
+
+
+def contour_rings(xi, yi, zi, levels):
+    """
+    Extract the filled contours of a time grid as plain coordinate arrays:
+    for each interval between two levels, the exterior ring of the first
+    polygon (as a (n, 2) array) or None when there is no usable polygon,
+    like qgsgeom_from_mpl_contour does for MatPlotLib contour sets.
+    """
+    v_bnd = np.nanmax(abs(zi))
+    axes = Figure().add_subplot()
+    contour_set = axes.contourf(xi, yi, zi, levels, vmax=v_bnd, vmin=-v_bnd)
+    rings = []
+    for segments in contour_set.allsegs:
+        if len(segments) > 0 and len(segments[0]) > 3:
+            rings.append(np.asarray(segments[0], dtype=float))
+        else:
+            rings.append(None)
+    return rings
+
+
+def isochrone_rings(task):
+    """
+    Worker function interpolating (unless the task already holds a grid)
+    and contouring the times of one isochrone center.
+
+    Params:
+
+    task: dict
+        "times", "coords", "levels", "resolution", "metric" and optionally
+        "grid" (xi, yi, zi)
+
+    Return
+    ------
+    grid, rings : the interpolated grid and the rings of each level
+    """
+    grid = task.get("grid")
+    if grid is None:
+        grid = interpolate_grid(
+            task["times"],
+            task["coords"],
+            resolution=task["resolution"],
+            metric=task["metric"]
+        )
+    return grid, contour_rings(*grid, task["levels"])
+
+
+def nearest_label_grid(xi, yi, coords, labels):
+    """
+    Spread the labels of scattered points (-1 for no label) on the grid
+    axes xi, yi, each cell taking the label of the closest point (distances
+    being measured on a local equirectangular projection).
+    """
+    x_scale = np.cos(np.radians((yi[0] + yi[-1]) / 2.0))
+    x_grid, y_grid = np.meshgrid(xi, yi)
+    points = np.column_stack((coords[:, 0] * x_scale, coords[:, 1]))
+    return griddata(points, labels, (x_grid * x_scale, y_grid),
+                    method='nearest')
+
+
+def label_rings(xi, yi, label_grid, nb_labels):
+    """
+    Contour the area of each label of a label grid: for each label, the
+    list of all its rings as (n, 2) arrays (exterior rings and holes alike,
+    they are told apart by the even-odd rule).
+    """
+    axes = Figure().add_subplot()
+    rings = []
+    for label in range(nb_labels):
+        indicator = (label_grid == label).astype(float)
+        if not indicator.any():
+            rings.append([])
+            continue
+        contour_set = axes.contourf(xi, yi, indicator, (0.5, 1.5))
+        rings.append([
+            np.asarray(segment, dtype=float)
+            for segment in contour_set.allsegs[0] if len(segment) > 3
+        ])
+    return rings
+
+
+def lonlat_to_mercator(lon, lat):
+    """
+    Closed form EPSG:4326 to EPSG:3857 conversion of coordinate arrays
+    (latitudes are clipped to the Web Mercator validity range)
+    """
+    lat = np.clip(np.asarray(lat, dtype=float),
+                  -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT)
+    x = EARTH_RADIUS * np.radians(np.asarray(lon, dtype=float))
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4.0 + np.radians(lat) / 2.0))
+    return x, y
+
+
+def mercator_to_lonlat(x, y):
+    """Closed form EPSG:3857 to EPSG:4326 conversion of coordinate arrays"""
+    lon = np.degrees(np.asarray(x, dtype=float) / EARTH_RADIUS)
+    lat = np.degrees(
+        2.0 * np.arctan(np.exp(np.asarray(y, dtype=float) / EARTH_RADIUS))
+        - np.pi / 2.0
+    )
+    return lon, lat
+
+
+def search_frames(points, max_time):
+    """
+    Search frames (bboxes) of many centers at once: squares of
+    max_time * 4 km half side in Web Mercator around each (lon, lat) point.
+
+    Return
+    ------
+    (n, 4) array of xmin, ymin, xmax, ymax (lon/lat)
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    search_len = (max_time * 4) * 1000
+    x, y = lonlat_to_mercator(points[:, 0], points[:, 1])
+    xmin, ymin = mercator_to_lonlat(x - search_len, y - search_len)
+    xmax, ymax = mercator_to_lonlat(x + search_len, y + search_len)
+    return np.column_stack((xmin, ymin, xmax, ymax))
+
+
+def regular_grids(bounds, nb_pts):
+    """
+    Square grids of regular points in many frames at once (same number of
+    points in height and width even if a frame is not a square), ordered
+    column by column like make_regular_points.
+
+    Return
+    ------
+    (n, m, 2) array of lon/lat coordinates
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    nb_h = int(round(np.sqrt(nb_pts)))
+    steps = np.arange(nb_h + 1) / nb_h
+    prog_x = bounds[:, [0]] + steps * (bounds[:, [2]] - bounds[:, [0]])
+    prog_y = bounds[:, [1]] + steps * (bounds[:, [3]] - bounds[:, [1]])
+    grids = np.empty((len(bounds), nb_h + 1, nb_h + 1, 2))
+    grids[..., 0] = prog_x[:, :, None]
+    grids[..., 1] = prog_y[:, None, :]
+    return grids.reshape(len(bounds), -1, 2)
+
+
+def probe_points(point, radius, nb_directions=PROBE_DIRECTIONS,
+                 fractions=PROBE_FRACTIONS):
+    """
+    Sparse radial sample around a (lon, lat) point: for each of the
+    `nb_directions` bearings, one point at each fraction of `radius`
+    (in meters).
+
+    Return
+    ------
+    bearings : (n,) array of bearings in radians (clockwise from north)
+    coords : (n, 2) array of lon/lat coordinates
+    """
+    lon, lat = float(point[0]), float(point[1])
+    bearings = np.repeat(
+        np.linspace(0.0, 2.0 * np.pi, nb_directions, endpoint=False),
+        len(fractions)
+    )
+    distances = np.tile(np.asarray(fractions, dtype=float) * radius,
+                        nb_directions)
+    x_scale = METERS_PER_DEGREE * max(np.cos(np.radians(lat)), 1e-6)
+    coords = np.column_stack((
+        lon + distances * np.sin(bearings) / x_scale,
+        lat + distances * np.cos(bearings) / METERS_PER_DEGREE
+    ))
+    return bearings, coords
+
+
+def ground_distances(point, coords):
+    """Approximate ground distances (in meters) from a point to coords"""
+    lat = float(point[1])
+    x_scale = METERS_PER_DEGREE * max(np.cos(np.radians(lat)), 1e-6)
+    coords = np.asarray(coords, dtype=float)
+    return np.hypot((coords[:, 0] - float(point[0])) * x_scale,
+                    (coords[:, 1] - lat) * METERS_PER_DEGREE)
+
+
+def frame_from_probe(point, bearings, distances, times, max_time,
+                     nb_directions=PROBE_DIRECTIONS, margin=FRAME_MARGIN):
+    """
+    Size the search frame from a probe made with probe_points: the
+    effective speed in each direction is the best distance / time ratio
+    of its probes, and the frame is the bbox of the distances reachable in
+    `max_time` at these speeds (directions without any routable probe use
+    the median speed of the other ones).
+
+    Return
+    ------
+    xmin, ymin, xmax, ymax : float, or None when no probe was routable
+    """
+    times = np.asarray(times, dtype=float)
+    valid = np.isfinite(times) & (times > 0)
+    speeds = np.full(times.shape, -np.inf)
+    speeds[valid] = np.asarray(distances, dtype=float)[valid] / times[valid]
+    speeds = speeds.reshape(nb_directions, -1).max(axis=1)
+    if not np.isfinite(speeds).any():
+        return None
+    speeds[~np.isfinite(speeds)] = np.median(speeds[np.isfinite(speeds)])
+
+    reach = np.maximum(speeds * max_time * margin, FRAME_MIN_REACH)
+    directions = bearings.reshape(nb_directions, -1)[:, 0]
+    lon, lat = float(point[0]), float(point[1])
+    x_scale = METERS_PER_DEGREE * max(np.cos(np.radians(lat)), 1e-6)
+    dx = reach * np.sin(directions) / x_scale
+    dy = reach * np.cos(directions) / METERS_PER_DEGREE
+    return (lon + min(dx.min(), 0.0), lat + min(dy.min(), 0.0),
+            lon + max(dx.max(), 0.0), lat + max(dy.max(), 0.0))
+
+
+def expand_search_frame(point, bounds, coords, times, max_time,
+                        factor=FRAME_EXPANSION):
+    """
+    Enlarge (away from the center point) each side of the search frame
+    along which grid points are still reached in less than `max_time`,
+    since the isochrones would otherwise be clipped by the frame.
+
+    Return
+    ------
+    xmin, ymin, xmax, ymax : float, or None when no side needs it
+    """
+    xmin, ymin, xmax, ymax = bounds
+    coords = np.asarray(coords, dtype=float)
+    times = np.asarray(times, dtype=float)
+    reachable = np.isfinite(times) & (times < max_time)
+    tol_x = (xmax - xmin) * 1e-6
+    tol_y = (ymax - ymin) * 1e-6
+    lon, lat = float(point[0]), float(point[1])
+    sides = (
+        reachable & (coords[:, 0] <= xmin + tol_x),
+        reachable & (coords[:, 1] <= ymin + tol_y),
+        reachable & (coords[:, 0] >= xmax - tol_x),
+        reachable & (coords[:, 1] >= ymax - tol_y)
+    )
+    if not any(side.any() for side in sides):
+        return None
+    if sides[0].any():
+        xmin = lon - (lon - xmin) * factor
+    if sides[1].any():
+        ymin = lat - (lat - ymin) * factor
+    if sides[2].any():
+        xmax = lon + (xmax - lon) * factor
+    if sides[3].any():
+        ymax = lat + (ymax - lat) * factor
+    return xmin, ymin, xmax, ymax
+
+
+def _python_executable():
+    """
+    Path of a python interpreter able to start worker processes (inside
+    QGIS, sys.executable is the QGIS application itself), or None
+    """
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    if sys.platform == 'win32':
+        candidates = [
+            os.path.join(sys.exec_prefix, 'pythonw.exe'),
+            os.path.join(sys.exec_prefix, 'python.exe')
+        ]
+    else:
+        version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        candidates = [
+            os.path.join(sys.exec_prefix, 'bin', f"python{version}"),
+            os.path.join(sys.exec_prefix, 'bin', 'python3')
+        ]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def get_process_pool():
+    """
+    Return the (lazily started) pool of worker processes shared by the
+    plugin, or None when no python interpreter is available to run them.
+    Workers are spawned, never forked, since forking the QGIS process is
+    not safe.
+    """
+    global _PROCESS_POOL  # pylint: disable=global-statement
+    if _PROCESS_POOL is None:
+        executable = _python_executable()
+        if executable is None:
+            return None
+        context = multiprocessing.get_context('spawn')
+        context.set_executable(executable)
+        _PROCESS_POOL = ProcessPoolExecutor(
+            max_workers=max((os.cpu_count() or 2) - 1, 1),
+            mp_context=context
+        )
+    return _PROCESS_POOL
+
+
+def shutdown_process_pool():
+    """Stop the worker processes, if any were started"""
+    global _PROCESS_POOL  # pylint: disable=global-statement
+    if _PROCESS_POOL is not None:
+        _PROCESS_POOL.shutdown(wait=False, cancel_futures=True)
+        _PROCESS_POOL = None
+
+
+def submit_isochrone(task, use_processes=True, executor=None):
+    """
+    Submit an isochrone_rings task to the worker processes. When processes
+    are not wanted or not available, the task runs on executor if given
+    (keeping the calling thread responsive), or right away otherwise.
+
+    Return
+    ------
+    A concurrent.futures.Future of the isochrone_rings result
+    """
+    process_pool = get_process_pool() if use_processes else None
+    if process_pool is not None:
+        try:
+            return process_pool.submit(isochrone_rings, task)
+        except (BrokenProcessPool, RuntimeError):
+            shutdown_process_pool()
+    if executor is not None:
+        return executor.submit(isochrone_rings, task)
+    future = Future()
+    try:
+        future.set_result(isochrone_rings(task))
+    except ValueError as err:
+        future.set_exception(err)
+    return future
+
+
+def isochrone_result(future, task):
+    """
+    Result of a task submitted with submit_isochrone, computed again in
+    this process if the worker processes could not run it
+    """
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        shutdown_process_pool()
+        return isochrone_rings(task)
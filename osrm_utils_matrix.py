@@ -0,0 +1,701 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ osrm_utils_matrix
+                                 A QGIS plugin
+ Planning of blocked and sparse table requests, free of any QGIS import
+                             -------------------
+        begin                : 2025-07-15
+        copyright            : (C) 2025 by strues-maps
+        email                : info@strues-maps.lt
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import csv
+import io
+import os
+import re
+import tempfile
+import numpy as np
+from scipy.spatial import cKDTree
+
+__all__ = ['local_xy', 'candidate_destinations', 'morton_order',
+           'plan_table_blocks', 'candidate_pairs', 'k_smallest',
+           'MatrixStore', 'quote_csv_ids', 'write_matrix_csv',
+           'save_matrices_npz', 'MatrixSession', 'remove_leftover_stores',
+           'TABLE_MAX_COORDS', 'UINT32_UNREACHABLE']
+
+# Default maximum number of locations of an OSRM table request
+# (osrm-routed --max-table-size)
+TABLE_MAX_COORDS = 100
+
+# Value of the unreachable cells of an uint32 MatrixStore
+UINT32_UNREACHABLE = np.uint32(0xFFFFFFFF)
+
+# Number of rows read at once from a MatrixStore
+MATRIX_ROWS_CHUNK = 1024
+# Temporary files of the closed MatrixStore which could not be removed yet
+# (still mapped by a view of the matrix on Windows)
+LEFTOVER_STORE_FILES = set()
+
+# Number of cells requested at once to update a MatrixSession
+SESSION_BLOCK_CELLS = 1 << 20
+
+# Number of cells of the blocks of rows read and formatted by the csv writer
+CSV_BLOCK_CELLS = 1 << 18
+# Buffer size of the csv output file
+CSV_BUFFER_SIZE = 1 << 20
+# Values given to np.savetxt for the unreachable cells of the integer
+# columns and for the dropped cells, and the text they are replaced with
+CSV_INT_UNREACHABLE = -1
+CSV_DROPPED = np.inf
+CSV_DROPPED_TOKEN = re.compile(r'(?<![^,\n])(?:-2|inf)(?![^,\n])')
+CSV_UNREACHABLE_TOKEN = re.compile(r'(?<![^,\n])-1(?![^,\n])')
+
+
+def local_xy(coords, lat0):
+    """
+    Project lon/lat coordinates on a local equirectangular plane (in
+    degrees of latitude) so that straight-line distances can be compared
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    return np.column_stack(
+        (coords[:, 0] * np.cos(np.radians(lat0)), coords[:, 1]))
+
+
+def candidate_destinations(coords_src, coords_dest, k):
+    """
+    Indices of the k destinations closest to each source by straight-line
+    distance, found with a KD-tree
+
+    Return
+    ------
+    (n, k) array of destination indices, nearest first
+    """
+    coords_src = np.asarray(coords_src, dtype=float).reshape(-1, 2)
+    coords_dest = np.asarray(coords_dest, dtype=float).reshape(-1, 2)
+    lat0 = np.mean(coords_dest[:, 1])
+    k = max(1, min(k, len(coords_dest)))
+    tree = cKDTree(local_xy(coords_dest, lat0))
+    _, candidates = tree.query(local_xy(coords_src, lat0), k=k)
+    return np.asarray(candidates, dtype=int).reshape(len(coords_src), k)
+
+
+def candidate_pairs(candidates):
+    """(source, destination) pairs of a (n, k) candidate index array"""
+    candidates = np.asarray(candidates, dtype=int)
+    return np.column_stack((
+        np.repeat(np.arange(len(candidates)), candidates.shape[1]),
+        candidates.ravel()
+    ))
+
+
+def _part1by1(values):
+    """Spread the 16 low bits of integers to the even bits"""
+    values = values & 0x0000ffff
+    values = (values | (values << 8)) & 0x00ff00ff
+    values = (values | (values << 4)) & 0x0f0f0f0f
+    values = (values | (values << 2)) & 0x33333333
+    values = (values | (values << 1)) & 0x55555555
+    return values
+
+
+def morton_order(coords):
+    """
+    Rank of each lon/lat coordinate along a Z-order (Morton) curve, so that
+    close ranks are spatially close
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return np.zeros(0, dtype=int)
+    mins = coords.min(axis=0)
+    spans = np.maximum(coords.max(axis=0) - mins, 1e-12)
+    cells = ((coords - mins) / spans * 65535).astype(np.int64)
+    codes = _part1by1(cells[:, 0]) | (_part1by1(cells[:, 1]) << 1)
+    ranks = np.empty(len(coords), dtype=int)
+    ranks[np.argsort(codes, kind='stable')] = np.arange(len(coords))
+    return ranks
+
+
+def plan_table_blocks(pairs, coords_src, coords_dest,
+                      max_coords=TABLE_MAX_COORDS):
+    """
+    Cover a sparse set of (source, destination) index pairs with a few
+    dense sources x destinations blocks of at most max_coords locations.
+
+    The destinations of each source are split in chunks of at most half a
+    block (in Z-order), the chunks are ordered by their first destination
+    then by source, both in Z-order, so that spatially close sources
+    sharing destinations follow each other, and they are packed greedily
+    in blocks (bicliques) as long as the block stays within max_coords.
+
+    Return
+    ------
+    list of (sources, destinations, pair indices) arrays: the sorted
+    source and destination indices of each block, and the indices (in
+    pairs) of the pairs it covers, each pair being covered once
+    """
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    if len(pairs) == 0:
+        return []
+    src_rank = morton_order(coords_src)
+    dest_rank = morton_order(coords_dest)
+    chunk_size = max(1, max_coords // 2)
+
+    order = np.lexsort((dest_rank[pairs[:, 1]], src_rank[pairs[:, 0]]))
+    chunks = []
+    start = 0
+    while start < len(order):
+        src = pairs[order[start], 0]
+        end = start + 1
+        while end < len(order) and end - start < chunk_size \
+                and pairs[order[end], 0] == src:
+            end += 1
+        chunks.append(order[start:end])
+        start = end
+    chunks.sort(key=lambda chunk: (
+        dest_rank[pairs[chunk[0], 1]], src_rank[pairs[chunk[0], 0]]))
+
+    blocks = []
+    rows, cols, members = set(), set(), []
+    for chunk in chunks:
+        new_rows = rows | {int(pairs[chunk[0], 0])}
+        new_cols = cols.union(pairs[chunk, 1].tolist())
+        if members and len(new_rows) + len(new_cols) > max_coords:
+            blocks.append((
+                np.array(sorted(rows)), np.array(sorted(cols)),
+                np.concatenate(members)
+            ))
+            rows, cols, members = set(), set(), []
+            new_rows = {int(pairs[chunk[0], 0])}
+            new_cols = set(pairs[chunk, 1].tolist())
+        rows, cols = new_rows, new_cols
+        members.append(chunk)
+    blocks.append((
+        np.array(sorted(rows)), np.array(sorted(cols)),
+        np.concatenate(members)
+    ))
+    return blocks
+
+
+def k_smallest(values, k, exclude=None):
+    """
+    Column indices and values of the k smallest values of each row, sorted,
+    found with np.argpartition (NaN values are never selected).
+
+    Params:
+
+    exclude: array or None
+        Column index to leave out in each row (for instance the diagonal of
+        a square matrix)
+
+    Return
+    ------
+    indices, values : (n, k) arrays, padded with -1 and NaN for the rows
+    having less than k values
+    """
+    values = np.where(np.isnan(values), np.inf, values)
+    if exclude is not None:
+        values[np.arange(len(values)), exclude] = np.inf
+    k = max(1, min(k, values.shape[1]))
+    part = np.argpartition(values, k - 1, axis=1)[:, :k]
+    part_values = np.take_along_axis(values, part, axis=1)
+    order = np.argsort(part_values, axis=1, kind='stable')
+    indices = np.take_along_axis(part, order, axis=1)
+    smallest = np.take_along_axis(part_values, order, axis=1)
+    missing = np.isinf(smallest)
+    indices[missing] = -1
+    smallest[missing] = np.nan
+    return indices, smallest
+
+
+class MatrixStore:
+    """
+    Sources x destinations matrix backed by a memory-mapped temporary file,
+    written block by block as the table requests complete, so that matrices
+    larger than the memory can be assembled and exported.
+
+    Params:
+
+    shape: (int, int)
+        Number of sources and destinations
+    dtype: str
+        'float32' or 'float64' (unreachable cells are NaN) or 'uint32'
+        (values rounded to integers, unreachable cells are
+        UINT32_UNREACHABLE)
+    directory: str or None
+        Directory of the temporary file (the system default if None)
+    """
+    def __init__(self, shape, dtype='float32', directory=None):
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.dtype('float32'), np.dtype('float64'),
+                              np.dtype('uint32')):
+            raise ValueError(f"Unsupported matrix storage type {dtype}")
+        self.shape = tuple(shape)
+        handle, self.path = tempfile.mkstemp(suffix='.dat', dir=directory)
+        os.close(handle)
+        self.array = np.memmap(
+            self.path, dtype=self.dtype, mode='w+',
+            shape=(max(self.shape[0], 1), max(self.shape[1], 1))
+        )
+        for start in range(0, self.shape[0], MATRIX_ROWS_CHUNK):
+            self.array[start:start + MATRIX_ROWS_CHUNK] = self.unreachable
+
+    @property
+    def unreachable(self):
+        """Stored value of the unreachable cells"""
+        if self.dtype == np.dtype('uint32'):
+            return UINT32_UNREACHABLE
+        return np.float32(np.nan)
+
+    def encode(self, values):
+        """Convert float values (NaN if unreachable) to the storage type"""
+        values = np.asarray(values, dtype=float)
+        if self.dtype != np.dtype('uint32'):
+            return values.astype(self.dtype)
+        encoded = np.full(values.shape, UINT32_UNREACHABLE, dtype=np.uint32)
+        valid = np.isfinite(values) & (values >= 0)
+        encoded[valid] = np.minimum(
+            np.rint(values[valid]), int(UINT32_UNREACHABLE) - 1)
+        return encoded
+
+    def decode(self, block):
+        """Convert stored values to floats, NaN for the unreachable cells"""
+        if self.dtype != np.dtype('uint32'):
+            return np.array(block, dtype=float)
+        decoded = np.asarray(block, dtype=float)
+        decoded[block == UINT32_UNREACHABLE] = np.nan
+        return decoded
+
+    def write_block(self, row_start, col_start, values):
+        """Store a block of float values at the given position"""
+        values = np.asarray(values)
+        self.array[row_start:row_start + values.shape[0],
+                   col_start:col_start + values.shape[1]] = \
+            self.encode(values)
+
+    def write_cells(self, rows, cols, values):
+        """
+        Store a block of float values at the crossing of the given rows and
+        columns (arrays of indices, not necessarily contiguous)
+        """
+        self.array[np.asarray(rows)[:, None], np.asarray(cols)] = \
+            self.encode(values)
+
+    def read_cells(self, rows, cols):
+        """Decoded values at the crossing of the given rows and columns"""
+        return self.decode(
+            self.array[np.asarray(rows)[:, None], np.asarray(cols)])
+
+    def iter_rows(self, nb_rows=MATRIX_ROWS_CHUNK):
+        """
+        Read the matrix back by bands of rows
+
+        Yield
+        -----
+        row_start, band : index of the first row and the decoded band
+        """
+        for start in range(0, self.shape[0], nb_rows):
+            yield start, self.decode(
+                self.array[start:start + nb_rows, :self.shape[1]])
+
+    def save_npy(self, filename):
+        """Export the stored matrix as a .npy file, by bands of rows"""
+        self.array.flush()
+        output = np.lib.format.open_memmap(
+            filename, mode='w+', dtype=self.dtype, shape=self.shape)
+        for start in range(0, self.shape[0], MATRIX_ROWS_CHUNK):
+            output[start:start + MATRIX_ROWS_CHUNK] = \
+                self.array[start:start + MATRIX_ROWS_CHUNK, :self.shape[1]]
+        output.flush()
+        del output
+
+    def save_npz(self, filename, ids_src, ids_dest):
+        """
+        Export the stored matrix as a compressed .npz archive holding the
+        "matrix", "origins" and "destinations" arrays
+        """
+        save_matrices_npz(filename, {"matrix": self}, ids_src, ids_dest)
+
+    @staticmethod
+    def save_ids(filename, ids_src, ids_dest, encoding='utf-8'):
+        """
+        Write the origin and destination ids, in the row and column order
+        of the matrix, to .csv sidecar files next to filename
+
+        Return
+        ------
+        the names of the two sidecar files
+        """
+        base = os.path.splitext(filename)[0]
+        names = (f"{base}_origins.csv", f"{base}_destinations.csv")
+        for name, ids in zip(names, (ids_src, ids_dest)):
+            with open(name, 'w', encoding=encoding, newline='') as out_file:
+                writer = csv.writer(out_file, lineterminator='\n')
+                writer.writerow(['index', 'id'])
+                writer.writerows(enumerate(ids))
+        return names
+
+    def close(self):
+        """
+        Release the memory map and remove its temporary file, the file
+        being kept in LEFTOVER_STORE_FILES when it cannot be removed yet
+        (see remove_leftover_stores)
+        """
+        mapping = getattr(self.array, '_mmap', None)
+        self.array = None
+        if mapping is not None:
+            try:
+                mapping.close()
+            except BufferError:
+                # Views of the matrix are still alive, the mapping is
+                # released with the last of them
+                pass
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            LEFTOVER_STORE_FILES.add(self.path)
+
+
+def remove_leftover_stores():
+    """
+    Remove the temporary files of the closed MatrixStore which could not be
+    removed when they were closed
+
+    Return
+    ------
+    list of the files which still cannot be removed
+    """
+    for path in list(LEFTOVER_STORE_FILES):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            continue
+        LEFTOVER_STORE_FILES.discard(path)
+    return sorted(LEFTOVER_STORE_FILES)
+
+
+def save_matrices_npz(filename, stores, ids_src, ids_dest):
+    """
+    Export several stored matrices of the same origins and destinations
+    (a dict of name: MatrixStore) in a compressed .npz archive, with the
+    "origins" and "destinations" arrays (NumPy writes the matrices by
+    buffered chunks)
+    """
+    arrays = {}
+    for name, store in stores.items():
+        store.array.flush()
+        arrays[name] = store.array[:store.shape[0], :store.shape[1]]
+    np.savez_compressed(
+        filename,
+        origins=_ids_array(ids_src),
+        destinations=_ids_array(ids_dest),
+        **arrays
+    )
+
+
+def _ids_array(ids):
+    """Ids as a NumPy array that does not need pickling"""
+    ids = np.asarray(ids)
+    if ids.dtype == object:
+        ids = ids.astype(str)
+    return ids
+
+
+def quote_csv_ids(ids):
+    """Ids as strings, quoted once for all like csv.writer would do"""
+    quoted = []
+    for _id in ids:
+        text = str(_id)
+        if any(char in text for char in ',"\r\n'):
+            text = '"' + text.replace('"', '""') + '"'
+        quoted.append(text)
+    return quoted
+
+
+def csv_value_format(dtype, decimals=2):
+    """Numeric format of the values of a MatrixStore of the given dtype"""
+    if np.dtype(dtype) == np.dtype('uint32'):
+        return '%d'
+    return f'%.{decimals}f'
+
+
+def format_csv_rows(values, formats, dropped=None):
+    """
+    Format a block of rows of float values with np.savetxt, with one
+    numeric format per column (see csv_value_format): the unreachable
+    (NaN) cells are written 'nan' and the dropped cells are left empty.
+    np.savetxt still loops over the rows in Python, each row being
+    formatted by a single % operation on a row format (faster than
+    np.char.mod, which formats cell by cell)
+
+    Return
+    ------
+    list of the formatted rows (without line ends)
+    """
+    values = np.array(values, dtype=float)
+    if values.size == 0:
+        return [''] * len(values)
+    integer = np.array([fmt == '%d' for fmt in formats])
+    unreachable = np.isnan(values[:, integer])
+    values[:, integer] = np.where(
+        unreachable, CSV_INT_UNREACHABLE, values[:, integer])
+    has_dropped = dropped is not None and dropped.any()
+    if has_dropped:
+        values[dropped] = CSV_DROPPED
+        values[:, integer] = np.where(
+            np.isinf(values[:, integer]), -2, values[:, integer])
+    buffer = io.StringIO()
+    np.savetxt(buffer, values, fmt=formats, delimiter=',')
+    text = buffer.getvalue()
+    # The replacements only run on the blocks holding such cells
+    if has_dropped:
+        text = CSV_DROPPED_TOKEN.sub('', text)
+    if unreachable.any():
+        text = CSV_UNREACHABLE_TOKEN.sub('nan', text)
+    return text.split('\n')[:-1]
+
+
+def write_matrix_csv(filename, store, ids_src, ids_dest, flatten=False,
+                     header='Time', encoding='utf-8', max_value=None,
+                     drop_unreachable=False, decimals=2, others=None,
+                     speed_factor=None):
+    """
+    Stream the matrix of a MatrixStore to a .csv file, block of rows by
+    block of rows: the rows of each block are formatted by np.savetxt (one
+    % operation per row, see format_csv_rows) with a numeric format chosen
+    from the storage type (integers for uint32 stores), the ids being
+    quoted only once, to a buffered file, so that memory use does not
+    depend on the size of the matrix.
+
+    Params:
+
+    flatten: bool
+        Write one (origin, destination, value) row per cell rather than
+        the matrix with the destination ids as header
+    header: str or list
+        Name of the value column(s) of the flattened rows
+    max_value: float or None
+        Drop the cells whose value is over max_value
+    drop_unreachable: bool
+        Drop the unreachable (NaN) cells
+    decimals: int
+        Decimals of the float values (drops the float32 storage noise)
+    others: list or None
+        Other MatrixStore of the same shape whose values are written in
+        the next columns of the flattened rows (durations and distances)
+    speed_factor: float or None
+        Add a last column to the flattened rows with the speed, the value
+        of the first of the others stores divided by the value of the
+        store and multiplied by speed_factor
+
+    The dropped cells (tested on the values of the store) are left empty
+    in the matrix and left out of the flattened rows.
+    """
+    src_q = np.array(quote_csv_ids(ids_src), dtype=object)
+    dest_q = np.array(quote_csv_ids(ids_dest), dtype=object)
+    nb_cols = max(len(dest_q), 1)
+    others = others or []
+    headers = [header] if isinstance(header, str) else list(header)
+    formats = [csv_value_format(item.dtype, decimals)
+               for item in [store] + others]
+    if speed_factor is not None:
+        headers.append('Speed')
+        formats.append(f'%.{decimals}f')
+    nb_rows = max(1, CSV_BLOCK_CELLS // nb_cols)
+    with open(filename, 'w', encoding=encoding, newline='',
+              buffering=CSV_BUFFER_SIZE) as out_file:
+        if flatten:
+            out_file.write(
+                ','.join(['Origin', 'Destination'] + headers) + '\n')
+        else:
+            out_file.write(','.join([''] + dest_q.tolist()) + '\n')
+        other_rows = [other.iter_rows(nb_rows) for other in others]
+        for start, band in store.iter_rows(nb_rows):
+            other_bands = [next(rows)[1] for rows in other_rows]
+            if speed_factor is not None:
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    speed = other_bands[0] / band * speed_factor
+                speed[~np.isfinite(speed)] = np.nan
+                other_bands.append(speed)
+            band = band.round(decimals)
+            other_bands = [other.round(decimals) for other in other_bands]
+            dropped = np.zeros(band.shape, dtype=bool)
+            if drop_unreachable:
+                dropped |= np.isnan(band)
+            if max_value is not None:
+                with np.errstate(invalid='ignore'):
+                    dropped |= band > max_value
+            rows = src_q[start:start + len(band)]
+            if flatten:
+                row_idx, col_idx = np.nonzero(~dropped)
+                lines = format_csv_rows(
+                    np.column_stack([
+                        values[row_idx, col_idx]
+                        for values in [band] + other_bands
+                    ]),
+                    formats)
+                prefixes = rows[row_idx] + ',' + dest_q[col_idx]
+            else:
+                lines = format_csv_rows(
+                    band, [formats[0]] * band.shape[1], dropped)
+                prefixes = rows
+            out_file.write(''.join([
+                f"{prefix},{line}\n"
+                for prefix, line in zip(prefixes.tolist(), lines)
+            ]))
+
+
+class MatrixSession:
+    """
+    Matrix between two sets of features kept across runs: the sources and
+    destinations are identified by their feature ids, and after edits of
+    the layers only the rows and columns of the added or moved features
+    are requested again, the values of the others being reused. The values
+    are kept in float64 MatrixStore (one per metric, so that the reused
+    values are the requested ones) and moved by bands, so that large
+    tables are never held in memory.
+
+    Params:
+
+    key: tuple
+        Identifies what the matrix is about (url, layers, metrics...), a
+        session is only reused for the same key
+    nb_metrics: int
+        Number of metrics of the matrix
+    directory: str or None
+        Directory of the temporary files of the stores
+    """
+    def __init__(self, key, nb_metrics=1, directory=None):
+        self.key = key
+        self.nb_metrics = nb_metrics
+        self.directory = directory
+        self.src_fids = None
+        self.src_coords = None
+        self.dest_fids = None
+        self.dest_coords = None
+        self.stores = None
+
+    @staticmethod
+    def _kept(old_fids, old_coords, fids, coords):
+        """
+        Indices (in the new and in the old sets) of the features whose id
+        and coordinates did not change
+        """
+        old_index = {fid: i for i, fid in enumerate(old_fids.tolist())}
+        new_idx, old_idx = [], []
+        for i, fid in enumerate(fids.tolist()):
+            j = old_index.get(fid)
+            if j is not None and np.array_equal(coords[i], old_coords[j]):
+                new_idx.append(i)
+                old_idx.append(j)
+        return np.array(new_idx, dtype=int), np.array(old_idx, dtype=int)
+
+    @staticmethod
+    def _row_chunks(rows, nb_cols):
+        """Split row indices in chunks of about SESSION_BLOCK_CELLS cells"""
+        step = max(1, SESSION_BLOCK_CELLS // max(nb_cols, 1))
+        for start in range(0, len(rows), step):
+            yield start, rows[start:start + step]
+
+    def _fetch_into(self, stores, rows, cols, fetch):
+        """Request the values of the given rows and columns, by chunks"""
+        if len(rows) == 0 or len(cols) == 0:
+            return 0
+        for _, chunk in self._row_chunks(rows, len(cols)):
+            values = fetch(chunk, cols)
+            for store, metric_values in zip(stores, values):
+                store.write_cells(chunk, cols, metric_values)
+        return len(rows) * len(cols)
+
+    def update(self, src_fids, src_coords, dest_fids, dest_coords, fetch):
+        """
+        Bring the matrix up to date with the current features
+
+        Params:
+
+        fetch: callable
+            fetch(rows, cols) returns the (metrics, rows, cols) array of
+            values between the sources and destinations of the given
+            indices (in the current sets)
+
+        Return
+        ------
+        nb_cells : number of cells requested for this update
+        """
+        src_fids = np.asarray(src_fids)
+        dest_fids = np.asarray(dest_fids)
+        src_coords = np.asarray(src_coords, dtype=float).reshape(-1, 2)
+        dest_coords = np.asarray(dest_coords, dtype=float).reshape(-1, 2)
+        all_rows = np.arange(len(src_fids))
+        all_cols = np.arange(len(dest_fids))
+
+        stores = [
+            MatrixStore((len(src_fids), len(dest_fids)), 'float64',
+                        self.directory)
+            for _ in range(self.nb_metrics)
+        ]
+        try:
+            if self.stores is None:
+                nb_cells = self._fetch_into(stores, all_rows, all_cols, fetch)
+            else:
+                rows_new, rows_old = self._kept(
+                    self.src_fids, self.src_coords, src_fids, src_coords)
+                cols_new, cols_old = self._kept(
+                    self.dest_fids, self.dest_coords, dest_fids,
+                    dest_coords)
+                if len(cols_new) > 0:
+                    for start, chunk in self._row_chunks(
+                            rows_new, len(cols_new)):
+                        old_chunk = rows_old[start:start + len(chunk)]
+                        for store, old_store in zip(stores, self.stores):
+                            store.write_cells(
+                                chunk, cols_new,
+                                old_store.read_cells(old_chunk, cols_old))
+                nb_cells = self._fetch_into(
+                    stores, np.setdiff1d(all_rows, rows_new), all_cols,
+                    fetch)
+                nb_cells += self._fetch_into(
+                    stores, rows_new, np.setdiff1d(all_cols, cols_new),
+                    fetch)
+        except Exception:
+            for store in stores:
+                store.close()
+            raise
+
+        self.close()
+        self.src_fids, self.src_coords = src_fids, src_coords
+        self.dest_fids, self.dest_coords = dest_fids, dest_coords
+        self.stores = stores
+        return nb_cells
+
+    def iter_blocks(self, nb_rows=MATRIX_ROWS_CHUNK):
+        """
+        Read the kept values back by bands of rows
+
+        Yield
+        -----
+        row_start, 0, values : index of the first row of the band (all
+        columns) and its (metrics, rows, destinations) values
+        """
+        bands = [store.iter_rows(nb_rows) for store in self.stores]
+        for items in zip(*bands):
+            yield items[0][0], 0, np.stack([band for _, band in items])
+
+    def close(self):
+        """Release the stores of the session"""
+        for store in self.stores or []:
+            store.close()
+        self.stores = None
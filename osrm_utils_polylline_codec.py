@@ -33,13 +33,17 @@ class PolylineCodec:
             comp = result & 1
         return ~(result >> 1) if comp else (result >> 1), index
 
-    def decode(self, expression):
-        """Decode a polyline string into a set of coordinates."""
+    def decode(self, expression, precision=5):
+        """
+        Decode a polyline string (with coordinates encoded with the given
+        number of decimals) into a set of coordinates.
+        """
+        factor = 10 ** precision
         coordinates, index, lat, lng, length = [], 0, 0, 0, len(expression)
         while index < length:
             lat_change, index = self._trans(expression, index)
             lng_change, index = self._trans(expression, index)
             lat += lat_change
             lng += lng_change
-            coordinates.append((lat / 1e5, lng / 1e5))
+            coordinates.append((lat / factor, lng / factor))
         return coordinates
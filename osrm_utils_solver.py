@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ osrm_utils_solver
+                                 A QGIS plugin
+ Local traveling salesman heuristics on table matrices, free of any QGIS
+ import
+                             -------------------
+        begin                : 2025-07-15
+        copyright            : (C) 2025 by strues-maps
+        email                : info@strues-maps.lt
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import time
+import numpy as np
+from scipy.cluster.vq import kmeans2
+from scipy.spatial import cKDTree
+from .osrm_utils_matrix import local_xy
+
+__all__ = ['path_cost', 'nearest_neighbour_path', 'two_opt_move',
+           'or_opt_move', 'improve_path', 'solve_path', 'cluster_stops',
+           'solve_large_tsp', 'tour_chunks', 'savings_routes',
+           'improve_routes', 'relocate_move', 'solve_vrp',
+           'TRIP_MAX_COORDS', 'SOLVER_CLUSTER_SIZE', 'VRP_TIME_BUDGET']
+
+# Default maximum number of locations of an OSRM trip request
+# (osrm-routed --max-trip-size)
+TRIP_MAX_COORDS = 100
+
+# Maximum number of stops of a cluster solved on its own matrix
+SOLVER_CLUSTER_SIZE = 200
+
+# Maximum length of the segments moved by Or-opt
+OR_OPT_MAX_SEGMENT = 3
+
+# Smallest improvement applied by the local search
+SOLVER_EPSILON = 1e-6
+
+# Number of best savings kept per stop by the savings heuristic
+VRP_SAVINGS_NEIGHBOURS = 300
+
+# Default time budget (in seconds) of the vehicle routing local search
+VRP_TIME_BUDGET = 60
+
+
+def _costs(matrix):
+    """Duration matrix with the unreachable (NaN) cells heavily penalized"""
+    matrix = np.array(matrix, dtype=float)
+    finite = np.isfinite(matrix)
+    penalty = (matrix[finite].max() + 1) * len(matrix) if finite.any() else 1
+    matrix[~finite] = penalty
+    return matrix
+
+
+def path_cost(matrix, path):
+    """Sum of the matrix cells along a path of indices"""
+    path = np.asarray(path, dtype=int)
+    return float(matrix[path[:-1], path[1:]].sum())
+
+
+def nearest_neighbour_path(matrix, start, end):
+    """
+    Path from start to end (a closed tour if end is start) visiting every
+    index of the matrix, always going to the nearest unvisited index
+    """
+    visited = np.zeros(len(matrix), dtype=bool)
+    visited[[start, end]] = True
+    path = [start]
+    current = start
+    for _ in range(len(matrix) - int(visited.sum())):
+        current = int(np.where(visited, np.inf, matrix[current]).argmin())
+        visited[current] = True
+        path.append(current)
+    path.append(end)
+    return np.array(path, dtype=int)
+
+
+def two_opt_move(matrix, path):
+    """
+    Best 2-opt move of a path with fixed ends: the reversal of
+    path[i + 1:j + 1] with the largest decrease of the path cost, the
+    matrix being possibly asymmetric (the reversed segment is costed
+    backward through cumulative sums)
+
+    Return
+    ------
+    delta, i, j : the change of cost (>= 0 if there is no improving move)
+    """
+    nb_pts = len(path)
+    if nb_pts < 4:
+        return 0.0, 0, 0
+    forward = np.concatenate(([0], np.cumsum(matrix[path[:-1], path[1:]])))
+    backward = np.concatenate(([0], np.cumsum(matrix[path[1:], path[:-1]])))
+    i = np.arange(nb_pts - 1)[:, None]
+    j = np.arange(nb_pts - 1)[None, :]
+    a, b = path[:-1][:, None], path[1:][:, None]
+    c, d = path[:-1][None, :], path[1:][None, :]
+    delta = (
+        matrix[a, c] + matrix[b, d] - matrix[a, b] - matrix[c, d]
+        + (backward[j] - backward[i + 1]) - (forward[j] - forward[i + 1])
+    )
+    delta = np.where(j > i + 1, delta, np.inf)
+    best = np.unravel_index(delta.argmin(), delta.shape)
+    return float(delta[best]), int(best[0]), int(best[1])
+
+
+def or_opt_move(matrix, path, length):
+    """
+    Best Or-opt move of a path with fixed ends: the segment
+    path[i:i + length] moved, in the same direction, between path[j] and
+    path[j + 1]
+
+    Return
+    ------
+    delta, i, j : the change of cost (>= 0 if there is no improving move)
+    """
+    nb_pts = len(path)
+    if nb_pts < length + 3:
+        return 0.0, 0, 0
+    i = np.arange(1, nb_pts - length)[:, None]
+    j = np.arange(nb_pts - 1)[None, :]
+    prev, first = path[i - 1], path[i]
+    last, nxt = path[i + length - 1], path[i + length]
+    removal = matrix[prev, first] + matrix[last, nxt] - matrix[prev, nxt]
+    insertion = (
+        matrix[path[j], first] + matrix[last, path[j + 1]]
+        - matrix[path[j], path[j + 1]]
+    )
+    delta = np.where(
+        (j < i - 1) | (j > i + length - 1), insertion - removal, np.inf)
+    best = np.unravel_index(delta.argmin(), delta.shape)
+    return float(delta[best]), int(i[best[0], 0]), int(best[1])
+
+
+def _apply_or_opt(path, i, j, length):
+    """Move path[i:i + length] between path[j] and path[j + 1]"""
+    segment = path[i:i + length]
+    rest = np.concatenate((path[:i], path[i + length:]))
+    position = j + 1 if j < i else j + 1 - length
+    return np.concatenate((rest[:position], segment, rest[position:]))
+
+
+def improve_path(matrix, path, max_moves=None):
+    """
+    Local search on a path with fixed ends, applying the best of the 2-opt
+    and Or-opt moves (each one evaluated over the whole path at once) until
+    no move improves the path
+    """
+    path = np.asarray(path, dtype=int)
+    if max_moves is None:
+        max_moves = 20 * len(path)
+    for _ in range(max_moves):
+        delta, i, j = two_opt_move(matrix, path)
+        move = ('2-opt', i, j)
+        for length in range(1, OR_OPT_MAX_SEGMENT + 1):
+            or_delta, or_i, or_j = or_opt_move(matrix, path, length)
+            if or_delta < delta:
+                delta, move = or_delta, (length, or_i, or_j)
+        if delta > -SOLVER_EPSILON:
+            break
+        kind, i, j = move
+        if kind == '2-opt':
+            path = np.concatenate(
+                (path[:i + 1], path[i + 1:j + 1][::-1], path[j + 1:]))
+        else:
+            path = _apply_or_opt(path, i, j, kind)
+    return path
+
+
+def solve_path(matrix, start=0, end=None):
+    """
+    Short path from start to end (a closed tour if end is None or start)
+    visiting every index of a duration matrix: nearest neighbour followed
+    by 2-opt / Or-opt local search
+    """
+    matrix = _costs(matrix)
+    end = start if end is None else end
+    path = nearest_neighbour_path(matrix, start, end)
+    return improve_path(matrix, path)
+
+
+def cluster_stops(coords, max_size=SOLVER_CLUSTER_SIZE, seed=0):
+    """
+    Split lon/lat coordinates in spatial clusters (k-means) of at most
+    max_size points, the larger clusters being split again
+
+    Return
+    ------
+    list of index arrays
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    points = local_xy(coords, np.mean(coords[:, 1]))
+    pending = [np.arange(len(coords))]
+    clusters = []
+    while pending:
+        members = pending.pop()
+        if len(members) <= max_size:
+            clusters.append(members)
+            continue
+        nb_clusters = int(np.ceil(len(members) / max_size))
+        _, labels = kmeans2(
+            points[members], nb_clusters, minit='++', seed=seed)
+        parts = [members[labels == label] for label in np.unique(labels)]
+        if len(parts) < 2:
+            parts = np.array_split(members, nb_clusters)
+        pending.extend(parts)
+    return clusters
+
+
+def _closest_pair(points, exits, entries):
+    """(exit, entry) indices of the closest pair of two sets of points"""
+    dist, nearest = cKDTree(points[entries]).query(points[exits])
+    best = int(np.argmin(dist))
+    return exits[best], entries[nearest[best]]
+
+
+def solve_large_tsp(coords, fetch_matrix, max_size=SOLVER_CLUSTER_SIZE):
+    """
+    Closed tour visiting every lon/lat coordinate, starting from the first
+    one, by cluster-and-stitch: the stops are split in clusters of at most
+    max_size stops, the clusters are ordered by a tour of their centroids,
+    consecutive clusters are linked by their closest pair of stops and the
+    path of each cluster, from its entry to its exit stop, is solved on the
+    duration matrix of the cluster only.
+
+    Params:
+
+    fetch_matrix: callable
+        Called with an array of stop indices, returning the square duration
+        matrix between these stops (NaN if no route)
+
+    Return
+    ------
+    array of the stop indices in visiting order
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) <= max_size:
+        return solve_path(fetch_matrix(np.arange(len(coords))))[:-1]
+
+    points = local_xy(coords, np.mean(coords[:, 1]))
+    clusters = cluster_stops(coords, max_size)
+    centroids = np.array([points[members].mean(axis=0)
+                          for members in clusters])
+    order = solve_path(
+        np.linalg.norm(centroids[:, None] - centroids[None, :], axis=2))
+    clusters = [clusters[k] for k in order[:-1]]
+
+    _, entry = _closest_pair(points, clusters[-1], clusters[0])
+    entries, exits = [entry], []
+    for k, members in enumerate(clusters):
+        candidates = members[members != entries[k]]
+        if len(candidates) == 0:
+            candidates = members
+        if k + 1 < len(clusters):
+            exit_stop, entry = _closest_pair(
+                points, candidates, clusters[k + 1])
+            entries.append(entry)
+        else:
+            exit_stop, _ = _closest_pair(
+                points, candidates, np.array([entries[0]]))
+        exits.append(exit_stop)
+
+    tour = []
+    for members, entry, exit_stop in zip(clusters, entries, exits):
+        start = int(np.flatnonzero(members == entry)[0])
+        end = int(np.flatnonzero(members == exit_stop)[0])
+        path = solve_path(fetch_matrix(members), start, end)
+        tour.append(members[path[:-1] if start == end else path])
+    tour = np.concatenate(tour)
+    return np.roll(tour, -int(np.flatnonzero(tour == 0)[0]))
+
+
+def tour_chunks(tour, max_coords=TRIP_MAX_COORDS, closed=True):
+    """
+    Split a tour in consecutive chunks of at most max_coords stops, each
+    chunk starting with the last stop of the previous one (and the last
+    chunk ending with the first stop for a closed tour), so that the routes
+    of the chunks join into the route of the tour
+    """
+    tour = np.asarray(tour, dtype=int)
+    if closed:
+        tour = np.append(tour, tour[0])
+    step = max(1, max_coords - 1)
+    return [tour[start:start + max_coords]
+            for start in range(0, max(1, len(tour) - 1), step)]
+
+
+def savings_routes(matrix, demands, capacity, max_duration=None,
+                   neighbours=VRP_SAVINGS_NEIGHBOURS):
+    """
+    Clarke and Wright savings heuristic: starting from one route per stop,
+    the routes are merged (the end of a route followed by the start of
+    another one) by decreasing saving, as long as the load stays under
+    capacity and the duration under max_duration. The savings are computed
+    at once on the whole matrix and only the best ones of each stop are
+    tried.
+
+    Params:
+
+    matrix: array
+        (n + 1, n + 1) duration matrix, the depot being the index 0
+    demands: array
+        Demand of each of the n stops
+
+    Return
+    ------
+    list of routes, each one an array of matrix indices (without depot)
+    """
+    nb_stops = len(matrix) - 1
+    demands = np.asarray(demands, dtype=float)
+    to_depot, from_depot = matrix[1:, 0], matrix[0, 1:]
+    savings = to_depot[:, None] + from_depot[None, :] - matrix[1:, 1:]
+    np.fill_diagonal(savings, -np.inf)
+
+    nb_best = max(1, min(neighbours, nb_stops - 1))
+    if nb_best < nb_stops - 1:
+        cols = np.argpartition(-savings, nb_best - 1, axis=1)[:, :nb_best]
+    else:
+        cols = np.tile(np.arange(nb_stops), (nb_stops, 1))
+    rows = np.repeat(np.arange(nb_stops), cols.shape[1])
+    cols = cols.ravel()
+    values = savings[rows, cols]
+    order = np.argsort(-values, kind='stable')
+    order = order[values[order] > 0]
+
+    routes = {stop: [stop] for stop in range(nb_stops)}
+    route_of = np.arange(nb_stops)
+    first, last = np.arange(nb_stops), np.arange(nb_stops)
+    load = demands.copy()
+    duration = to_depot + from_depot
+    for i, j in zip(rows[order], cols[order]):
+        route_i, route_j = route_of[i], route_of[j]
+        if route_i == route_j or last[route_i] != i or first[route_j] != j:
+            continue
+        if load[route_i] + load[route_j] > capacity:
+            continue
+        merged = (duration[route_i] + duration[route_j]
+                  - to_depot[i] - from_depot[j] + matrix[i + 1, j + 1])
+        if max_duration is not None and merged > max_duration:
+            continue
+        stops_j = routes.pop(route_j)
+        route_of[stops_j] = route_i
+        routes[route_i].extend(stops_j)
+        load[route_i] += load[route_j]
+        duration[route_i] = merged
+        last[route_i] = last[route_j]
+    return [np.array(route, dtype=int) + 1 for route in routes.values()]
+
+
+def _route_duration(matrix, route):
+    """Duration of a route from and back to the depot (index 0)"""
+    return path_cost(matrix, np.concatenate(([0], route, [0])))
+
+
+def relocate_move(matrix, routes, loads, durations, demands, stop_route,
+                  position, capacity, max_duration=None):
+    """
+    Best relocation of the stop routes[stop_route][position] between two
+    consecutive stops (or the depot) of any route, the insertion costs of
+    every edge of every route being evaluated at once
+
+    Return
+    ------
+    delta, route, position : the change of the total duration (>= 0 if
+    there is no improving feasible move), the target route and the position
+    of the stop in the target route after the move
+    """
+    route = routes[stop_route]
+    stop = route[position]
+    prev = route[position - 1] if position > 0 else 0
+    nxt = route[position + 1] if position + 1 < len(route) else 0
+    removal = matrix[prev, stop] + matrix[stop, nxt] - matrix[prev, nxt]
+
+    paths = [np.concatenate(([0], other, [0])) for other in routes]
+    starts = np.concatenate([path[:-1] for path in paths])
+    ends = np.concatenate([path[1:] for path in paths])
+    edge_route = np.repeat(np.arange(len(routes)),
+                           [len(path) - 1 for path in paths])
+    edge_position = np.concatenate(
+        [np.arange(len(path) - 1) for path in paths])
+    insertion = (matrix[starts, stop] + matrix[stop, ends]
+                 - matrix[starts, ends])
+
+    same = edge_route == stop_route
+    feasible = np.where(
+        same,
+        (edge_position != position) & (edge_position != position + 1),
+        loads[edge_route] + demands[stop - 1] <= capacity
+    )
+    if max_duration is not None:
+        feasible &= np.where(
+            same,
+            durations[edge_route] - removal + insertion <= max_duration,
+            durations[edge_route] + insertion <= max_duration
+        )
+    delta = np.where(feasible, insertion - removal, np.inf)
+    best = int(delta.argmin())
+    target_position = int(edge_position[best])
+    if same[best] and target_position > position:
+        target_position -= 1
+    return float(delta[best]), int(edge_route[best]), target_position
+
+
+def _search_over(deadline, stop_event):
+    """Whether the deadline is reached or the stop event is set"""
+    return (deadline is not None and time.monotonic() >= deadline) \
+        or (stop_event is not None and stop_event.is_set())
+
+
+def improve_routes(matrix, routes, demands, capacity, max_duration=None,
+                   deadline=None, stop_event=None):
+    """
+    Local search on vehicle routes until no move improves them, the
+    deadline (time.monotonic() value) is reached or stop_event
+    (threading.Event) is set: 2-opt / Or-opt inside each route and
+    relocation of single stops between routes (a route emptied by the
+    relocations being dropped)
+    """
+    routes = [np.asarray(route, dtype=int) for route in routes]
+    demands = np.asarray(demands, dtype=float)
+    improved = True
+    while improved and not _search_over(deadline, stop_event):
+        improved = False
+        for k, route in enumerate(routes):
+            path = improve_path(matrix, np.concatenate(([0], route, [0])))
+            if not np.array_equal(path[1:-1], route):
+                routes[k] = path[1:-1]
+                improved = True
+
+        loads = np.array([demands[route - 1].sum() for route in routes])
+        durations = np.array(
+            [_route_duration(matrix, route) for route in routes])
+        for stop in np.random.default_rng(0).permutation(len(demands)) + 1:
+            if _search_over(deadline, stop_event):
+                break
+            stop_route = next(k for k, route in enumerate(routes)
+                              if stop in route)
+            position = int(np.flatnonzero(routes[stop_route] == stop)[0])
+            delta, target, target_position = relocate_move(
+                matrix, routes, loads, durations, demands, stop_route,
+                position, capacity, max_duration)
+            if delta > -SOLVER_EPSILON:
+                continue
+            routes[stop_route] = np.delete(routes[stop_route], position)
+            routes[target] = np.insert(
+                routes[target], target_position, stop)
+            for k in {stop_route, target}:
+                loads[k] = demands[routes[k] - 1].sum()
+                durations[k] = _route_duration(matrix, routes[k])
+            improved = True
+            if len(routes[stop_route]) == 0:
+                del routes[stop_route]
+                loads = np.delete(loads, stop_route)
+                durations = np.delete(durations, stop_route)
+    return routes
+
+
+def solve_vrp(matrix, demands, capacity, max_duration=None,
+              time_budget=VRP_TIME_BUDGET, stop_event=None):
+    """
+    Capacitated vehicle routing from a depot: savings heuristic followed by
+    a local search stopped after time_budget seconds, or earlier when
+    stop_event (threading.Event) is set
+
+    Params:
+
+    matrix: array
+        (n + 1, n + 1) duration matrix (NaN if no route), the depot being
+        the index 0 and the n stops the next ones
+    demands: array
+        Demand of each stop
+    capacity: float
+        Capacity of every vehicle
+    max_duration: float or None
+        Maximum duration of a route (in the unit of the matrix)
+
+    Return
+    ------
+    list of routes, each one an array of stop indices (from 0 to n - 1) in
+    visiting order
+    """
+    deadline = time.monotonic() + time_budget
+    matrix = _costs(matrix)
+    routes = savings_routes(matrix, demands, capacity, max_duration)
+    routes = improve_routes(
+        matrix, routes, demands, capacity, max_duration, deadline,
+        stop_event)
+    return [route - 1 for route in routes]
@@ -0,0 +1,123 @@
+"""
+Regression tests of the hints sent back to OSRM with the table requests
+"""
+import json
+import re
+import unittest
+from unittest import mock
+
+try:
+    from .. import osrm_utils
+except ImportError:  # QGIS is not available
+    osrm_utils = None
+
+
+URL = 'http://localhost:5000/table/v1/driving/'
+SOURCES = [(2.35, 48.85), (2.36, 48.86)]
+DESTINATIONS = [(2.37, 48.87), (2.38, 48.88), (2.39, 48.89)]
+# Length of the hints of an OSRM 5 server
+HINT_LENGTH = 88
+
+
+def hint_of(location):
+    """Hint of a snapped location, as long as the ones of OSRM"""
+    return f'{location[0]:.5f}_{location[1]:.5f}'.ljust(HINT_LENGTH, 'A')
+
+
+def table_response(query):
+    """
+    Body of the OSRM table response to a query (without the sources and
+    destinations when the waypoints are skipped)
+    """
+    polyline = re.search(r'polyline\((.*?)\)', query).group(1)
+    locations = [
+        [lon, lat]
+        for lat, lon in osrm_utils.PolylineCodec().decode(polyline)
+    ]
+    nb_src = len(re.search(r'sources=([\d;]+)', query).group(1).split(';'))
+    sources, destinations = locations[:nb_src], locations[nb_src:]
+    response = {
+        'code': 'Ok',
+        'durations': [[60.0] * len(destinations) for _ in sources],
+    }
+    if 'skip_waypoints=true' not in query:
+        response['sources'] = [
+            {'location': location, 'hint': hint_of(location)}
+            for location in sources
+        ]
+        response['destinations'] = [
+            {'location': location, 'hint': hint_of(location)}
+            for location in destinations
+        ]
+    return json.dumps(response).encode()
+
+
+@unittest.skipIf(osrm_utils is None, 'QGIS is not available')
+class TableHintsTest(unittest.TestCase):
+    """Table requests sent again once the hints of their points are known"""
+
+    def setUp(self):
+        osrm_utils.HINT_CACHE.clear()
+        self.queries = []
+
+        def request(_method, query, **_kwargs):
+            self.queries.append(query)
+            return mock.Mock(status=200, data=table_response(query))
+
+        patcher = mock.patch.object(osrm_utils.urllib3, 'PoolManager')
+        pool_manager = patcher.start()
+        pool_manager.return_value.request.side_effect = request
+        self.addCleanup(patcher.stop)
+
+    def test_same_table_twice(self):
+        """The snapped points are still returned by the hinted request"""
+        for _ in range(2):
+            values, snapped_src, snapped_dest = osrm_utils.fetch_table(
+                URL, '', SOURCES, DESTINATIONS)
+            self.assertEqual(values.shape, (2, 3))
+            self.assertEqual(snapped_src, [list(c) for c in SOURCES])
+            self.assertEqual(snapped_dest, [list(c) for c in DESTINATIONS])
+
+        hints = ';'.join(hint_of(c) for c in SOURCES + DESTINATIONS)
+        self.assertNotIn('hints=', self.queries[0])
+        self.assertIn(f'&hints={hints}', self.queries[1])
+        self.assertNotIn('skip_waypoints', self.queries[1])
+
+    def test_full_size_blocks_carry_hints(self):
+        """The table blocks are resized so that their hints are sent"""
+        coords = [(2.3 + i * 0.00137, 48.8 + (i % 17) * 0.00211)
+                  for i in range(150)]
+        nb_queries = []
+        for _ in range(2):
+            cells = sum(
+                values.size
+                for _, _, values, _, _ in osrm_utils.iter_table_blocks(
+                    URL, '', coords, coords))
+            self.assertEqual(cells, len(coords) ** 2)
+            nb_queries.append(len(self.queries))
+
+        # The hints alone of a block of TABLE_MAX_COORDS locations do not
+        # fit in the url
+        self.assertGreater(
+            osrm_utils.TABLE_MAX_COORDS * (HINT_LENGTH + 1),
+            osrm_utils.HINTS_MAX_URL_LENGTH)
+        for query in self.queries[nb_queries[0]:]:
+            self.assertIn('hints=', query)
+            self.assertLessEqual(
+                len(query), osrm_utils.HINTS_MAX_URL_LENGTH)
+
+    def test_too_long_query_keeps_waypoints(self):
+        """A query left without its hints does not skip the waypoints"""
+        osrm_utils.HINT_CACHE.update(
+            URL, SOURCES, [{'hint': 'h' * 100}] * len(SOURCES))
+        query = 'http://localhost:5000/route/v1/driving/polyline(x)?'
+        with mock.patch.object(osrm_utils, 'HINTS_MAX_URL_LENGTH', 100):
+            self.assertEqual(
+                osrm_utils.add_hints(query, URL, SOURCES, True), query)
+        self.assertEqual(
+            osrm_utils.add_hints(query, URL, SOURCES, True),
+            f'{query}&skip_waypoints=true&hints={"h" * 100};{"h" * 100}')
+
+
+if __name__ == '__main__':
+    unittest.main()